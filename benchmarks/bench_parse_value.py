@@ -0,0 +1,72 @@
+"""
+Micro-benchmark comparing `namelist_python.values.parse_value` with the
+exception based value parser that `Namelist._parse_value` used before.
+
+    python benchmarks/bench_parse_value.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from namelist_python.values import parse_value
+
+
+class NoSingleValueFoundException(Exception):
+    pass
+
+_complex_re = re.compile(r'^\((\d+.?\d*),(\d+.?\d*)\)$')
+
+def legacy_parse_value(variable_value):
+    try:
+        parsed_value = int(variable_value)
+    except ValueError:
+        try:
+            parsed_value = float(variable_value)
+        except ValueError:
+            # check for complex number
+            complex_values = re.findall(_complex_re, variable_value)
+            if len(complex_values) == 1:
+                a, b = complex_values[0]
+                parsed_value = complex(float(a),float(b))
+            elif variable_value in ['.true.', 'T']:
+                # check for a boolean
+                parsed_value = True
+            elif variable_value in ['.false.', 'F']:
+                parsed_value = False
+            else:
+                # see if we have an escaped string
+                if variable_value.startswith("'") and variable_value.endswith("'") and variable_value.count("'") == 2:
+                    parsed_value = variable_value[1:-1]
+                elif variable_value.startswith('"') and variable_value.endswith('"') and variable_value.count('"') == 2:
+                    parsed_value = variable_value[1:-1]
+                else:
+                    raise NoSingleValueFoundException(variable_value)
+
+    return parsed_value
+
+
+CASES = [
+    ('int', '42'),
+    ('float', '3.14159'),
+    ('float exponent', '1.5e-3'),
+    ('complex', '(3.,4.)'),
+    ('logical', '.true.'),
+    ('logical short', 'F'),
+    ('string', "'cloud_water'"),
+]
+
+
+def main(number=200000):
+    print("%-16s %12s %12s %8s" % ('value', 'legacy (us)', 'new (us)', 'speedup'))
+    for name, value_str in CASES:
+        assert legacy_parse_value(value_str) == parse_value(value_str)
+        t_legacy = min(timeit.repeat(lambda: legacy_parse_value(value_str), number=number, repeat=3))
+        t_new = min(timeit.repeat(lambda: parse_value(value_str), number=number, repeat=3))
+        print("%-16s %12.3f %12.3f %7.1fx" % (name, t_legacy/number*1e6, t_new/number*1e6, t_legacy/t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Generators for synthetic namelist files used by the benchmarks. All
+generators are deterministic so that runs can be compared.
+"""
+import random
+
+
+def many_small_groups(n_groups=2000, n_variables=5, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for n in range(n_groups):
+        lines.append("&group_%d" % n)
+        for m in range(n_variables):
+            lines.append("  var_%d = %f" % (m, rng.uniform(-100., 100.)))
+        lines.append("/")
+    return "\n".join(lines) + "\n"
+
+
+def huge_inline_float_array(n_values=200000, values_per_line=10, seed=0):
+    rng = random.Random(seed)
+    values = ["%.6f" % rng.uniform(0., 1000.) for _ in range(n_values)]
+    rows = [" ".join(values[i:i+values_per_line]) for i in range(0, n_values, values_per_line)]
+    return "&grid\n  levels = %s\n/\n" % "\n           ".join(rows)
+
+
+def indexed_arrays(n_variables=20, n_elements=1000, seed=0):
+    rng = random.Random(seed)
+    lines = ["&tables"]
+    for n in range(n_variables):
+        for i in range(n_elements):
+            lines.append("  table_%d(%d) = %d" % (n, i+1, rng.randint(-1000, 1000)))
+    lines.append("/")
+    return "\n".join(lines) + "\n"
+
+
+def string_heavy(n_groups=200, n_variables=20, seed=0):
+    rng = random.Random(seed)
+    words = ['cloud_water', 'rain', 'cloud_ice', 'graupel', '/home/monkey/', "it''s", 'a ! b']
+    lines = []
+    for n in range(n_groups):
+        lines.append("&strings_%d ! a comment" % n)
+        for m in range(n_variables):
+            lines.append("  name_%d = '%s' '%s'" % (m, rng.choice(words), rng.choice(words)))
+        lines.append("/")
+    return "\n".join(lines) + "\n"
+
+
+def complex_values(n_values=50000, seed=0):
+    rng = random.Random(seed)
+    values = ["(%.3f,%.3f)" % (rng.uniform(-10., 10.), rng.uniform(-10., 10.)) for _ in range(n_values)]
+    rows = [" ".join(values[i:i+8]) for i in range(0, n_values, 8)]
+    return "&spectrum\n  coefs = %s\n/\n" % "\n          ".join(rows)
+
+
+CORPUS = {
+    'many_small_groups': many_small_groups,
+    'huge_inline_float_array': huge_inline_float_array,
+    'indexed_arrays': indexed_arrays,
+    'string_heavy': string_heavy,
+    'complex_values': complex_values,
+}
@@ -0,0 +1,161 @@
+"""
+Benchmarks of the parse and dump hot paths on a synthetic corpus.
+
+For every case in `corpus.CORPUS` the time taken to parse the text into
+assignments (`parse_text`, the path `Namelist` takes) and build the groups
+from them, and to dump the result is measured, together with the throughput
+and the peak memory used while parsing. Tokenizing and assembling the tokens,
+the path taken when the layout is kept, is timed as well. Results can be saved as
+JSON and compared against a stored baseline:
+
+    python benchmarks/run_benchmarks.py --output baseline.json
+    python benchmarks/run_benchmarks.py --baseline baseline.json
+
+When comparing, the exit code is 1 if any timing is slower than the
+baseline by more than the given tolerance.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from namelist_python import Namelist
+from namelist_python.parser import tokenize, parse, parse_text
+
+from corpus import CORPUS
+
+# timings that are compared against the baseline
+TIMINGS = ['tokenize_s', 'assemble_s', 'parse_text_s', 'parse_s', 'dump_s']
+
+
+def _best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        result = fn()
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best, result
+
+
+def run_case(text, repeat=3):
+    size_mb = len(text.encode('utf-8'))/1.0e6
+
+    tokenize_s, tokens = _best_time(lambda: list(tokenize(text)), repeat)
+    assemble_s, _ = _best_time(lambda: list(parse(iter(tokens))), repeat)
+    parse_text_s, groups = _best_time(lambda: list(parse_text(text)), repeat)
+    parse_s, namelist = _best_time(lambda: Namelist(text), repeat)
+    dump_s, output = _best_time(namelist.dump, repeat)
+
+    n_values = sum(len(values) for _, assignments in groups for _, _, values in assignments)
+
+    gc.collect()
+    tracemalloc.start()
+    Namelist(text)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'size_mb': size_mb,
+        'n_groups': len(groups),
+        'n_values': n_values,
+        'tokenize_s': tokenize_s,
+        'assemble_s': assemble_s,
+        'parse_text_s': parse_text_s,
+        # building the groups from the assignments, i.e. value conversion
+        # and array assembly
+        'build_s': max(parse_s - parse_text_s, 0.),
+        'parse_s': parse_s,
+        'dump_s': dump_s,
+        'parse_mb_per_s': size_mb/parse_s,
+        'parse_values_per_s': n_values/parse_s,
+        'dump_mb_per_s': len(output.encode('utf-8'))/1.0e6/dump_s,
+        'peak_memory_mb': peak_memory/1.0e6,
+    }
+
+
+def run(cases=None, repeat=3):
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': {},
+    }
+    for name in cases or sorted(CORPUS.keys()):
+        results['cases'][name] = run_case(CORPUS[name](), repeat=repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the timings relative to the baseline, returns the list of
+    `(case, timing)` that are slower than the baseline by more than
+    `tolerance` (a fraction)
+    """
+    regressions = []
+    print("%-26s %-12s %10s %10s %8s" % ('case', 'timing', 'baseline', 'current', 'ratio'))
+    for name, case in sorted(results['cases'].items()):
+        if name not in baseline['cases']:
+            continue
+        for timing in TIMINGS:
+            if timing not in baseline['cases'][name]:
+                # saved before the timing was added
+                continue
+            old, new = baseline['cases'][name][timing], case[timing]
+            ratio = new/old if old > 0 else float('inf')
+            flag = ''
+            if ratio > 1. + tolerance:
+                regressions.append((name, timing))
+                flag = ' <-- slower'
+            print("%-26s %-12s %10.4f %10.4f %7.2fx%s" % (name, timing, old, new, ratio, flag))
+    return regressions
+
+
+def print_results(results):
+    print("%-26s %9s %10s %10s %10s %12s %10s" % ('case', 'size (MB)', 'parse (s)', 'dump (s)',
+                                                 'MB/s', 'values/s', 'peak (MB)'))
+    for name, case in sorted(results['cases'].items()):
+        print("%-26s %9.2f %10.4f %10.4f %10.2f %12.0f %10.1f" % (
+            name, case['size_mb'], case['parse_s'], case['dump_s'],
+            case['parse_mb_per_s'], case['parse_values_per_s'], case['peak_memory_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('cases', nargs='*',
+                        help="cases to run, one of %s (default: all)" % ", ".join(sorted(CORPUS.keys())))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="save the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against results saved earlier")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="fraction by which timings may be slower than the baseline")
+    args = parser.parse_args(argv)
+    for name in args.cases:
+        if name not in CORPUS:
+            parser.error("unknown case '%s'" % name)
+
+    results = run(args.cases, repeat=args.repeat)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("")
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
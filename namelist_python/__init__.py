@@ -1 +1,7 @@
-from .namelist import read_namelist_file, Namelist, AttributeMapper
+from .namelist import read_namelist_file, iter_namelist_groups, apply_patch, Namelist, AttributeMapper
+from .cache import NamelistCache
+from .batch import read_namelist_files, read_namelist_dir
+from .template import NamelistTemplate
+from .layers import LayeredNamelist
+from .schema import Schema, SchemaValidationError, ValidationError, validate_files
+from .watch import NamelistWatcher
@@ -0,0 +1,599 @@
+"""
+Array storage for namelist variables.
+
+Values given with a repeat count, e.g. `1000*0.01`, are kept as a
+`RunLengthArray` which only expands to a full list when asked to.
+
+NumPy is optional, it is only needed when parsing with
+`array_backend='numpy'`.
+"""
+import re
+import warnings
+from bisect import bisect_left, bisect_right
+from itertools import product, repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .values import _logical_values
+
+ARRAY_BACKENDS = ('list', 'numpy')
+
+# number of unassigned elements beyond the end of an array above which the
+# array is stored sparse while parsing
+SPARSE_GAP = 1024
+
+_long_int_re = re.compile(r'\d{19}')
+
+
+def check_array_backend(array_backend):
+    if array_backend not in ARRAY_BACKENDS:
+        raise ValueError("Array backend '%s' not understood, should be one of %s"
+                         % (array_backend, ", ".join(ARRAY_BACKENDS)))
+    if array_backend == 'numpy' and numpy is None:
+        raise ImportError("array_backend='numpy' requires numpy to be installed")
+
+
+def is_numpy_array(value):
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def is_numpy_scalar(value):
+    return numpy is not None and isinstance(value, numpy.generic)
+
+
+def parse_numpy_array(raw_values, parse_value):
+    """
+    Converts a list of raw value strings into a numpy array in one go, using
+    the first value to decide on the type. Returns `None` if the values
+    aren't a homogeneous numeric or boolean array.
+    """
+    first_value = parse_value(raw_values[0])
+
+    if isinstance(first_value, bool):
+        parsed_values = [_logical_values.get(v.lower()) for v in raw_values]
+        if None in parsed_values:
+            return None
+        return numpy.array(parsed_values, dtype=bool)
+    elif isinstance(first_value, (int, float)):
+        # each value is parsed as with the list backend, so that values
+        # numpy would accept but fortran doesn't (e.g. `nan`) aren't
+        # (runs of plain numbers are converted by `parse_number_run`)
+        array = to_numpy_array([parse_value(v) for v in raw_values])
+        return array if is_numpy_array(array) else None
+    elif isinstance(first_value, complex):
+        try:
+            return numpy.array([parse_value(v) for v in raw_values], dtype=complex)
+        except (TypeError, ValueError):
+            return None
+    else:
+        return None
+
+
+def parse_number_run(text):
+    """
+    Converts the text of a run of plain numbers (a `parser.NumberRun`) into
+    a numpy array directly, without splitting it into separate values. The
+    array has integers if none of the numbers has a decimal point or an
+    exponent. Returns `None` if the text isn't only numbers, or has integers
+    that might not fit in 64 bits.
+    """
+    if 'd' in text or 'D' in text:
+        # double precision exponents, e.g. 1.0d-3, aren't understood by numpy
+        text = text.replace('d', 'e').replace('D', 'e')
+    if '.' in text or 'e' in text or 'E' in text:
+        dtype = numpy.float64
+    elif _long_int_re.search(text):
+        return None
+    else:
+        dtype = numpy.int64
+    text = text.replace(',', ' ')
+
+    with warnings.catch_warnings():
+        # numpy stops at the first thing that isn't a number, with a warning
+        # or (in newer versions) an error
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            array = numpy.fromstring(text, dtype=dtype, sep=' ')
+        except ValueError:
+            return None
+
+    # a number numpy reads differently than fortran, e.g. `1.2.3` read as
+    # `1.2` and `.3`, changes the count of numbers
+    chars = numpy.frombuffer(text.encode('ascii'), dtype=numpy.uint8)
+    is_space = chars <= ord(' ')
+    count = numpy.count_nonzero(is_space[:-1] & ~is_space[1:]) + 1
+    if len(array) != count:
+        return None
+    return array
+
+
+def to_numpy_array(values):
+    """
+    Converts a list of parsed values into a numpy array if they all have the
+    same numeric or boolean type, otherwise the list is returned as is (as
+    it is for integers too large for numpy)
+    """
+    value_types = set(type(v) for v in values)
+    if len(value_types) == 1:
+        value_type = value_types.pop()
+        if value_type in (bool, int, float, complex):
+            try:
+                return numpy.array(values, dtype=value_type)
+            except OverflowError:
+                return values
+    elif value_types == set([int, float]):
+        return numpy.array(values, dtype=float)
+    return values
+
+
+def format_numpy_array(array, format_value):
+    """
+    Formats all values in a numpy array at once, returning a list of strings
+    """
+    # converting to a list of python scalars first is considerably faster
+    # than numpy's own string operations
+    kind = array.dtype.kind
+    if kind == 'b':
+        return numpy.where(array, '.true.', '.false.').tolist()
+    elif kind in 'iu':
+        return ['%d' % v for v in array.tolist()]
+    elif kind == 'f':
+        # same formatting as for single floats, never use scientific notation
+        return [('%f' % v).rstrip('0') for v in array.tolist()]
+    else:
+        return [format_value(v) for v in array.tolist()]
+
+
+# placeholder for array elements that haven't been assigned yet
+_unset = object()
+
+
+class ArrayBuilder(object):
+    """
+    Collects the values of an array as they are assigned while parsing,
+    placing them straight into a list that grows as needed. If an index far
+    beyond the end of the list is assigned the elements are kept in a dict
+    instead, so that the gap is never allocated.
+    """
+    __slots__ = ('values', 'n_unset', 'sparse')
+
+    def __init__(self, initial=None):
+        self.n_unset = 0
+        self.sparse = None
+        if initial is None:
+            self.values = []
+        elif isinstance(initial, list):
+            self.values = list(initial)
+        elif isinstance(initial, SparseArray):
+            self.values = None
+            self.sparse = dict(initial.items())
+        elif isinstance(initial, RunLengthArray) or is_numpy_array(initial):
+            self.values = initial.tolist()
+        else:
+            # a single value given before, which is the first element
+            self.values = [initial]
+
+    def set_values(self, index, new_values):
+        """
+        Sets the elements starting at `index`, returns False if the index is
+        out of range (i.e. negative)
+        """
+        if index < 0:
+            return False
+        if self.sparse is not None:
+            self.sparse.update(zip(range(index, index + len(new_values)), new_values))
+            return True
+        values = self.values
+        n = len(values)
+        if index == n:
+            values.extend(new_values)
+            return True
+        if index - n > SPARSE_GAP:
+            self.sparse = dict((i, v) for i, v in enumerate(values) if v is not _unset)
+            self.values = None
+            return self.set_values(index, new_values)
+        end = index + len(new_values)
+        if end > n:
+            # grow the list, leaving a gap of unset elements if needed
+            values.extend([_unset]*(end - n))
+            self.n_unset += end - n
+        self.n_unset -= sum(1 for v in values[index:end] if v is _unset)
+        values[index:end] = new_values
+        return True
+
+    def set_section(self, section, new_values):
+        """
+        Sets the elements in the `slice` `section`, an open upper bound
+        takes as many elements as there are values. Returns False if the
+        section is out of range.
+        """
+        start, stop, step = section.start, section.stop, section.step
+        if step < 0:
+            if start is None:
+                # would need to know the size of the array
+                return False
+            indices = range(start, -1 if stop is None else stop, step)
+        else:
+            start = start or 0
+            if stop is None:
+                stop = start + step*len(new_values)
+            indices = range(start, stop, step)
+
+        if step == 1:
+            return self.set_values(start, new_values[:len(indices)])
+        for index, value in zip(indices, new_values):
+            if not self.set_values(index, [value]):
+                return False
+        return True
+
+    def build(self, array_backend='list'):
+        """
+        Returns the array as a list (or numpy array), or as a `SparseArray`
+        if not all elements have been assigned
+        """
+        if self.sparse is not None:
+            indices = sorted(self.sparse)
+            if len(indices) < indices[-1] + 1:
+                return SparseArray(indices, [self.sparse[i] for i in indices])
+            values = [self.sparse[i] for i in indices]
+        elif self.n_unset > 0:
+            indices = [i for i, v in enumerate(self.values) if v is not _unset]
+            return SparseArray(indices, [self.values[i] for i in indices])
+        else:
+            values = self.values
+        if array_backend == 'numpy':
+            return to_numpy_array(values)
+        return values
+
+
+class NDArrayBuilder(object):
+    """
+    Collects assignments to (sections of) a multi-dimensional array. As the
+    shape of the array is only known once all assignments have been seen,
+    it is allocated and filled in when `build` is called.
+    """
+    __slots__ = ('assignments',)
+
+    def __init__(self):
+        self.assignments = []
+
+    def add(self, subscript, values):
+        self.assignments.append((subscript, values))
+
+    def shape(self):
+        ndim = len(self.assignments[0][0])
+        if any(len(subscript) != ndim for subscript, _ in self.assignments):
+            raise ValueError("inconsistent number of dimensions")
+
+        # extent of each dimension from the explicit indices and bounds
+        shape = [0]*ndim
+        for subscript, values in self.assignments:
+            for d, s in enumerate(subscript):
+                if isinstance(s, slice):
+                    if s.step > 0:
+                        extent = max(s.stop or 0, 0 if s.start is None else s.start + 1)
+                    else:
+                        extent = 0 if s.start is None else s.start + 1
+                elif s < 0:
+                    raise ValueError("index %d is smaller than 1" % (s + 1))
+                else:
+                    extent = s + 1
+                shape[d] = max(shape[d], extent)
+
+        # an open section, e.g. `a(:,1)`, of a dimension with unknown extent
+        # is as long as needed for the values given
+        for subscript, values in self.assignments:
+            unknown = [d for d in range(ndim) if shape[d] == 0]
+            if len(unknown) != 1:
+                continue
+            d = unknown[0]
+            s = subscript[d]
+            if not isinstance(s, slice) or s.step < 0:
+                continue
+            n_other = 1
+            for other_d, other_s in enumerate(subscript):
+                if other_d != d:
+                    n_other *= len(_section_indices(other_s, shape[other_d]))
+            n = -(-len(values) // n_other)
+            shape[d] = (s.start or 0) + (n - 1)*s.step + 1
+
+        if 0 in shape:
+            raise ValueError("the shape of the array can't be determined")
+        return shape
+
+    def build(self, array_backend='list'):
+        """
+        Allocates the array and fills in all assigned values, returning a
+        numpy array (for the numpy backend) or nested lists, indexed in the
+        same order as in fortran
+        """
+        shape = self.shape()
+
+        # fortran arrays are stored column-major, i.e. the first index
+        # changes fastest
+        strides = [1]
+        for extent in shape[:-1]:
+            strides.append(strides[-1]*extent)
+        size = strides[-1]*shape[-1]
+
+        flat = [_unset]*size
+        for subscript, values in self.assignments:
+            offsets = [0]
+            for d, s in enumerate(subscript):
+                offsets = [o + i*strides[d] for i in _section_indices(s, shape[d]) for o in offsets]
+            if len(values) > len(offsets):
+                raise ValueError("too many values given for the array section")
+            for offset, value in zip(offsets, values):
+                flat[offset] = value
+
+        if any(v is _unset for v in flat):
+            raise ValueError("not all elements of the array have been assigned")
+
+        if array_backend == 'numpy':
+            array = to_numpy_array(flat)
+            if is_numpy_array(array):
+                return array.reshape(shape, order='F')
+        return _nest(flat, shape, strides, 0, 0)
+
+
+def _section_indices(s, extent):
+    if isinstance(s, slice):
+        return range(*s.indices(extent))
+    return [s]
+
+
+def _nest(flat, shape, strides, offset, d):
+    if d == len(shape) - 1:
+        return [flat[offset + i*strides[d]] for i in range(shape[d])]
+    return [_nest(flat, shape, strides, offset + i*strides[d], d + 1) for i in range(shape[d])]
+
+
+def is_nd_array(value):
+    """
+    Whether `value` is an array with more than one dimension, either a numpy
+    array or nested lists
+    """
+    if is_numpy_array(value):
+        return value.ndim > 1
+    return isinstance(value, list) and len(value) > 0 and isinstance(value[0], list)
+
+
+def is_type_array(value):
+    """
+    Whether `value` is an array of derived types, i.e. a list of dicts
+    """
+    return isinstance(value, list) and len(value) > 0 and isinstance(value[0], dict)
+
+
+def fortran_order(value):
+    """
+    Returns the shape and the values in column-major order of a
+    multi-dimensional array
+    """
+    if is_numpy_array(value):
+        return value.shape, value.ravel(order='F')
+
+    shape = []
+    v = value
+    while isinstance(v, list):
+        shape.append(len(v))
+        v = v[0] if v else None
+
+    flat = []
+    for index in product(*[range(extent) for extent in reversed(shape)]):
+        v = value
+        for i in reversed(index):
+            v = v[i]
+        flat.append(v)
+    return tuple(shape), flat
+
+
+class SparseArray(object):
+    """
+    Array of which only some elements are assigned, stored as the sorted
+    (zero-based) indices of the assigned elements and their values.
+    Unassigned elements read as `fill_value`. The length is one past the
+    highest index assigned, unless a larger `size` is given.
+    """
+
+    def __init__(self, indices, values, size=None, fill_value=None):
+        if len(indices) != len(values):
+            raise ValueError("SparseArray needs as many indices as values")
+        self.indices = list(indices)
+        self.values = list(values)
+        self.size = max(size or 0, self.indices[-1] + 1 if self.indices else 0)
+        self.fill_value = fill_value
+
+    @property
+    def nnz(self):
+        """
+        Number of assigned elements
+        """
+        return len(self.indices)
+
+    def items(self):
+        """
+        Iterates over `(index, value)` of the assigned elements only
+        """
+        return zip(self.indices, self.values)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        fill_value = self.fill_value
+        n = 0
+        for i, value in zip(self.indices, self.values):
+            for _ in range(n, i):
+                yield fill_value
+            yield value
+            n = i + 1
+        for _ in range(n, self.size):
+            yield fill_value
+
+    def _position(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("SparseArray index out of range")
+        return i, bisect_left(self.indices, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.size)
+            if step != 1:
+                return self.tolist()[i]
+            # a contiguous section is again sparse, with indices relative to
+            # its start
+            lo = bisect_left(self.indices, start)
+            hi = bisect_left(self.indices, stop)
+            return SparseArray([n - start for n in self.indices[lo:hi]], self.values[lo:hi],
+                               size=max(stop - start, 0), fill_value=self.fill_value)
+        i, n = self._position(i)
+        if n < len(self.indices) and self.indices[n] == i:
+            return self.values[n]
+        return self.fill_value
+
+    def __setitem__(self, i, value):
+        i, n = self._position(i)
+        if n < len(self.indices) and self.indices[n] == i:
+            self.values[n] = value
+        else:
+            self.indices.insert(n, i)
+            self.values.insert(n, value)
+
+    def __delitem__(self, i):
+        """
+        Unassigns the element at `i`
+        """
+        i, n = self._position(i)
+        if n < len(self.indices) and self.indices[n] == i:
+            del self.indices[n]
+            del self.values[n]
+
+    def __eq__(self, other):
+        if isinstance(other, SparseArray):
+            return (self.size == other.size and self.indices == other.indices and
+                    self.values == other.values)
+        try:
+            return len(self) == len(other) and self.tolist() == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "%s(%r, %r, size=%d)" % (self.__class__.__name__, self.indices, self.values, self.size)
+
+    def todense(self, fill_value=None):
+        """
+        Returns all elements as a list, with unassigned elements set to
+        `fill_value` (by default the fill value of the array)
+        """
+        if fill_value is None:
+            fill_value = self.fill_value
+        values = [fill_value]*self.size
+        for i, value in zip(self.indices, self.values):
+            values[i] = value
+        return values
+
+    tolist = todense
+
+    def to_numpy(self, fill_value=None):
+        if numpy is None:
+            raise ImportError("numpy is required to convert to a numpy array")
+        return numpy.array(self.todense(fill_value))
+
+
+class RunLengthArray(object):
+    """
+    Array stored as runs of `[count, value]`, as given in a namelist with
+    repeat counts (`r*c`). Undefined (null) values are `None`.
+    """
+
+    def __init__(self, runs):
+        self.runs = [list(run) for run in runs]
+        self._offsets = None
+
+    def _run_offsets(self):
+        # index of the first element of each run (and of one past the end)
+        if self._offsets is None:
+            offsets = [0]
+            for count, value in self.runs:
+                offsets.append(offsets[-1] + count)
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return self._run_offsets()[-1]
+
+    def __iter__(self):
+        for count, value in self.runs:
+            for v in repeat(value, count):
+                yield v
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.tolist()[i]
+        offsets = self._run_offsets()
+        if i < 0:
+            i += offsets[-1]
+        if not 0 <= i < offsets[-1]:
+            raise IndexError("RunLengthArray index out of range")
+        return self.runs[bisect_right(offsets, i) - 1][1]
+
+    def __setitem__(self, i, value):
+        offsets = self._run_offsets()
+        if i < 0:
+            i += offsets[-1]
+        if not 0 <= i < offsets[-1]:
+            raise IndexError("RunLengthArray assignment index out of range")
+        n = bisect_right(offsets, i) - 1
+        count, old_value = self.runs[n]
+        if old_value is value:
+            return
+        # split the run into the part before, the new value and the part after
+        before = i - offsets[n]
+        after = count - before - 1
+        new_runs = [[1, value]]
+        if before > 0:
+            new_runs.insert(0, [before, old_value])
+        if after > 0:
+            new_runs.append([after, old_value])
+        self.runs[n:n+1] = new_runs
+        self._offsets = None
+
+    def __eq__(self, other):
+        if isinstance(other, RunLengthArray):
+            return self.runs == other.runs or self.tolist() == other.tolist()
+        try:
+            return len(self) == len(other) and self.tolist() == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.runs)
+
+    def tolist(self):
+        values = []
+        for count, value in self.runs:
+            values.extend([value]*count)
+        return values
+
+    def to_numpy(self):
+        if numpy is None:
+            raise ImportError("numpy is required to convert to a numpy array")
+        return numpy.array(self.tolist())
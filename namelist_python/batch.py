@@ -0,0 +1,117 @@
+"""
+Parsing of many namelist files at once on a pool of worker processes (or
+threads).
+"""
+import os
+import fnmatch
+import multiprocessing
+from collections import namedtuple
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:
+    # python 2 without the `futures` backport, multiprocessing pools are
+    # used instead
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
+from .namelist import read_namelist_file
+
+EXECUTORS = ('process', 'thread')
+
+NamelistResult = namedtuple('NamelistResult', ['path', 'namelist', 'error'])
+
+
+def _read_one(args):
+    path, array_backend = args
+    try:
+        return NamelistResult(path, read_namelist_file(path, array_backend=array_backend), None)
+    except Exception as e:
+        return NamelistResult(path, None, e)
+
+
+def read_namelist_files(paths, workers=None, executor='process', array_backend='list'):
+    """
+    Parses all files in `paths` using `workers` processes (or threads if
+    `executor='thread'`), by default as many as there are CPUs. Returns a
+    list of `NamelistResult(path, namelist, error)` in the same order as
+    `paths`, where a file that failed to parse has `namelist` set to `None`
+    and the exception raised as `error`.
+    """
+    return map_files(_read_one, [(path, array_backend) for path in paths], workers, executor)
+
+
+def map_files(function, args, workers=None, executor='process'):
+    """
+    Calls `function` for each item in `args` on a pool of `workers`
+    processes (or threads), returning the results in the same order
+    """
+    check_executor(executor)
+    args = list(args)
+
+    if workers == 1 or len(args) <= 1:
+        return [function(a) for a in args]
+
+    if workers is None:
+        workers = cpu_count()
+
+    # send files to the worker processes in batches to reduce the overhead
+    # of communicating with them
+    chunksize = max(1, len(args) // (workers*4))
+    return pool_map(function, args, workers, executor, chunksize)
+
+
+def check_executor(executor):
+    if executor not in EXECUTORS:
+        raise ValueError("Executor '%s' not understood, should be one of %s"
+                         % (executor, ", ".join(EXECUTORS)))
+
+
+def cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        # python 2
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+
+def pool_map(function, args, workers, executor='process', chunksize=1):
+    """
+    Calls `function` for each item in `args` on a new pool of `workers`
+    processes (or threads), returning the results in the same order
+    """
+    if ProcessPoolExecutor is None:
+        from multiprocessing.pool import Pool, ThreadPool
+        pool = (Pool if executor == 'process' else ThreadPool)(workers)
+        try:
+            return pool.map(function, args, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    if executor == 'process':
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(function, args, chunksize=chunksize))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(function, args))
+
+
+def find_namelist_files(directory, pattern='*.nml', recursive=False):
+    """
+    Returns the sorted paths of all files in `directory` matching `pattern`
+    """
+    paths = []
+    for root, dirnames, filenames in os.walk(directory):
+        paths += [os.path.join(root, f) for f in fnmatch.filter(filenames, pattern)]
+        if not recursive:
+            break
+    return sorted(paths)
+
+
+def read_namelist_dir(directory, pattern='*.nml', recursive=False, **kwargs):
+    """
+    Parses all files in `directory` matching `pattern` with
+    `read_namelist_files`, to which any other arguments are passed
+    """
+    return read_namelist_files(find_namelist_files(directory, pattern, recursive), **kwargs)
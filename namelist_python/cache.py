@@ -0,0 +1,237 @@
+"""
+Cache of parsed namelist files, so that unchanged files can be loaded
+without parsing them again.
+
+Entries are looked up by the file's path, modification time and size, and
+if these have changed (e.g. the file was touched or copied) by a hash of the
+file content. Only the groups of parsed namelists are kept, encoded as JSON
+by `export.encode_namelist`, both in an in-process LRU and optionally in a
+directory on disk. Every read decodes a new `Namelist` that can be modified
+without affecting the cache. The keys include the version of the encoding,
+so that entries written by another version are never read.
+"""
+import os
+import json
+import mmap
+import hashlib
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+
+from .namelist import Namelist, _read_file
+from .export import FORMAT_VERSION, encode_namelist, decode_namelist
+
+
+class NamelistCache(object):
+    """
+    LRU cache of parsed namelist files holding at most `maxsize` namelists
+    in memory. If `cache_dir` is given parsed namelists are also stored
+    there, so that they can be reused between processes.
+    """
+
+    def __init__(self, maxsize=128, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # content key -> encoded namelist
+        self._entries = OrderedDict()
+        # (path, mtime, size, array_backend, encoding, format version) -> content key
+        self._stat_keys = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def read(self, filename, array_backend='list', use_mmap=False, encoding='utf-8'):
+        """
+        Returns the parsed namelist in `filename`, only parsing the file if
+        it isn't in the cache already. See `read_namelist_file` for
+        `use_mmap` and `encoding`.
+        """
+        stat_key = self._stat_key(filename, array_backend, encoding)
+
+        with self._lock:
+            content_key = self._stat_keys.get(stat_key)
+            data = content_key is not None and self._get(content_key) or None
+        if data is not None:
+            return self._hit(data, array_backend)
+
+        if self.cache_dir is not None:
+            content_key = self._read_disk_file(self._disk_stat_path(stat_key))
+            if content_key is not None:
+                content_key = content_key.decode('ascii')
+                data = self._read_disk_file(self._disk_path(content_key))
+            if data is not None:
+                self._store(stat_key, content_key, data)
+                return self._hit(data, array_backend, disk=True)
+
+        buf = None
+        if use_mmap:
+            with open(filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self._read_content(filename, stat_key, buf, array_backend, encoding)
+        finally:
+            if buf is not None:
+                buf.close()
+
+    def _read_content(self, filename, stat_key, buf, array_backend, encoding):
+        """
+        Looks the file up by its content, which is memory mapped as `buf`
+        or otherwise read, and parses it if it isn't in the cache
+        """
+        if buf is not None:
+            # the raw bytes are hashed, without decoding them
+            input_str = buf
+            content_key = self._content_key(buf, array_backend, encoding)
+        else:
+            input_str = _read_file(filename, encoding)
+            content_key = self._content_key(input_str, array_backend)
+
+        with self._lock:
+            data = self._get(content_key)
+        from_disk = False
+        if data is None and self.cache_dir is not None:
+            data = self._read_disk_file(self._disk_path(content_key))
+            from_disk = data is not None
+        if data is not None:
+            # the file has changed on disk, but the content is the same as
+            # that of a file read before
+            self._store(stat_key, content_key, data)
+            if self.cache_dir is not None:
+                self._write_disk_file(self._disk_stat_path(stat_key), content_key.encode('ascii'))
+            return self._hit(data, array_backend, disk=from_disk)
+
+        namelist = Namelist(input_str, array_backend=array_backend,
+                            encoding=encoding if buf is not None else None)
+        data = json.dumps(encode_namelist(namelist)).encode('utf-8')
+        with self._lock:
+            self.misses += 1
+        self._store(stat_key, content_key, data)
+        if self.cache_dir is not None:
+            self._write_disk_file(self._disk_path(content_key), data)
+            self._write_disk_file(self._disk_stat_path(stat_key), content_key.encode('ascii'))
+
+        return namelist
+
+    def invalidate(self, filename=None):
+        """
+        Removes `filename` from the cache, or everything if no filename is given
+        """
+        with self._lock:
+            if filename is None:
+                stat_keys = list(self._stat_keys.keys())
+            else:
+                path = os.path.abspath(filename)
+                stat_keys = [k for k in self._stat_keys if k[0] == path]
+
+            for stat_key in stat_keys:
+                content_key = self._stat_keys.pop(stat_key)
+                self._entries.pop(content_key, None)
+                if self.cache_dir is not None:
+                    self._remove_disk_file(self._disk_stat_path(stat_key))
+                    self._remove_disk_file(self._disk_path(content_key))
+
+            if filename is None:
+                self._entries.clear()
+                if self.cache_dir is not None:
+                    for cache_file in os.listdir(self.cache_dir):
+                        if cache_file.endswith('.nlcache'):
+                            self._remove_disk_file(os.path.join(self.cache_dir, cache_file))
+
+    def stats(self):
+        """
+        Returns the number of cache hits, misses etc as a dictionary
+        """
+        with self._lock:
+            return dict(hits=self.hits, disk_hits=self.disk_hits,
+                        misses=self.misses, evictions=self.evictions,
+                        size=len(self._entries), maxsize=self.maxsize)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _hit(self, data, array_backend, disk=False):
+        with self._lock:
+            self.hits += 1
+            if disk:
+                self.disk_hits += 1
+        obj = json.loads(data.decode('utf-8'), object_pairs_hook=OrderedDict)
+        return decode_namelist(obj, array_backend)
+
+    def _get(self, content_key):
+        data = self._entries.pop(content_key, None)
+        if data is not None:
+            # move to the end as the most recently used
+            self._entries[content_key] = data
+        return data
+
+    def _store(self, stat_key, content_key, data):
+        with self._lock:
+            self._stat_keys[stat_key] = content_key
+            self._entries.pop(content_key, None)
+            self._entries[content_key] = data
+            while len(self._entries) > self.maxsize:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self.evictions += 1
+                for k in [k for k, v in self._stat_keys.items() if v == evicted_key]:
+                    del self._stat_keys[k]
+
+    @staticmethod
+    def _stat_key(filename, array_backend, encoding):
+        st = os.stat(filename)
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        return (os.path.abspath(filename), mtime, st.st_size, array_backend, encoding, FORMAT_VERSION)
+
+    @staticmethod
+    def _content_key(input_str, array_backend, encoding=None):
+        """
+        Key of the parsed content, decoded text is hashed as utf-8, raw
+        bytes (e.g. a memory mapped file) together with their `encoding`
+        """
+        if encoding is None:
+            if not isinstance(input_str, bytes):
+                input_str = input_str.encode('utf-8')
+            content_hash = hashlib.sha1(input_str)
+            return "%s-%s-v%d" % (content_hash.hexdigest(), array_backend, FORMAT_VERSION)
+        content_hash = hashlib.sha1(input_str)
+        return "%s-%s-%s-v%d" % (content_hash.hexdigest(), encoding, array_backend, FORMAT_VERSION)
+
+    def _disk_path(self, content_key):
+        return os.path.join(self.cache_dir, "%s.nlcache" % content_key)
+
+    def _disk_stat_path(self, stat_key):
+        stat_hash = hashlib.sha1(repr(stat_key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, "stat-%s.nlcache" % stat_hash)
+
+    @staticmethod
+    def _read_disk_file(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        return data
+
+    @staticmethod
+    def _write_disk_file(path, data):
+        # write to a temporary file first so that other processes never
+        # see a partially written cache file
+        tmp_path = "%s.%d-%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+
+    @staticmethod
+    def _remove_disk_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
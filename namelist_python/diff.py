@@ -0,0 +1,165 @@
+"""
+Differences between namelists, and applying them to other namelists and
+files.
+
+A change set is an ordered dict of group name (the key of the group, e.g.
+`station0` for the second `&station` group) to either `None` (the group is
+removed) or an ordered dict of variable name to `Change`. Components of
+derived types are listed as separate variables, e.g. `physics%nccn`. For
+arrays that keep their length only the elements that differ are kept, in
+`Change.indices` (zero-based) with their old and new values.
+"""
+from collections import namedtuple
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+
+from .arrays import numpy, is_numpy_array, is_nd_array, RunLengthArray, SparseArray
+from .document import _flatten_components
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+Change = namedtuple('Change', ['kind', 'old', 'new', 'indices'])
+
+_missing = object()
+
+_array_types = (list, RunLengthArray, SparseArray)
+
+
+def _same(a, b):
+    return type(a) is type(b) and a == b
+
+
+def _changed_elements(old, new):
+    """
+    Returns the indices of the elements that differ between the arrays `old`
+    and `new`, or `None` if they can't be compared element by element
+    """
+    if is_numpy_array(old) or is_numpy_array(new):
+        if not (is_numpy_array(old) and is_numpy_array(new)) or old.shape != new.shape:
+            return None
+        if old.dtype.kind != new.dtype.kind:
+            return None
+        differs = old != new
+        if old.ndim == 1:
+            return numpy.flatnonzero(differs).tolist()
+        return [tuple(i) for i in numpy.argwhere(differs).tolist()]
+
+    if not (isinstance(old, _array_types) and isinstance(new, _array_types)):
+        return None
+    if len(old) != len(new) or is_nd_array(old) or is_nd_array(new):
+        return None
+    return [i for i, (a, b) in enumerate(zip(old, new)) if not _same(a, b)]
+
+
+def _elements(value, indices):
+    if is_numpy_array(value):
+        # picked all at once, and as python values
+        if value.ndim == 1:
+            return value[indices].tolist()
+        return value[tuple(zip(*indices))].tolist()
+    return [value[i] for i in indices]
+
+
+def diff_variables(old_variables, new_variables):
+    """
+    Returns the changes from the variables of one group to another as an
+    ordered dict of variable name to `Change`
+    """
+    old_variables = _flatten_components(old_variables)
+    new_variables = _flatten_components(new_variables)
+
+    changes = OrderedDict()
+    for variable_name, old_value in old_variables.items():
+        new_value = new_variables.get(variable_name, _missing)
+        if new_value is _missing:
+            changes[variable_name] = Change(REMOVED, old_value, None, None)
+            continue
+
+        indices = _changed_elements(old_value, new_value)
+        if indices is None:
+            if not _same(old_value, new_value):
+                changes[variable_name] = Change(CHANGED, old_value, new_value, None)
+        elif indices:
+            changes[variable_name] = Change(CHANGED, _elements(old_value, indices),
+                                            _elements(new_value, indices), indices)
+
+    for variable_name, new_value in new_variables.items():
+        if variable_name not in old_variables:
+            changes[variable_name] = Change(ADDED, None, new_value, None)
+    return changes
+
+
+class ChangeSet(OrderedDict):
+    """
+    Change set returned by `diff_groups`, which also keeps the group names
+    of the added groups that are stored under another key, i.e. further
+    instances of a repeated group, in `group_names`
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.group_names = {}
+        OrderedDict.__init__(self, *args, **kwargs)
+
+
+def added_group_name(changes, key):
+    """
+    Returns the name of the group added under `key` by `changes`, which for
+    plain dicts of changes is the key itself
+    """
+    return getattr(changes, 'group_names', {}).get(key, key)
+
+
+def diff_groups(old_groups, new_groups, group_name=None):
+    """
+    Returns the change set from the groups `old_groups` to `new_groups`,
+    with `group_name(key)` giving the name of a group in `new_groups`
+    """
+    changes = ChangeSet()
+    for key, old_group in old_groups.items():
+        if key not in new_groups:
+            changes[key] = None
+            continue
+        group_changes = diff_variables(old_group, new_groups[key])
+        if group_changes:
+            changes[key] = group_changes
+
+    for key, new_group in new_groups.items():
+        if key not in old_groups:
+            changes[key] = diff_variables({}, new_group)
+            if group_name is not None and group_name(key) != key:
+                changes.group_names[key] = group_name(key)
+    return changes
+
+
+def _set_element(value, index, element):
+    if isinstance(index, tuple) and not is_numpy_array(value):
+        # multi-dimensional array stored as nested lists
+        for i in index[:-1]:
+            value = value[i]
+        index = index[-1]
+    value[index] = element
+
+
+def patch_variables(variables, changes, component):
+    """
+    Applies `changes` to the dict `variables` of a group in place, where
+    `component(variables, variable_name)` returns the dict holding the
+    variable and its name in it. Changes can also be given as plain values,
+    which the variables are set to.
+    """
+    for variable_name, change in changes.items():
+        container, name = component(variables, variable_name)
+        if not isinstance(change, Change):
+            container[name] = change
+        elif change.kind == REMOVED:
+            container.pop(name, None)
+        elif change.indices is not None and name in container:
+            value = container[name]
+            for index, element in zip(change.indices, change.new):
+                _set_element(value, index, element)
+        else:
+            container[name] = change.new
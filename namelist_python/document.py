@@ -0,0 +1,253 @@
+"""
+Layout preserving model of a namelist document.
+
+While parsing, the position of every group and assignment in the original
+text is recorded. When the namelist is written back out the original text is
+copied as is, comments, whitespace and the spelling of values included, and
+only the assignments of variables that have changed since parsing are
+rewritten.
+"""
+import copy
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+
+from .parser import GROUP_START, NAME, INDEX, EQUALS, VALUE, GROUP_END, variable_key, component_path
+from .arrays import numpy, is_numpy_array, is_type_array, SparseArray
+
+
+class AssignmentLayout(object):
+    """
+    Position of a single `name(index) = values` assignment in the text
+    """
+    __slots__ = ('variable_name', 'index', 'start', 'value_start', 'end', 'values')
+
+    def __init__(self, variable_name, start):
+        self.variable_name = variable_name
+        self.index = None
+        self.start = start
+        self.value_start = None
+        self.end = start + len(variable_name)
+        self.values = []
+
+    def is_element(self):
+        """
+        Whether this assigns a single value to a single array element
+        """
+        if self.index is None or len(self.values) != 1:
+            return False
+        value_str = self.values[0]
+        return not (value_str[0].isdigit() and '*' in value_str)
+
+
+class GroupLayout(object):
+    """
+    Position of a '&name ... /' group block and its assignments in the text
+    """
+
+    def __init__(self, start):
+        # name the group is stored under, which may differ from the name in
+        # the text for repeated groups
+        self.key = None
+        self.start = start
+        self.end = None
+        self.slash = None
+        self.assignments = []
+        self.original = None
+
+
+class LayoutRecorder(object):
+    """
+    Passes a token stream through unchanged, recording where each group and
+    assignment is in the text
+    """
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self.groups = []
+
+    def __iter__(self):
+        group = None
+        assignment = None
+        for token in self._tokens:
+            kind = token.kind
+            if kind == VALUE:
+                if not assignment.values:
+                    assignment.value_start = token.offset
+                assignment.values.append(token.text)
+                assignment.end = token.offset + len(token.text)
+            elif kind == NAME:
+                assignment = AssignmentLayout(token.text, token.offset)
+                group.assignments.append(assignment)
+            elif kind == INDEX:
+                assignment.index = token.text
+            elif kind == EQUALS:
+                assignment.end = token.offset + 1
+            elif kind == GROUP_START:
+                group = GroupLayout(token.offset)
+                self.groups.append(group)
+            elif kind == GROUP_END:
+                group.slash = token.offset
+                group.end = token.offset + 1
+            yield token
+
+
+_missing = object()
+
+
+def values_equal(a, b):
+    if is_numpy_array(a) or is_numpy_array(b):
+        return (is_numpy_array(a) and is_numpy_array(b) and a.dtype == b.dtype
+                and numpy.array_equal(a, b))
+    return type(a) is type(b) and a == b
+
+
+def _removal_range(text, start, end):
+    """
+    Range of text to remove for an assignment (or group) at `start:end`,
+    which is the whole line if nothing else is on it
+    """
+    line_start = text.rfind('\n', 0, start) + 1
+    line_end = text.find('\n', end)
+    if line_end < 0:
+        line_end = len(text)
+    after = text[end:line_end].strip()
+    if text[line_start:start].strip() == '' and after in ('', ','):
+        return line_start, min(line_end + 1, len(text))
+    # otherwise only remove the assignment and a comma following it
+    while end < line_end and text[end] in ' \t':
+        end += 1
+    if end < line_end and text[end] == ',':
+        end += 1
+    return start, end
+
+
+def _designator(path):
+    return "%".join([name if index is None else "%s(%d)" % (name, index+1) for name, index in path])
+
+
+def _flatten_components(variables):
+    """
+    Returns the variables with every derived type replaced by its
+    components, named as in an assignment, e.g. `domains(2)%dx`
+    """
+    flat = OrderedDict()
+    for variable_name, variable_value in variables.items():
+        if isinstance(variable_value, dict):
+            for component_name, component_value in _flatten_components(variable_value).items():
+                flat["%s%%%s" % (variable_name, component_name)] = component_value
+        elif is_type_array(variable_value):
+            for n, element in enumerate(variable_value):
+                for component_name, component_value in _flatten_components(element).items():
+                    flat["%s(%d)%%%s" % (variable_name, n+1, component_name)] = component_value
+        else:
+            flat[variable_name] = variable_value
+    return flat
+
+
+class NamelistDocument(object):
+    """
+    Original text of a namelist together with the layout of its groups and
+    the values they had when parsed
+    """
+
+    def __init__(self, text, group_layouts, groups):
+        self.text = text
+        self.groups = group_layouts
+        for layout in self.groups:
+            layout.original = copy.deepcopy(groups[layout.key])
+
+    def render(self, groups, format_value, format_inline, format_variable, format_group):
+        """
+        Yields the pieces of text of the document with `groups` as its
+        content. `format_value(value)` and `format_inline(value)` format a
+        single value and the right hand side of an assignment, while
+        `format_variable(variable_name, value, index_notation)` and
+        `format_group(group_name, group)` format whole assignments and
+        groups for variables and groups that are new or changed.
+        """
+        text = self.text
+        pos = 0
+        for layout in self.groups:
+            if layout.key not in groups:
+                start, end = _removal_range(text, layout.start, layout.end)
+                yield text[pos:start]
+                pos = end
+                continue
+
+            edits = self._group_edits(layout, groups[layout.key], format_value, format_inline, format_variable)
+            for start, end, replacement in sorted(edits, key=lambda e: e[0]):
+                yield text[pos:start]
+                yield replacement
+                pos = end
+        yield text[pos:]
+
+        group_keys = set(layout.key for layout in self.groups)
+        new_groups = [k for k in groups if not k in group_keys]
+        if new_groups and not text.endswith('\n'):
+            yield '\n'
+        for group_name in new_groups:
+            yield format_group(group_name, groups[group_name])
+
+    def _group_edits(self, layout, group, format_value, format_inline, format_variable):
+        text = self.text
+        original = layout.original
+
+        # components of derived types are compared one by one, as if they
+        # were separate variables
+        original = _flatten_components(original)
+        group = _flatten_components(group)
+
+        assignments = {}
+        for assignment in layout.assignments:
+            if '%' in assignment.variable_name:
+                path = component_path(assignment.variable_name, assignment.index)
+                key, index = _designator(path[:-1]) + '%' + path[-1][0], path[-1][1]
+            else:
+                key, index = variable_key(assignment.variable_name, assignment.index)
+            assignments.setdefault(key, []).append((assignment, index))
+
+        edits = []
+        for variable_name, variable_assignments in assignments.items():
+            old_value = original.get(variable_name, _missing)
+            new_value = group.get(variable_name, _missing)
+
+            if new_value is _missing:
+                if old_value is not _missing:
+                    for assignment, index in variable_assignments:
+                        edits.append(_removal_range(text, assignment.start, assignment.end) + ('',))
+                continue
+            if old_value is not _missing and values_equal(new_value, old_value):
+                continue
+
+            index_notation = all(a.is_element() and isinstance(index, int) for a, index in variable_assignments)
+            if (index_notation and old_value is not _missing and
+                    type(new_value) is type(old_value) and len(new_value) == len(old_value)):
+                # only rewrite the elements that have changed
+                for assignment, index in variable_assignments:
+                    if not values_equal(new_value[index], old_value[index]):
+                        edits.append((assignment.value_start, assignment.end, format_value(new_value[index])))
+                continue
+
+            assignment = variable_assignments[0][0]
+            if (not index_notation and assignment.index is None and assignment.values
+                    and not isinstance(new_value, SparseArray)):
+                # keep the variable name and '=' as they were, only replace the value
+                edits.append((assignment.value_start, assignment.end, format_inline(new_value)))
+            else:
+                edits.append((assignment.start, assignment.end,
+                              format_variable(variable_name, new_value, index_notation)))
+            for assignment, index in variable_assignments[1:]:
+                edits.append(_removal_range(text, assignment.start, assignment.end) + ('',))
+
+        new_variables = [v for v in group if not v in assignments]
+        if new_variables:
+            lines = "".join(["  %s\n" % format_variable(v, group[v], False) for v in new_variables])
+            line_start = text.rfind('\n', 0, layout.slash) + 1
+            if text[line_start:layout.slash].strip() == '':
+                edits.append((line_start, line_start, lines))
+            else:
+                edits.append((layout.slash, layout.slash, "\n" + lines))
+
+        return edits
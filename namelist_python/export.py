@@ -0,0 +1,481 @@
+"""
+Export of parsed namelists to JSON, MessagePack and NPZ, and loading them
+back without parsing the Fortran text again.
+
+All formats share the same structure, the list of groups (in order, repeated
+groups included) with the value of each variable. Values that JSON can't
+represent are written as objects with a single key starting with '__',
+which can't be the name of a fortran variable:
+
+    {"__complex__": [1.0, 2.0]}
+    {"__runs__": [[1000, 0.01], [1, 1.0]]}
+    {"__sparse__": {"indices": [0, 99999], "values": [1, 2], "size": 100000, "fill_value": null}}
+    {"__ndarray__": {"dtype": "float64", "shape": [3, 2], "order": "F", "data": [...]}}
+
+MessagePack stores the data of numeric arrays as raw bytes. NPZ stores them
+as separate (uncompressed) `.npy` members, which can be memory mapped when
+loaded, and the structure as JSON.
+
+A directory of namelists can also be converted into a single columnar
+dataset, with a row for each variable of each file:
+
+    python -m namelist_python.export dataset runs/ runs.npz --recursive
+"""
+import sys
+import json
+import struct
+import zipfile
+import argparse
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .namelist import Namelist, read_namelist_file, _string_types, _integer_types
+from .document import _flatten_components
+from .batch import map_files, find_namelist_files
+from .arrays import numpy, is_numpy_array, is_numpy_scalar, is_nd_array, fortran_order, RunLengthArray, SparseArray
+
+FORMAT_VERSION = 1
+
+# lists with at least this many elements of the same numeric (or logical)
+# type are stored natively in the binary formats
+NATIVE_ARRAY_SIZE = 64
+
+_native_types = (bool, int, float, complex)
+
+
+def _native_array(value):
+    """
+    Returns `value` as a numpy array if it is an array of numbers or
+    logicals that can be stored natively, otherwise `None`
+    """
+    if numpy is None:
+        return None
+    if is_numpy_array(value):
+        return value if value.dtype.kind in 'biufc' else None
+    if not isinstance(value, list) or not value:
+        return None
+    flat = fortran_order(value)[1] if is_nd_array(value) else value
+    if len(flat) < NATIVE_ARRAY_SIZE:
+        return None
+    first = type(flat[0])
+    if first not in _native_types or any(type(v) is not first for v in flat):
+        return None
+    return numpy.array(value)
+
+
+def encode_value(value, encode_array=None):
+    """
+    Returns `value` as JSON compatible objects. Arrays that can be stored
+    natively are passed to `encode_array(array)` if given, which returns
+    what to store instead of the array.
+    """
+    if isinstance(value, (bool, float) + _integer_types + _string_types) or value is None:
+        return value
+    elif isinstance(value, complex):
+        return {'__complex__': [value.real, value.imag]}
+    elif is_numpy_scalar(value):
+        return encode_value(value.item())
+    elif isinstance(value, dict):
+        return OrderedDict((k, encode_value(v, encode_array)) for k, v in value.items())
+    elif isinstance(value, RunLengthArray):
+        return {'__runs__': [[count, encode_value(v)] for count, v in value.runs]}
+    elif isinstance(value, SparseArray):
+        return {'__sparse__': OrderedDict([
+            ('indices', value.indices),
+            ('values', [encode_value(v, encode_array) for v in value.values]),
+            ('size', value.size),
+            ('fill_value', encode_value(value.fill_value)),
+        ])}
+
+    if encode_array is not None:
+        array = _native_array(value)
+        if array is not None:
+            return encode_array(array)
+    if is_numpy_array(value):
+        return {'__ndarray__': OrderedDict([
+            ('dtype', value.dtype.str),
+            ('shape', list(value.shape)),
+            ('order', 'F' if value.ndim > 1 and value.flags.f_contiguous else 'C'),
+            ('data', [encode_value(v) for v in value.ravel(order='K').tolist()]),
+        ])}
+    elif isinstance(value, list):
+        return [encode_value(v, encode_array) for v in value]
+    raise TypeError("Variable type not understood: %s" % type(value))
+
+
+def _array_from_spec(spec, array_backend):
+    data = spec['data']
+    dtype = numpy.dtype(spec['dtype'])
+    if isinstance(data, bytes):
+        array = numpy.frombuffer(data, dtype=dtype).copy()
+    else:
+        array = numpy.array([decode_value(v, array_backend) for v in data], dtype=dtype)
+    return array.reshape(spec['shape'], order=spec.get('order', 'C'))
+
+
+def decode_value(obj, array_backend='list', decode_array=None):
+    """
+    Returns the value encoded by `encode_value`, with arrays stored natively
+    decoded by `decode_array(spec)`
+    """
+    if isinstance(obj, list):
+        return [decode_value(v, array_backend, decode_array) for v in obj]
+    elif not isinstance(obj, dict):
+        return obj
+    if len(obj) == 1:
+        key, spec = next(iter(obj.items()))
+        if key == '__complex__':
+            return complex(*spec)
+        elif key == '__runs__':
+            return RunLengthArray([(count, decode_value(v)) for count, v in spec])
+        elif key == '__sparse__':
+            return SparseArray(spec['indices'], [decode_value(v, array_backend, decode_array) for v in spec['values']],
+                               spec['size'], decode_value(spec['fill_value']))
+        elif key == '__ndarray__':
+            if 'data' in spec:
+                array = _array_from_spec(spec, array_backend)
+            else:
+                array = decode_array(spec)
+            return array if array_backend == 'numpy' else array.tolist()
+    return OrderedDict((k, decode_value(v, array_backend, decode_array)) for k, v in obj.items())
+
+
+def encode_namelist(namelist, encode_array=None):
+    """
+    Returns the content of `namelist` as JSON compatible objects
+    """
+    return OrderedDict([
+        ('version', FORMAT_VERSION),
+        ('groups', [[namelist.group_name(key), encode_value(group, encode_array)]
+                    for key, group in namelist.groups.items()]),
+    ])
+
+
+def decode_namelist(obj, array_backend='list', decode_array=None):
+    """
+    Returns the `Namelist` encoded by `encode_namelist`
+    """
+    if obj.get('version') != FORMAT_VERSION:
+        raise ValueError("Exported namelist version %r not understood" % obj.get('version'))
+    namelist = Namelist('', array_backend=array_backend)
+    for group_name, group in obj['groups']:
+        namelist.add_group(group_name, decode_value(group, array_backend, decode_array))
+    return namelist
+
+
+def to_json(namelist, indent=None):
+    return json.dumps(encode_namelist(namelist), indent=indent)
+
+
+def from_json(text, array_backend='list'):
+    return decode_namelist(json.loads(text, object_pairs_hook=OrderedDict), array_backend)
+
+
+def _check_msgpack():
+    if msgpack is None:
+        raise ImportError("The msgpack package is needed to export namelists to MessagePack")
+
+
+def _encode_bytes(array):
+    order = 'F' if array.ndim > 1 and array.flags.f_contiguous else 'C'
+    return {'__ndarray__': OrderedDict([
+        ('dtype', array.dtype.str),
+        ('shape', list(array.shape)),
+        ('order', order),
+        ('data', array.tobytes(order=order)),
+    ])}
+
+
+def to_msgpack(namelist):
+    _check_msgpack()
+    return msgpack.packb(encode_namelist(namelist, _encode_bytes), use_bin_type=True)
+
+
+def from_msgpack(data, array_backend='list'):
+    _check_msgpack()
+    return decode_namelist(msgpack.unpackb(data, raw=False, object_pairs_hook=OrderedDict), array_backend)
+
+
+def _check_numpy():
+    if numpy is None:
+        raise ImportError("numpy is needed to export namelists to NPZ")
+
+
+def save_npz(namelist, filename):
+    """
+    Writes `namelist` to the NPZ file `filename`, with large numeric arrays
+    stored as `.npy` members and the rest as JSON in the member `namelist`
+    """
+    _check_numpy()
+    arrays = OrderedDict()
+
+    def encode_array(array):
+        name = 'a%d' % len(arrays)
+        arrays[name] = array
+        return {'__ndarray__': {'npy': name}}
+
+    structure = json.dumps(encode_namelist(namelist, encode_array))
+    numpy.savez(filename, namelist=numpy.array(structure), **arrays)
+
+
+def _mmap_member(filename, zf, name):
+    """
+    Memory maps the array in the member `name` of an NPZ file, returns
+    `None` if it is compressed
+    """
+    info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(filename, 'rb') as f:
+        # the data follows the local file header, which is 30 bytes plus the
+        # file name and extra field
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+        if dtype.hasobject:
+            return None
+        offset = f.tell()
+    # copy on write, changing the array doesn't change the file
+    return numpy.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape,
+                        order='F' if fortran_order else 'C')
+
+
+def load_npz(filename, array_backend='list', mmap=False):
+    """
+    Loads a namelist written by `save_npz`. With `mmap=True` (and the numpy
+    backend) the large arrays are memory mapped from the file rather than
+    read into memory.
+    """
+    _check_numpy()
+    with numpy.load(filename, allow_pickle=False) as npz:
+        structure = json.loads(npz['namelist'].item(), object_pairs_hook=OrderedDict)
+        if mmap:
+            zf = zipfile.ZipFile(filename)
+        try:
+            def decode_array(spec):
+                array = None
+                if mmap:
+                    array = _mmap_member(filename, zf, spec['npy'])
+                if array is None:
+                    array = npz[spec['npy']]
+                return array
+            return decode_namelist(structure, array_backend, decode_array)
+        finally:
+            if mmap:
+                zf.close()
+
+
+# columns of a dataset, `number` holds scalar numbers and logicals and
+# `text` strings, the shape of multi-dimensional arrays and the JSON of
+# values that aren't numbers, logicals, strings or numeric arrays. The
+# elements of numeric arrays are stored in `values` (in fortran order),
+# starting at `offset`, with `length` elements.
+DATASET_COLUMNS = ('path', 'group', 'occurrence', 'variable', 'kind', 'number', 'text', 'offset', 'length')
+
+
+def _row(value):
+    """
+    Returns `(kind, number, text, array)` for the value of a variable
+    """
+    if is_numpy_scalar(value):
+        value = value.item()
+    if isinstance(value, bool):
+        return 'logical', float(value), '', None
+    elif isinstance(value, _integer_types):
+        return 'integer', float(value), '', None
+    elif isinstance(value, float):
+        return 'real', value, '', None
+    elif isinstance(value, _string_types):
+        return 'character', float('nan'), value, None
+
+    if isinstance(value, RunLengthArray) and None not in [v for _, v in value.runs]:
+        value = value.tolist()
+    if numpy is not None and (isinstance(value, list) or is_numpy_array(value)):
+        if is_numpy_array(value):
+            shape, flat = value.shape, value.ravel(order='F')
+        elif is_nd_array(value):
+            shape, flat = fortran_order(value)
+        else:
+            shape, flat = (len(value),), value
+        array = numpy.asarray(flat)
+        if len(array) and array.dtype.kind in 'biuf':
+            text = json.dumps(list(shape)) if len(shape) > 1 else ''
+            return 'array', float('nan'), text, array.astype(numpy.float64)
+    return 'json', float('nan'), json.dumps(encode_value(value)), None
+
+
+def _dataset_rows(path):
+    """
+    Parses a single file, returning its rows `(group, occurrence, variable,
+    kind, number, text, array)` and the error if it failed to parse
+    """
+    try:
+        namelist = read_namelist_file(path)
+    except Exception as e:
+        return path, [], "%s: %s" % (type(e).__name__, e)
+
+    rows = []
+    occurrences = {}
+    for key, group in namelist.groups.items():
+        group_name = namelist.group_name(key)
+        occurrence = occurrences[group_name] = occurrences.get(group_name, -1) + 1
+        for variable_name, value in _flatten_components(group).items():
+            rows.append((group_name, occurrence, variable_name) + _row(value))
+    return path, rows, None
+
+
+def make_dataset(paths, workers=None, executor='process'):
+    """
+    Parses the files in `paths` on `workers` processes (or threads) into a
+    columnar dataset, an ordered dict of column name to numpy array with
+    the columns in `DATASET_COLUMNS` and `values`. Returns the dataset and
+    a list of `(path, error)` for the files that failed to parse.
+    """
+    _check_numpy()
+    columns = OrderedDict((name, []) for name in DATASET_COLUMNS)
+    arrays = []
+    offset = 0
+    errors = []
+    for path, rows, error in map_files(_dataset_rows, paths, workers, executor):
+        if error is not None:
+            errors.append((path, error))
+        for group_name, occurrence, variable_name, kind, number, text, array in rows:
+            for name, value in zip(DATASET_COLUMNS, (path, group_name, occurrence, variable_name, kind,
+                                                     number, text)):
+                columns[name].append(value)
+            if array is None:
+                columns['offset'].append(-1)
+                columns['length'].append(0)
+            else:
+                columns['offset'].append(offset)
+                columns['length'].append(len(array))
+                arrays.append(array)
+                offset += len(array)
+
+    dataset = OrderedDict()
+    for name, values in columns.items():
+        if name in ('occurrence', 'offset', 'length'):
+            dataset[name] = numpy.array(values, dtype=numpy.int64)
+        elif name == 'number':
+            dataset[name] = numpy.array(values, dtype=numpy.float64)
+        else:
+            dataset[name] = numpy.array(values, dtype=str)
+    dataset['values'] = numpy.concatenate(arrays) if arrays else numpy.zeros(0)
+    return dataset, errors
+
+
+def save_dataset(dataset, filename):
+    """
+    Writes a dataset made by `make_dataset` to `filename`, as Parquet if it
+    ends in `.parquet` (with the elements of arrays as a list column) and
+    otherwise as NPZ
+    """
+    if not filename.endswith('.parquet'):
+        numpy.savez(filename, **dataset)
+        return
+    if pyarrow is None:
+        raise ImportError("The pyarrow package is needed to write Parquet files")
+    columns = OrderedDict((name, dataset[name]) for name in DATASET_COLUMNS if name != 'offset')
+    values, offsets, lengths = dataset['values'], dataset['offset'], dataset['length']
+    columns['values'] = [values[o:o+n] if o >= 0 else None for o, n in zip(offsets, lengths)]
+    pyarrow.parquet.write_table(pyarrow.table(columns), filename)
+
+
+def load_dataset(filename, mmap=False):
+    """
+    Loads a dataset written by `save_dataset`. With `mmap=True` the columns
+    of an NPZ dataset are memory mapped.
+    """
+    _check_numpy()
+    if filename.endswith('.parquet'):
+        if pyarrow is None:
+            raise ImportError("The pyarrow package is needed to read Parquet files")
+        table = pyarrow.parquet.read_table(filename).to_pydict()
+        lists = table.pop('values')
+        dataset = OrderedDict((name, numpy.array(table[name])) for name in DATASET_COLUMNS if name in table)
+        dataset['offset'] = numpy.cumsum([0] + [len(v or ()) for v in lists])[:-1]
+        dataset['offset'][[v is None for v in lists]] = -1
+        dataset['values'] = numpy.array([x for v in lists if v for x in v], dtype=numpy.float64)
+        return dataset
+
+    with numpy.load(filename, allow_pickle=False) as npz:
+        names = list(npz.files)
+        if not mmap:
+            return OrderedDict((name, npz[name]) for name in names)
+        with zipfile.ZipFile(filename) as zf:
+            dataset = OrderedDict()
+            for name in names:
+                array = _mmap_member(filename, zf, name)
+                dataset[name] = npz[name] if array is None else array
+            return dataset
+
+
+def convert_dir(directory, filename, pattern='*.nml', recursive=False, workers=None, executor='process'):
+    """
+    Converts all files in `directory` matching `pattern` into a single
+    dataset written to `filename` (see `save_dataset`), returns the list of
+    `(path, error)` for the files that failed to parse
+    """
+    dataset, errors = make_dataset(find_namelist_files(directory, pattern, recursive), workers, executor)
+    save_dataset(dataset, filename)
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Converts namelists into other formats")
+    subparsers = parser.add_subparsers(dest='command')
+
+    dataset_parser = subparsers.add_parser('dataset', help="convert a directory of namelists into a dataset")
+    dataset_parser.add_argument('directory')
+    dataset_parser.add_argument('output', help="NPZ file, or Parquet file if it ends in .parquet")
+    dataset_parser.add_argument('--pattern', default='*.nml')
+    dataset_parser.add_argument('--recursive', action='store_true')
+    dataset_parser.add_argument('--workers', type=int, default=None)
+
+    convert_parser = subparsers.add_parser('convert', help="convert a single namelist")
+    convert_parser.add_argument('input')
+    convert_parser.add_argument('output', help="file ending in .json, .msgpack or .npz")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    if args.command == 'dataset':
+        for path, error in convert_dir(args.directory, args.output, args.pattern, args.recursive, args.workers):
+            print("%s: %s" % (path, error))
+        return 0
+
+    namelist = read_namelist_file(args.input)
+    if args.output.endswith('.json'):
+        with open(args.output, 'w') as f:
+            f.write(to_json(namelist, indent=1))
+    elif args.output.endswith('.msgpack'):
+        with open(args.output, 'wb') as f:
+            f.write(to_msgpack(namelist))
+    elif args.output.endswith('.npz'):
+        save_npz(namelist, args.output)
+    else:
+        parser.error("the output format isn't understood from '%s'" % args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+Searchable index of the variables in many namelist files.
+
+Every file found is parsed once and the value of each variable is stored in
+an SQLite database, scalars as they are and arrays as their length and the
+smallest and largest element. Repeated groups are stored under their name,
+with the occurrence (0 for the first group of a name, 1 for the second and so
+on) in a column of their own. Files are only parsed again when their
+modification time or size has changed. The index can then be queried for
+files in which a variable exists, equals a value or lies in a range:
+
+    python -m namelist_python.index update archive.sqlite runs/ --recursive
+    python -m namelist_python.index query archive.sqlite "ATHAM_SETUP.dt<5"
+"""
+import os
+import re
+import sys
+import sqlite3
+import argparse
+
+from .namelist import read_namelist_file
+from .document import _flatten_components
+from .batch import map_files, find_namelist_files
+from .arrays import is_numpy_array, is_numpy_scalar, is_nd_array, fortran_order
+from .values import parse_value, NoSingleValueFoundException
+
+# version of the tables below, an index written with another version is
+# dropped and built again
+SCHEMA_VERSION = 2
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    -- nanoseconds, or seconds where python doesn't give nanoseconds
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS variables (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    group_name TEXT NOT NULL,
+    occurrence INTEGER NOT NULL,
+    variable TEXT NOT NULL,
+    -- 'integer', 'real', 'logical', 'character', 'complex' or 'array'
+    kind TEXT NOT NULL,
+    -- numbers and logicals are stored in `lo` and `hi`, which for arrays
+    -- are the smallest and largest element
+    lo REAL,
+    hi REAL,
+    text TEXT,
+    length INTEGER
+);
+CREATE INDEX IF NOT EXISTS variables_value ON variables (group_name, variable, lo, hi);
+CREATE INDEX IF NOT EXISTS variables_text ON variables (group_name, variable, text);
+CREATE INDEX IF NOT EXISTS variables_file ON variables (file_id);
+"""
+
+# condition operators and the SQL they translate to for numbers, `?` is the
+# value compared against
+_number_conditions = {
+    '==': "lo = ? AND hi = ?",
+    '!=': "NOT (lo = ? AND hi = ?)",
+    '<': "hi < ?",
+    '<=': "hi <= ?",
+    '>': "lo > ?",
+    '>=': "lo >= ?",
+}
+
+OPERATORS = ('==', '!=', '<', '<=', '>', '>=')
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'logical'
+    elif isinstance(value, int):
+        return 'integer'
+    elif isinstance(value, float):
+        return 'real'
+    elif isinstance(value, complex):
+        return 'complex'
+    return 'character'
+
+
+def _summarise(value):
+    """
+    Returns `(kind, lo, hi, text, length)` for the value of a variable
+    """
+    if is_numpy_scalar(value):
+        value = value.item()
+    if isinstance(value, list) or hasattr(value, 'tolist'):
+        if is_nd_array(value):
+            value = fortran_order(value)[1]
+        values = value.tolist() if is_numpy_array(value) else list(value)
+        numbers = [float(v) for v in values
+                   if isinstance(v, (int, float)) and not isinstance(v, complex)]
+        if numbers:
+            return 'array', min(numbers), max(numbers), None, len(values)
+        return 'array', None, None, None, len(values)
+
+    kind = _kind(value)
+    if kind == 'complex':
+        return kind, None, None, repr(value), None
+    elif kind == 'character':
+        return kind, None, None, value, None
+    return kind, float(value), float(value), None, None
+
+
+def _mtime(stat):
+    # a float modification time can miss a change made shortly after the
+    # last one
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+
+def _index_one(path):
+    """
+    Parses a single file, returning `(path, mtime, size, rows, error)` with
+    a row `(group_name, occurrence, variable, kind, lo, hi, text, length)`
+    for each variable
+    """
+    stat = os.stat(path)
+    try:
+        namelist = read_namelist_file(path)
+    except Exception as e:
+        return path, _mtime(stat), stat.st_size, [], "%s: %s" % (type(e).__name__, e)
+
+    rows = []
+    occurrences = {}
+    for key, group in namelist.groups.items():
+        group_name = namelist.group_name(key)
+        occurrence = occurrences[group_name] = occurrences.get(group_name, -1) + 1
+        for variable_name, value in _flatten_components(group).items():
+            rows.append((group_name, occurrence, variable_name) + _summarise(value))
+    return path, _mtime(stat), stat.st_size, rows, None
+
+
+class NamelistIndex(object):
+    """
+    Index of the namelist files under one or more directories, stored in the
+    SQLite database `db_path`
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            with self._db:
+                self._db.execute("DROP TABLE IF EXISTS variables")
+                self._db.execute("DROP TABLE IF EXISTS files")
+        self._db.executescript(_schema)
+        self._db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, directory, pattern='*.nml', recursive=True, workers=None, executor='process'):
+        """
+        Indexes the files in `directory` matching `pattern`, parsing them on
+        `workers` processes. Only files that are new or whose modification
+        time or size has changed are parsed, and files that no longer exist
+        are removed from the index. Returns the number of files (re)indexed
+        and removed.
+        """
+        paths = [os.path.abspath(p) for p in find_namelist_files(directory, pattern, recursive)]
+
+        indexed = {}
+        prefix = os.path.join(os.path.abspath(directory), '')
+        for file_id, path, mtime, size in self._db.execute(
+                "SELECT id, path, mtime, size FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)):
+            indexed[path] = (file_id, mtime, size)
+
+        changed = []
+        for path in paths:
+            known = indexed.pop(path, None)
+            if known is not None:
+                stat = os.stat(path)
+                if (_mtime(stat), stat.st_size) == known[1:]:
+                    continue
+            changed.append(path)
+
+        if not recursive:
+            # files in subdirectories weren't looked for
+            for path in [p for p in indexed if os.path.dirname(p) != os.path.dirname(prefix)]:
+                del indexed[path]
+
+        with self._db:
+            self._db.executemany("DELETE FROM files WHERE id = ?", [(v[0],) for v in indexed.values()])
+            for path, mtime, size, rows, error in map_files(_index_one, changed, workers, executor):
+                self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+                file_id = self._db.execute("INSERT INTO files (path, mtime, size, error) VALUES (?, ?, ?, ?)",
+                                           (path, mtime, size, error)).lastrowid
+                self._db.executemany("INSERT INTO variables VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     [(file_id,) + row for row in rows])
+        return len(changed), len(indexed)
+
+    def query(self, *conditions):
+        """
+        Returns the sorted paths of the files matching all `conditions`, each
+        a tuple `(group_name, variable)` for files in which the variable is
+        set, or `(group_name, variable, operator, value)` with `operator` one
+        of '==', '!=', '<', '<=', '>' and '>='. For arrays the comparisons
+        apply to all elements, e.g. `('ATHAM_SETUP', 'dt', '<', 5)` matches
+        if every element is smaller than 5. With repeated groups a condition
+        matches if it holds for any of the groups of that name.
+        """
+        sql = ["SELECT path FROM files WHERE error IS NULL"]
+        params = []
+        for condition in conditions:
+            where, condition_params = self._condition(*condition)
+            sql.append("AND id IN (SELECT file_id FROM variables WHERE group_name = ? AND variable = ?%s)" % where)
+            params += [condition[0], condition[1]] + condition_params
+        sql.append("ORDER BY path")
+        return [path for path, in self._db.execute(" ".join(sql), params)]
+
+    def _condition(self, group_name, variable, operator=None, value=None):
+        if operator is None:
+            return "", []
+        if operator not in OPERATORS:
+            raise ValueError("Operator '%s' not understood, should be one of %s" % (operator, ", ".join(OPERATORS)))
+        if isinstance(value, (int, float)) and not isinstance(value, complex):
+            where = _number_conditions[operator]
+            return " AND " + where, [float(value)]*where.count('?')
+
+        if isinstance(value, complex):
+            value = repr(value)
+        if operator == '==':
+            return " AND text = ?", [value]
+        elif operator == '!=':
+            return " AND (text IS NULL OR text != ?)", [value]
+        raise ValueError("Only numbers can be compared with '%s'" % operator)
+
+    def errors(self):
+        """
+        Returns `(path, error)` for the files that failed to parse
+        """
+        return list(self._db.execute("SELECT path, error FROM files WHERE error IS NOT NULL ORDER BY path"))
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+_condition_re = re.compile(r'^\s*(\w+)\s*[.%]\s*([^=<>!\s]+)\s*(?:(==|!=|<=|>=|<|>|=)\s*(.+?))?\s*$')
+
+
+def parse_condition(condition):
+    """
+    Parses a condition written as e.g. `GROUP.dt<5`, `GROUP.scheme='kessler'`
+    or `GROUP.dt` (the variable is set) into a tuple for `NamelistIndex.query`
+    """
+    m = _condition_re.match(condition)
+    if m is None:
+        raise ValueError("Condition '%s' not understood" % condition)
+    group_name, variable, operator, value_str = m.groups()
+    if operator is None:
+        return group_name, variable
+    try:
+        value = parse_value(value_str)
+    except NoSingleValueFoundException:
+        value = value_str
+    return group_name, variable, '==' if operator == '=' else operator, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    update_parser = subparsers.add_parser('update', help="index new and changed files")
+    update_parser.add_argument('db')
+    update_parser.add_argument('directory')
+    update_parser.add_argument('--pattern', default='*.nml')
+    update_parser.add_argument('--recursive', action='store_true')
+    update_parser.add_argument('--workers', type=int, default=None)
+
+    query_parser = subparsers.add_parser('query', help="print the files matching all conditions")
+    query_parser.add_argument('db')
+    query_parser.add_argument('conditions', nargs='+', help="e.g. \"GROUP.dt<5\" or GROUP.dt")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    with NamelistIndex(args.db) as index:
+        if args.command == 'update':
+            n_indexed, n_removed = index.update(args.directory, args.pattern, args.recursive, args.workers)
+            print("%d files indexed, %d removed" % (n_indexed, n_removed))
+            for path, error in index.errors():
+                print("%s: %s" % (path, error))
+        else:
+            try:
+                conditions = [parse_condition(c) for c in args.conditions]
+            except ValueError as e:
+                parser.error(str(e))
+            for path in index.query(*conditions):
+                print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,452 @@
+"""
+Namelists made up of a stack of layers, e.g. a large base namelist with
+site defaults, experiment overrides and per-member perturbations on top.
+
+Variables are looked up from the top layer down and all changes are made to
+the top layer only, so many members can share the same parsed base. Arrays
+and derived types read from the layers below are given through a view that
+copies them to the top layer when they are first changed.
+"""
+import copy
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from .namelist import Namelist, AttributeMapper
+from .paths import compile_path
+from .arrays import numpy, is_numpy_array, RunLengthArray, SparseArray
+
+_missing = object()
+
+# methods that change arrays in place
+_mutating_methods = frozenset([
+    'append', 'extend', 'insert', 'pop', 'remove', 'sort', 'reverse', 'clear',
+    'fill', 'put', 'resize', 'itemset', 'setfield', 'setflags', 'byteswap',
+])
+
+
+def _is_mutable(value):
+    return isinstance(value, (dict, list, RunLengthArray, SparseArray)) or is_numpy_array(value)
+
+
+def _read_only(value, base):
+    # numpy arrays that (may) share memory with a value in a layer below
+    # can't be written to
+    if is_numpy_array(value) and is_numpy_array(base) and numpy.may_share_memory(value, base):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+def _shared(group, variable_name, keys, value):
+    if isinstance(value, dict):
+        return SharedMapping(group, variable_name, keys, value)
+    return SharedArray(group, variable_name, keys, value)
+
+
+class _Shared(object):
+    """
+    A (part of a) variable in a layer below the top one. Reading goes
+    straight to the value in that layer, the first change copies the whole
+    variable to the top layer and is then made to the copy.
+    """
+    __slots__ = ('_group', '_variable_name', '_keys', '_value')
+
+    def __init__(self, group, variable_name, keys, value):
+        self._group = group
+        self._variable_name = variable_name
+        # keys leading from the variable to this part of it
+        self._keys = keys
+        self._value = value
+
+    def _writable(self):
+        value = self._group._copy_up(self._variable_name)
+        for key in self._keys:
+            value = value[key]
+        return value
+
+    def _child(self, key, item):
+        if isinstance(key, slice):
+            if is_numpy_array(item):
+                return _read_only(item, self._value)
+            # slices of lists are new lists, but not their elements
+            return copy.deepcopy(item)
+        if _is_mutable(item):
+            return _shared(self._group, self._variable_name, self._keys + (key,), item)
+        return item
+
+    def __getitem__(self, key):
+        return self._child(key, self._value[key])
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+
+    def __len__(self):
+        return len(self._value)
+
+    def __eq__(self, other):
+        if isinstance(other, _Shared):
+            other = other._value
+        return self._value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._value)
+
+    def __copy__(self):
+        return copy.copy(self._value)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._value, memo)
+
+    def __reduce__(self):
+        # pickled as a copy of the value
+        return (copy.deepcopy, (self._value,))
+
+
+class SharedArray(_Shared):
+    """
+    View of an array (a list, numpy array, `RunLengthArray` or
+    `SparseArray`) in a layer below the top one, see `_Shared`. Other
+    attributes are those of the array, numpy arrays sharing its memory are
+    read only.
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        for i, item in enumerate(self._value):
+            yield self._child(i, item)
+
+    def __contains__(self, item):
+        return item in self._value
+
+    def __array__(self, dtype=None):
+        return _read_only(numpy.asarray(self._value, dtype=dtype), self._value)
+
+    def __getattr__(self, attr):
+        if attr in _Shared.__slots__:
+            raise AttributeError(attr)
+        if attr in _mutating_methods:
+            return getattr(self._writable(), attr)
+        return _read_only(getattr(self._value, attr), self._value)
+
+
+def _operator(name):
+    def operator(self, *args):
+        method = getattr(self._value, name, None)
+        if method is None:
+            return NotImplemented
+        return method(*[a._value if isinstance(a, _Shared) else a for a in args])
+    operator.__name__ = name
+    return operator
+
+
+def _in_place_operator(name):
+    def operator(self, other):
+        # the changed copy in the top layer takes the place of the view
+        value = self._writable()
+        return getattr(value, name)(other)
+    operator.__name__ = name
+    return operator
+
+
+# arithmetic and comparisons give new values, in place operators change the
+# copy in the top layer
+for _name in ('add', 'sub', 'mul', 'truediv', 'div', 'floordiv', 'mod', 'pow'):
+    setattr(SharedArray, '__%s__' % _name, _operator('__%s__' % _name))
+    setattr(SharedArray, '__r%s__' % _name, _operator('__r%s__' % _name))
+    setattr(SharedArray, '__i%s__' % _name, _in_place_operator('__i%s__' % _name))
+for _name in ('neg', 'pos', 'abs', 'lt', 'le', 'gt', 'ge'):
+    setattr(SharedArray, '__%s__' % _name, _operator('__%s__' % _name))
+
+
+class SharedMapping(_Shared, MutableMapping):
+    """
+    View of a derived type in a layer below the top one (or merged from
+    several layers), see `_Shared`
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def __contains__(self, key):
+        return key in self._value
+
+    __eq__ = _Shared.__eq__
+    __ne__ = _Shared.__ne__
+    __hash__ = None
+
+
+def _merge(values):
+    """
+    Merges the derived types `values`, given from the bottom layer up, into a
+    new dict
+    """
+    merged = OrderedDict()
+    for value in values:
+        for component_name, component_value in value.items():
+            below = merged.get(component_name)
+            if isinstance(component_value, dict) and isinstance(below, dict):
+                component_value = _merge([below, component_value])
+            merged[component_name] = component_value
+    return merged
+
+
+class LayeredGroup(MutableMapping):
+    """
+    View of a single group through all layers of a `LayeredNamelist`.
+    Values read with `group[name]` or `get` that could be changed in place
+    (arrays and derived types) are given as a `SharedArray` or
+    `SharedMapping` if they are in a layer below the top one, which copies
+    them to the top layer when they are first changed, so that the layers
+    below are never changed. `items()` and `values()` give the values in
+    the layers as they are.
+    """
+
+    def __init__(self, layered, group_name):
+        self._layered = layered
+        self.group_name = group_name
+
+    def _groups(self):
+        # the group in each layer it can be seen in, from the bottom up
+        return self._layered._visible_groups(self.group_name)
+
+    def _lookup(self, variable_name):
+        floor = self._layered._variable_floors.get(self.group_name, {}).get(variable_name, 0)
+        values = []
+        for n, group in self._groups():
+            if n >= floor and variable_name in group:
+                values.append((n, group[variable_name]))
+        if not values:
+            return _missing, None
+        n, value = values[-1]
+        if isinstance(value, dict):
+            # components of derived types can be set in different layers
+            dicts = [v for _, v in values if isinstance(v, dict)]
+            if len(dicts) > 1:
+                return _merge(dicts), None
+        return value, n
+
+    def __getitem__(self, variable_name):
+        value, n = self._lookup(variable_name)
+        if value is _missing:
+            raise KeyError(variable_name)
+        if n != self._layered._top and _is_mutable(value):
+            # copied to the top layer when it is changed
+            return _shared(self, variable_name, (), value)
+        return value
+
+    def __contains__(self, variable_name):
+        return self._lookup(variable_name)[0] is not _missing
+
+    def get(self, variable_name, default=None):
+        try:
+            return self[variable_name]
+        except KeyError:
+            return default
+
+    def _copy_up(self, variable_name):
+        """
+        Returns the value of a variable in the top layer, copying it there
+        from the layers below if it isn't there yet
+        """
+        value, n = self._lookup(variable_name)
+        if value is _missing:
+            raise KeyError(variable_name)
+        if n != self._layered._top:
+            value = copy.deepcopy(value)
+            self._top_group()[variable_name] = value
+        return value
+
+    def _top_group(self):
+        top = self._layered.layers[-1].groups
+        if self.group_name not in top:
+            top[self.group_name] = OrderedDict()
+        return top[self.group_name]
+
+    def __setitem__(self, variable_name, value):
+        self._top_group()[variable_name] = value
+
+    def __delitem__(self, variable_name):
+        if self._lookup(variable_name)[0] is _missing:
+            raise KeyError(variable_name)
+        self._top_group().pop(variable_name, None)
+        # hide the variable in the layers below
+        self._layered._variable_floors.setdefault(self.group_name, {})[variable_name] = self._layered._top
+
+    def __iter__(self):
+        for variable_name, _ in self._items():
+            yield variable_name
+
+    def _items(self):
+        seen = set()
+        for n, group in self._groups():
+            for variable_name in group:
+                if variable_name not in seen:
+                    seen.add(variable_name)
+                    value = self._lookup(variable_name)[0]
+                    if value is not _missing:
+                        yield variable_name, value
+
+    def items(self):
+        return list(self._items())
+
+    def values(self):
+        return [value for _, value in self._items()]
+
+    def __len__(self):
+        return sum(1 for _ in self._items())
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, OrderedDict(self._items()))
+
+
+class LayeredGroups(MutableMapping):
+    """
+    Mapping of group names to `LayeredGroup` views
+    """
+
+    def __init__(self, layered):
+        self._layered = layered
+        self._views = {}
+
+    def __getitem__(self, group_name):
+        if not self._layered._visible_groups(group_name):
+            raise KeyError(group_name)
+        view = self._views.get(group_name)
+        if view is None:
+            view = self._views[group_name] = LayeredGroup(self._layered, group_name)
+        return view
+
+    def __setitem__(self, group_name, group):
+        # replaces the group in all layers
+        self._layered._hide_group(group_name)
+        self._layered.layers[-1].groups[group_name] = OrderedDict(group)
+
+    def __delitem__(self, group_name):
+        if not self._layered._visible_groups(group_name):
+            raise KeyError(group_name)
+        self._layered._hide_group(group_name)
+
+    def __iter__(self):
+        seen = set()
+        for layer in self._layered.layers:
+            for group_name in layer.groups:
+                if group_name not in seen:
+                    seen.add(group_name)
+                    if self._layered._visible_groups(group_name):
+                        yield group_name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class LayeredNamelist(object):
+    """
+    Stack of `Namelist` layers, given from the bottom (e.g. the base
+    namelist) up. Variables are read from the highest layer they are set in,
+    and setting or deleting variables only changes the top layer.
+    """
+
+    def __init__(self, *layers):
+        if not layers:
+            raise ValueError("A LayeredNamelist needs at least one layer")
+        self.layers = list(layers)
+        self._top = len(self.layers) - 1
+        # groups and variables that have been deleted are hidden in the
+        # layers below the one given here
+        self._group_floors = {}
+        self._variable_floors = {}
+        self.groups = LayeredGroups(self)
+        self._data = None
+
+    def new_child(self, layer=None):
+        """
+        Returns a new `LayeredNamelist` with `layer` (by default an empty
+        namelist) on top of the layers of this one, which are shared
+        """
+        if layer is None:
+            layer = Namelist('')
+        child = LayeredNamelist(*(self.layers + [layer]))
+        child._group_floors = dict(self._group_floors)
+        child._variable_floors = dict((g, dict(v)) for g, v in self._variable_floors.items())
+        return child
+
+    def _visible_groups(self, group_name):
+        """
+        Returns `(layer number, group)` for the layers in which the group can
+        be seen, from the bottom up
+        """
+        floor = self._group_floors.get(group_name, 0)
+        return [(n, layer.groups[group_name]) for n, layer in enumerate(self.layers)
+                if n >= floor and group_name in layer.groups]
+
+    def _hide_group(self, group_name):
+        self._group_floors[group_name] = self._top
+        self._variable_floors.pop(group_name, None)
+        self.layers[-1].groups.pop(group_name, None)
+
+    def group_name(self, key):
+        """
+        Returns the name of the group stored in `groups` under `key`, e.g.
+        `station` for `station0`
+        """
+        for layer in reversed(self.layers):
+            if key in layer.groups:
+                return layer.group_name(key)
+        return key
+
+    def get(self, path):
+        return compile_path(path).get(self.groups)
+
+    def set(self, path, value):
+        compile_path(path).set(self.groups, value)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = AttributeMapper(self.groups)
+        return self._data
+
+    def flatten(self):
+        """
+        Returns a single `Namelist` with the merged content of all layers,
+        which doesn't share any values with them
+        """
+        namelist = Namelist('', array_backend=self.layers[0]._array_backend)
+        for group_name in self.groups:
+            namelist.add_group(self.group_name(group_name),
+                               copy.deepcopy(OrderedDict(self.groups[group_name].items())))
+        return namelist
+
+    def dump(self, array_inline=True, values_per_line=None):
+        output = StringIO()
+        self.dump_to(output, array_inline=array_inline, values_per_line=values_per_line)
+        return output.getvalue()
+
+    def dump_to(self, fileobj, array_inline=True, values_per_line=None):
+        """
+        Writes the merged content of all layers to `fileobj`, one variable at
+        a time
+        """
+        formatter = self.layers[0]
+        for group_name in self.groups:
+            formatter._dump_group(fileobj.write, self.group_name(group_name), OrderedDict(self.groups[group_name].items()),
+                                  array_inline, values_per_line)
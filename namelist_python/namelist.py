@@ -1,253 +1,980 @@
+import io
+import os
 import sys
+import mmap
+from itertools import product
 try:
     from collections import OrderedDict
 except ImportError:
     from utils import OrderedDict
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+from .parser import NamelistParseError, NumberRun, tokenize, parse, parse_text, variable_key, component_path, iter_group_blocks, iter_file_pieces, iter_group_spans
+from .document import LayoutRecorder, NamelistDocument
+from .paths import compile_path
+from .schema import SchemaValidationError, ValidationError, CONVERSION_ERRORS, locator
+from .diff import diff_groups, patch_variables, added_group_name
+from .values import NoSingleValueFoundException, parse_value, parse_values, parse_runs, has_repeat_count
+from .arrays import numpy, ArrayBuilder, NDArrayBuilder, RunLengthArray, SparseArray, is_nd_array, is_type_array, fortran_order, check_array_backend, is_numpy_array, is_numpy_scalar, parse_numpy_array, parse_number_run, format_numpy_array
+
+
+if sys.version_info < (3,0,0):
+    _string_types = (str, unicode)
+    _integer_types = (int, long)
+else:
+    _string_types = (str,)
+    _integer_types = (int,)
+
+def _format_bool(value):
+    return value and '.true.' or '.false.'
+
+def _format_int(value):
+    return "%d" % value
+
+def _format_float(value):
+    # ensure that we never use scientific notation, but remove excess zeroes
+    # https://stackoverflow.com/a/2440786
+    return ('%f' % value).rstrip('0')
+
+def _format_string(value):
+    return "'%s'" % value.replace("'", "''")
+
+def _format_complex(value):
+    return "(%s,%s)" % (_format_float(value.real), _format_float(value.imag))
+
+# formatters for the exact type of a value, subclasses are handled by
+# Namelist._format_value
+_formatters = {
+    bool: _format_bool,
+    int: _format_int,
+    float: _format_float,
+    str: _format_string,
+    complex: _format_complex,
+}
+
+def _read_file(filename, encoding):
+    # decoded the same way as memory mapped files, also under python 2
+    with io.open(filename, 'r', encoding=encoding) as f:
+        return f.read()
+
+def read_namelist_file(filename, lazy=False, array_backend='list', preserve_layout=False, cache=None,
+                       use_mmap=False, encoding='utf-8', schema=None):
+    """
+    Parses the namelist file `filename`. If a `NamelistCache` is given as
+    `cache` the file is only parsed if it isn't in the cache already. With
+    `use_mmap=True` the file is memory mapped and parsed straight from the
+    mapped bytes rather than being read into a string first. See `Namelist`
+    for `schema`. The file is decoded with `encoding`.
+    """
+    if cache is not None and not lazy and not preserve_layout and schema is None:
+        return cache.read(filename, array_backend=array_backend, use_mmap=use_mmap, encoding=encoding)
+
+    if use_mmap:
+        if lazy or preserve_layout:
+            raise ValueError("A memory mapped file can't be lazily parsed or preserve its layout")
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files can't be mapped
+                return Namelist('', array_backend=array_backend, schema=schema)
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return Namelist(buf, array_backend=array_backend, encoding=encoding, schema=schema)
+            finally:
+                buf.close()
+
+    input_str = _read_file(filename, encoding)
+    return Namelist(input_str, lazy=lazy, array_backend=array_backend, preserve_layout=preserve_layout,
+                    schema=schema)
+
+def iter_namelist_groups(fileobj, chunk_size=65536, array_backend='list'):
+    """
+    Reads namelist groups from a file object one at a time, yielding
+    `(group_name, group)` for each. Only a single group is kept in memory at
+    a time and iteration can be stopped as soon as the wanted group is found.
+    Repeated group names are yielded as they appear in the file.
+    """
+    for group_block in iter_group_blocks(fileobj, chunk_size):
+        for group_name, group in Namelist(group_block, array_backend=array_backend).groups.items():
+            yield group_name, group
+
+
+def apply_patch(file_in, file_out, changes, chunk_size=65536):
+    """
+    Writes the namelist file `file_in` to `file_out` with the change set
+    `changes` (as returned by `Namelist.diff`, or a dict of group name to a
+    dict of variable name to new value) applied. The file is streamed a
+    group at a time, groups without changes are copied as they are and in
+    the other groups only the assignments that change are rewritten. Groups
+    that aren't in the file are added at the end, named as in
+    `Namelist.patch`.
+    """
+    if os.path.abspath(file_in) == os.path.abspath(file_out):
+        tmp_path = "%s.%d.tmp" % (file_out, os.getpid())
+        apply_patch(file_in, tmp_path, changes, chunk_size)
+        getattr(os, 'replace', os.rename)(tmp_path, file_out)
+        return
+
+    keys = GroupKeys()
+    seen = set()
+    with open(file_in, 'r') as fin, open(file_out, 'w') as fout:
+        text = ''
+        for group_name, text in iter_file_pieces(fin, chunk_size):
+            if group_name is None:
+                fout.write(text)
+                continue
+            # repeated groups are given the same keys as in `Namelist`
+            group_key = keys.add(group_name)
+            seen.add(group_key)
+            if group_key not in changes:
+                fout.write(text)
+            elif changes[group_key] is not None:
+                namelist = Namelist(text, preserve_layout=True)
+                namelist.patch({group_name: changes[group_key]})
+                namelist.dump_to(fout)
+
+        new_groups = [k for k, c in changes.items() if k not in seen and c is not None]
+        if new_groups:
+            if text and not text.endswith('\n'):
+                fout.write('\n')
+            namelist = Namelist('')
+            for k in new_groups:
+                namelist.groups.add(added_group_name(changes, k), OrderedDict(), key=k)
+            namelist.patch(OrderedDict((k, changes[k]) for k in new_groups))
+            namelist.dump_to(fout)
+
+
+class GroupKeys(object):
+    """
+    Keys under which the instances of each group are stored in a mapping of
+    groups, in order. The first instance of a group is stored under its
+    name and repeated groups are numbered, e.g. `station0`, `station1`,
+    skipping keys that are already in use.
+    """
+
+    def __init__(self):
+        # group name -> keys of its instances
+        self.keys = OrderedDict()
+        # key -> group name
+        self.names = {}
+
+    def copy(self):
+        group_keys = GroupKeys()
+        group_keys.keys = OrderedDict((name, list(keys)) for name, keys in self.keys.items())
+        group_keys.names = dict(self.names)
+        return group_keys
+
+    def add(self, group_name, key=None):
+        """
+        Adds a new instance of the group `group_name`, returning its key
+        """
+        if key is None:
+            n = len(self.keys.get(group_name, ()))
+            key = group_name if n == 0 else "%s%d" % (group_name, n - 1)
+            i = max(n - 1, 0)
+            while key in self.names:
+                key = "%s%d" % (group_name, i)
+                i += 1
+        self.names[key] = group_name
+        self.keys.setdefault(group_name, []).append(key)
+        return key
+
+    def remove(self, key):
+        group_name = self.names.pop(key, None)
+        if group_name is not None:
+            keys = self.keys[group_name]
+            keys.remove(key)
+            if not keys:
+                del self.keys[group_name]
+
+
+def group_keys(group_names):
+    """
+    Returns the keys the groups `group_names`, in order, are stored under
+    """
+    keys = GroupKeys()
+    return [keys.add(group_name) for group_name in group_names]
+
+
+class GroupDict(OrderedDict):
+    """
+    Ordered dict of groups, which also keeps the keys of the instances of
+    each group (see `GroupKeys`). Groups assigned by key are taken to be a
+    group of that name, use `add` to add an instance of a repeated group.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._keys = GroupKeys()
+        OrderedDict.__init__(self, *args, **kwargs)
+
+    def add(self, group_name, group, key=None):
+        """
+        Adds `group` as a new instance of the group `group_name`, returning
+        its key
+        """
+        key = self._keys.add(group_name, key)
+        OrderedDict.__setitem__(self, key, group)
+        return key
+
+    def __setitem__(self, key, group):
+        # keys that are already known keep their group name, including while
+        # a copy is being made
+        if key not in self._keys.names:
+            self._keys.add(key, key)
+        OrderedDict.__setitem__(self, key, group)
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        self._keys.remove(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            group = OrderedDict.__getitem__(self, key)
+            del self[key]
+            return group
+        elif default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('dictionary is empty')
+        key = next(reversed(self)) if last else next(iter(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self._keys = GroupKeys()
+
+    def copy(self):
+        groups = self.__class__()
+        groups._keys = self._keys.copy()
+        for key, group in self.items():
+            OrderedDict.__setitem__(groups, key, group)
+        return groups
+
+
+class LazyGroups(MutableMapping):
+    """
+    Ordered mapping of group names to groups, where a group is only parsed
+    from the original text the first time it is accessed
+    """
+
+    def __init__(self, text, parse_group_block):
+        self._text = text
+        self._parse_group_block = parse_group_block
+        # values are either a parsed group or the (start, end) offsets of
+        # the unparsed group block in the text
+        self._groups = OrderedDict()
+        self._keys = GroupKeys()
+
+    def add_unparsed(self, group_name, start, end):
+        self._groups[self._keys.add(group_name)] = (start, end)
+
+    def add(self, group_name, group, key=None):
+        key = self._keys.add(group_name, key)
+        self._groups[key] = group
+        return key
+
+    def is_parsed(self, group_name):
+        return not isinstance(self._groups[group_name], tuple)
 
-import re
+    def __getitem__(self, group_name):
+        group = self._groups[group_name]
+        if isinstance(group, tuple):
+            start, end = group
+            group = self._parse_group_block(self._text[start:end])
+            self._groups[group_name] = group
+        return group
 
-class NoSingleValueFoundException(Exception):
-    pass
+    def __setitem__(self, group_name, group):
+        if group_name not in self._keys.names:
+            self._keys.add(group_name, group_name)
+        self._groups[group_name] = group
 
-def read_namelist_file(filename):
-    return Namelist(open(filename, 'r').read())
+    def __delitem__(self, group_name):
+        del self._groups[group_name]
+        self._keys.remove(group_name)
 
+    def __contains__(self, group_name):
+        return group_name in self._groups
 
-class AttributeMapper():
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self._groups.keys()))
+
+
+class AttributeMapper(object):
     """
-    Simple mapper to access dictionary items as attributes
+    Simple mapper to access dictionary items as attributes. The mappers of
+    nested dicts (e.g. groups) are created once and reused for as long as
+    the dict they map isn't replaced.
     """
+    __slots__ = ('data', '_children')
 
     def __init__(self, obj):
-        self.__dict__['data'] = obj
+        object.__setattr__(self, 'data', obj)
+        object.__setattr__(self, '_children', {})
 
     def __getattr__(self, attr):
-        if attr in self.data:
+        if attr == 'data' or attr == '_children':
+            # not set yet, e.g. while unpickling
+            raise AttributeError(attr)
+        try:
             found_attr = self.data[attr]
-            if isinstance(found_attr, dict):
-                return AttributeMapper(found_attr)
-            else:
-                return found_attr
-        else:
-            raise AttributeError
+        except KeyError:
+            raise AttributeError(attr)
+        if isinstance(found_attr, (dict, MutableMapping)):
+            child = self._children.get(attr)
+            if child is None or child.data is not found_attr:
+                child = self._children[attr] = AttributeMapper(found_attr)
+            return child
+        return found_attr
 
     def __setattr__(self, attr, value):
-        if attr in self.data:
-            self.data[attr] = value
-        else:
-            raise NotImplementedError
+        # variables that don't exist yet are added
+        self.data[attr] = value
+
+    def __delattr__(self, attr):
+        try:
+            del self.data[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __reduce__(self):
+        return (AttributeMapper, (self.data,))
+
+    def update(self, *args, **kwargs):
+        """
+        Sets many variables at once, takes the same arguments as `dict.update`
+        """
+        self.data.update(*args, **kwargs)
 
     def __dir__(self):
-        return self.data.keys()
+        return list(self.data.keys())
 
 class Namelist():
     """
     Parses namelist files in Fortran 90 format, recognised groups are
-    available through 'groups' attribute.
+    available through 'groups' attribute. If an `encoding` is given
+    `input_str` is a bytes buffer instead of a string.
+
+    With a `Schema` as `schema` the values of the variables it gives a type
+    for are converted straight to that type, and every group is validated
+    as soon as it is parsed. Values are coerced to their declared type and
+    missing variables set to their default, and `SchemaValidationError` is
+    raised with all errors found.
+
+    Repeated groups, e.g. several `&station` blocks, are stored in `groups`
+    as `station`, `station0`, `station1`, ... in the order they appear, and
+    are written back out under their own name. `instances`, `group` and
+    `column` give access to them by name and occurrence.
     """
 
-    def __init__(self, input_str):
-        self.groups = OrderedDict()
+    def __init__(self, input_str, lazy=False, array_backend='list', preserve_layout=False, encoding=None,
+                 schema=None):
+        check_array_backend(array_backend)
+        self._array_backend = array_backend
+        self._document = None
+        self._data = None
+
+        if lazy and preserve_layout:
+            raise ValueError("A namelist can't be both lazily parsed and preserve its layout")
+        if encoding is not None and (lazy or preserve_layout):
+            raise ValueError("A namelist parsed from bytes can't be lazily parsed or preserve its layout")
+        if lazy and schema is not None:
+            raise ValueError("A namelist can't be both lazily parsed and validated")
+
+        if lazy:
+            # only find where each group starts and ends, the variables of a
+            # group are parsed the first time it is accessed
+            self.groups = LazyGroups(input_str, self._parse_group_block)
+            for group_name, start, end in iter_group_spans(input_str):
+                self.groups.add_unparsed(group_name, start, end)
+            return
+
+        self.groups = GroupDict()
+
+        # comments are skipped by the parser, to keep them (and the rest of
+        # the original layout) the position of every group and assignment is
+        # recorded as the tokens are parsed
+        # (`encoding` is given when `input_str` is a bytes buffer, e.g. a
+        # memory mapped file)
+        if preserve_layout or schema is not None:
+            # the layout also gives the lines of validation errors
+            layout = LayoutRecorder(tokenize(input_str, encoding))
+            groups = parse(layout)
+        else:
+            groups = parse_text(input_str, encoding, number_runs=array_backend == 'numpy')
+
+        errors = []
+        for group_name, assignments in groups:
+            converters = conversion_errors = None
+            if schema is not None:
+                converters = schema.converters(group_name)
+                conversion_errors = []
+            group = self._parse_group(assignments, converters, conversion_errors)
+            self._finalise_group(group_name, group)
+
+            schema_name = group_name
+            group_name = self.groups.add(group_name, group)
+            if preserve_layout or schema is not None:
+                layout.groups[-1].key = group_name
+            if schema is not None:
+                locate = locator(input_str, layout.groups[-1])
+                errors += [ValidationError(group_name, variable_name, locate(variable_name), message)
+                           for variable_name, message in conversion_errors]
+                # variables whose values weren't understood aren't missing
+                failed = set(variable_name for variable_name, _ in conversion_errors)
+                errors += [error for error in schema.validate_group(self, schema_name, group_name, group,
+                                                                    coerce=True, locate=locate)
+                           if error.variable not in failed]
+
+        if schema is not None:
+            for schema_name in schema.groups:
+                if schema_name not in self.groups:
+                    errors += schema.validate_group(self, schema_name, schema_name, {})
+            if errors:
+                raise SchemaValidationError(errors)
+
+        if preserve_layout:
+            self._document = NamelistDocument(input_str, layout.groups, self.groups)
+
+    def group_name(self, key):
+        """
+        Returns the name of the group stored in `groups` under `key`, e.g.
+        `station` for `station0`
+        """
+        return self.groups._keys.names.get(key, key)
 
-        group_re = re.compile(r'&([^&]+)/', re.DOTALL)  # allow blocks to span multiple lines
-        array_re = re.compile(r'(\w+)\((\d+)\)')
-        string_re = re.compile(r"\'\s*\w[^']*\'")
-        self._complex_re = re.compile(r'^\((\d+.?\d*),(\d+.?\d*)\)$')
+    def instances(self, group_name):
+        """
+        Returns the list of instances of the group `group_name` (the group
+        itself if it isn't repeated), in the order they appear
+        """
+        groups = self.groups
+        return [groups[key] for key in groups._keys.keys.get(group_name, ())]
 
-        # remove all comments, since they may have forward-slashes
-        # TODO: store position of comments so that they can be re-inserted when
-        # we eventually save
-        filtered_lines = []
-        for line in input_str.split('\n'):
-            if line.strip().startswith('!'):
-                continue
-            else:
-                filtered_lines.append(line)
+    def group(self, group_name, occurrence=0):
+        """
+        Returns instance number `occurrence` (starting at 0) of the group
+        `group_name`, raises `KeyError` if there is no such group and
+        `IndexError` if it has fewer instances
+        """
+        keys = self.groups._keys.keys.get(group_name)
+        if keys is None:
+            raise KeyError(group_name)
+        return self.groups[keys[occurrence]]
 
-        group_blocks = re.findall(group_re, "\n".join(filtered_lines))
+    def add_group(self, group_name, group=None):
+        """
+        Adds a new instance of the group `group_name` after the existing
+        ones (or a new group), by default empty, and returns it
+        """
+        if group is None:
+            group = OrderedDict()
+        self.groups.add(group_name, group)
+        return group
 
-        group_cnt = {}
+    def column(self, group_name, variable, default=None):
+        """
+        Returns the value of `variable` (which can be a derived type
+        component, e.g. `physics%nccn`) in every instance of the group
+        `group_name`, as a list or with the numpy backend a numpy array.
+        Instances in which the variable isn't set are given `default`.
+        """
+        keys = compile_path("%s.%s" % (group_name, variable)).keys[1:]
+        values = []
+        for group in self.instances(group_name):
+            value = group
+            try:
+                for key in keys:
+                    value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = default
+            values.append(value)
+        if self._array_backend == 'numpy':
+            return numpy.array(values)
+        return values
+
+    def _parse_group(self, assignments, converters=None, conversion_errors=None):
+        """
+        Parses the assignments of a group, `converters` optionally gives
+        `(converter, numpy dtype, type name)` by variable name for variables
+        with a known type (see `Schema.converters`). If `conversion_errors`
+        is given, variables whose values can't be parsed are left out and
+        `(variable name, message)` appended to it rather than raising.
+        """
+        group = OrderedDict()
 
-        for group_block in group_blocks:
-            block_lines_raw = group_block.split('\n')
-            group_name = block_lines_raw.pop(0).strip()
+        for variable_name, variable_index, variable_values in assignments:
+            if len(variable_values) == 0:
+                # null value, variable is left undefined
+                continue
 
-            group = OrderedDict()
+            # (the name errors are reported for)
+            error_name = variable_name
+            if '%' in variable_name:
+                # derived type component, stored in a tree of dicts (and lists
+                # of dicts for arrays of derived types)
+                variables, variable_name, variable_index = self._component(group, variable_name, variable_index)
+            else:
+                variables = group
+                variable_name, variable_index = variable_key(variable_name, variable_index)
+                error_name = variable_name
+
+            if variable_values[0].__class__ is NumberRun:
+                # only given with the numpy backend, plain numbers are
+                # converted straight from the text
+                if variable_index is None:
+                    parsed_array = parse_number_run(variable_values[0])
+                    if parsed_array is not None:
+                        variables[variable_name] = parsed_array
+                        continue
+                variable_values = variable_values[0].values()
+
+            if variable_index is None and has_repeat_count(variable_values):
+                # values with repeat counts are kept as runs rather than expanded
+                variables[variable_name] = RunLengthArray(parse_runs(variable_values))
+                continue
 
-            block_lines = []
-            for line in block_lines_raw:
-                # cleanup string
-                line = line.strip()
-                if line == "":
-                    continue
-                if line.startswith('!'):
-                    continue
+            parsed_values = None
+            converter = None if converters is None else converters.get(variable_name)
+            if converter is not None:
+                # the type is known, the values don't need to be inspected
+                try:
+                    parsed_values = converter[0](variable_values)
+                except CONVERSION_ERRORS:
+                    # left to the validation to report
+                    pass
+                else:
+                    if self._array_backend == 'numpy' and converter[1] is not None \
+                            and variable_index is None and len(variable_values) > 1:
+                        variables[variable_name] = numpy.array(parsed_values, dtype=converter[1])
+                        continue
 
+            if parsed_values is None:
                 try:
-                    k, v = line.split('=')
-                    block_lines.append(line)
-                except ValueError:
-                    # no = in current line, try to append to previous line
-                    if block_lines[-1].endswith(','):
-                        block_lines[-1] += line
-                    else:
+                    if self._array_backend == 'numpy' and variable_index is None and len(variable_values) > 1:
+                        # inline arrays are converted in bulk
+                        parsed_array = parse_numpy_array(variable_values, self._parse_value)
+                        if parsed_array is not None:
+                            variables[variable_name] = parsed_array
+                            continue
+
+                    parsed_values = parse_values(variable_values)
+                except NoSingleValueFoundException as e:
+                    if conversion_errors is None:
                         raise
+                    if converter is None:
+                        message = "value %r not understood" % e.args[0]
+                    else:
+                        message = "expected %s values, got %r" % (converter[2], e.args[0])
+                    conversion_errors.append((error_name, message))
+                    continue
 
-            for line in block_lines:
-                # commas at the end of lines seem to be optional
-                if line.endswith(','):
-                    line = line[:-1]
-
-                # inline comments are allowed, but we remove them for now
-                if "!" in line:
-                    line = line.split("!")[0].strip()
-
-                k, v = line.split('=')
-                variable_name = k.strip()
-                variable_value = v.strip()
-
-                variable_name_groups = re.findall(array_re, k)
+            if variable_index is None and len(parsed_values) == 1 and len(variable_values) == 1:
+                variables[variable_name] = parsed_values[0]
+            elif isinstance(variable_index, tuple) and len(variable_index) > 1:
+                # element or section of a multi-dimensional array, which is
+                # only assembled once its shape is known
+                array = variables.get(variable_name)
+                if not isinstance(array, NDArrayBuilder):
+                    if array is not None:
+                        raise NamelistParseError("The variable '%s' is assigned both as a one- and a multi-dimensional array"
+                                                 % variable_name)
+                    array = variables[variable_name] = NDArrayBuilder()
+                array.add(variable_index, parsed_values)
+            else:
+                if variable_index is None:
+                    variable_index = 0
+                array = variables.get(variable_name)
+                if isinstance(array, NDArrayBuilder):
+                    raise NamelistParseError("The variable '%s' is assigned both as a one- and a multi-dimensional array"
+                                             % variable_name)
+                if not isinstance(array, ArrayBuilder):
+                    # values already assigned to the variable are kept, it
+                    # may have been given inline earlier
+                    array = variables[variable_name] = ArrayBuilder(array)
+                if isinstance(variable_index, tuple):
+                    if not array.set_section(variable_index[0], parsed_values):
+                        raise NamelistParseError("The variable '%s' has an array section that is out of range"
+                                                 % variable_name)
+                elif not array.set_values(variable_index, parsed_values):
+                    raise NamelistParseError("The variable '%s' has an array index (%d) smaller than 1"
+                                             % (variable_name, variable_index+1))
+
+        return group
+
+    def _component(self, group, variable_name, variable_index):
+        """
+        Returns the dict holding the derived type component `variable_name`
+        (creating it and its parents if needed), and the name and index of
+        the component within it
+        """
+        path = component_path(variable_name, variable_index)
+        if path is None:
+            raise NamelistParseError("The derived type component '%s' isn't understood" % variable_name)
+
+        variables = group
+        for name, index in path[:-1]:
+            value = variables.get(name)
+            if index is None:
+                if value is None:
+                    value = variables[name] = OrderedDict()
+            elif isinstance(index, int):
+                # array of derived types, elements that aren't assigned are
+                # left empty
+                if value is None:
+                    value = variables[name] = []
+                if isinstance(value, list):
+                    while len(value) <= index:
+                        value.append(OrderedDict())
+                    value = value[index]
+            else:
+                raise NamelistParseError("Only single elements of arrays of derived types are supported, not '%s'"
+                                         % variable_name)
+            if not isinstance(value, dict):
+                raise NamelistParseError("The variable '%s' is assigned both a value and components" % name)
+            variables = value
 
-                variable_index = None
-                if len(variable_name_groups) == 1:
-                    variable_name, variable_index = variable_name_groups[0]
-                    variable_index = int(variable_index)-1 # python indexing starts at 0
+        name, index = path[-1]
+        return variables, name, index
 
+    def _finalise_group(self, group_name, group):
+        """
+        Replaces the arrays that were built while parsing the group with lists
+        (or numpy arrays, or sparse arrays)
+        """
+        for variable_name, variable_value in group.items():
+            if isinstance(variable_value, ArrayBuilder):
+                # arrays with unassigned elements are stored as a SparseArray
+                group[variable_name] = variable_value.build(self._array_backend)
+            elif isinstance(variable_value, NDArrayBuilder):
                 try:
-                    parsed_value = self._parse_value(variable_value)
-
-                    if variable_index is None:
-                        group[variable_name] = parsed_value
-                    else:
-                        if not variable_name in group:
-                            group[variable_name] = {'_is_list': True}
-                        group[variable_name][variable_index] = parsed_value
-
-                except NoSingleValueFoundException as e:
-                    # see we have several values inlined
-                    if variable_value.count("'") in [0, 2]:
-                        if variable_value.count("(") != 0:  # if list of complex values
-                            variable_arr_entries = variable_value.split()
-                        else:
-                            # replacing ',' makes comma-separated arrays possible,
-                            # see unit test test_inline_array_comma
-                            # this fails if an array of complex numbers is comma-separated
-                            variable_arr_entries = variable_value.replace(',', ' ').split()
-                    else:
-                        # we need to be more careful with lines with escaped
-                        # strings, since they might contained spaces
-                        matches = re.findall(string_re, variable_value)
-                        variable_arr_entries = [s.strip() for s in matches]
-
-
-                    for variable_index, inline_value in enumerate(variable_arr_entries):
-                        parsed_value = self._parse_value(inline_value)
-
-                        if variable_index is None:
-                            group[variable_name] = parsed_value
-                        else:
-                            if not variable_name in group:
-                                group[variable_name] = {'_is_list': True}
-                            group[variable_name][variable_index] = parsed_value
-
-            if group_name in self.groups.keys():
-                
-                if not group_name in group_cnt.keys():
-                    group_cnt[group_name] = 0
-                else:
-                    group_cnt[group_name] += 1
-                group_name = group_name + str(group_cnt[group_name])
+                    group[variable_name] = variable_value.build(self._array_backend)
+                except ValueError as e:
+                    raise NamelistParseError("The multi-dimensional array '%s' in group '%s' is inconsistent: %s"
+                                             % (variable_name, group_name, e))
+            elif isinstance(variable_value, dict):
+                self._finalise_group(group_name, variable_value)
+            elif is_type_array(variable_value):
+                for element in variable_value:
+                    self._finalise_group(group_name, element)
+
+    def _parse_group_block(self, group_block):
+        """
+        Parses the text of a single '&name ... /' block
+        """
+        for group_name, assignments in parse_text(group_block, number_runs=self._array_backend == 'numpy'):
+            group = self._parse_group(assignments)
+            self._finalise_group(group_name, group)
+            return group
 
-            self.groups[group_name] = group
+    # kept as a method for backwards compatibility
+    _parse_value = staticmethod(parse_value)
 
-            self._check_lists()
+    def dump(self, array_inline=True, values_per_line=None):
+        output = StringIO()
+        self.dump_to(output, array_inline=array_inline, values_per_line=values_per_line)
+        return output.getvalue()
 
-    def _parse_value(self, variable_value):
+    def dump_to(self, fileobj, array_inline=True, values_per_line=None):
         """
-        Tries to parse a single value, raises an exception if no single value is matched
+        Writes the namelist to `fileobj` one variable at a time, rather than
+        building the whole output in memory first. Inline arrays with more
+        than `values_per_line` values are wrapped over several lines.
         """
-        try:
-            parsed_value = int(variable_value)
-        except ValueError:
-            try:
-                parsed_value = float(variable_value)
-            except ValueError:
-                # check for complex number
-                complex_values = re.findall(self._complex_re, variable_value)
-                if len(complex_values) == 1:
-                    a, b = complex_values[0]
-                    parsed_value = complex(float(a),float(b))
-                elif variable_value in ['.true.', 'T']:
-                    # check for a boolean
-                    parsed_value = True
-                elif variable_value in ['.false.', 'F']:
-                    parsed_value = False
-                else:
-                    # see if we have an escaped string
-                    if variable_value.startswith("'") and variable_value.endswith("'") and variable_value.count("'") == 2:
-                        parsed_value = variable_value[1:-1]
-                    elif variable_value.startswith('"') and variable_value.endswith('"') and variable_value.count('"') == 2:
-                        parsed_value = variable_value[1:-1]
-                    else:
-                        raise NoSingleValueFoundException(variable_value)
+        write = fileobj.write
 
-        return parsed_value
+        if self._document is not None:
+            # copy the original text, only rewriting what has changed
+            def format_variable(variable_name, variable_value, index_notation):
+                return self._format_assignment(variable_name, variable_value,
+                                               array_inline and not index_notation, values_per_line)
 
-    def _check_lists(self):
-        for group in self.groups.values():
-            for variable_name, variable_values in group.items():
-                if isinstance(variable_values, dict):
-                    if '_is_list' in variable_values and variable_values['_is_list']:
-                        variable_data = variable_values
-                        del(variable_data['_is_list'])
+            def format_group(group_name, group_variables):
+                pieces = []
+                self._dump_group(pieces.append, self.group_name(group_name), group_variables,
+                                 array_inline, values_per_line)
+                return "".join(pieces)
 
-                        num_entries = len(variable_data.keys())
-                        variable_list = [None]*num_entries
+            for piece in self._document.render(self.groups, self._format_value, self._format_inline,
+                                               format_variable, format_group):
+                write(piece)
+            return
 
-                        for i, value in variable_data.items():
-                            if i >= num_entries:
-                                raise Exception("The variable '%s' has an array index assignment that is inconsistent with the number of list values" % variable)
-                            else:
-                                variable_list[i] = value
+        for group_name, group_variables in self.groups.items():
+            self._dump_group(write, self.group_name(group_name), group_variables, array_inline, values_per_line)
+
+    def _dump_group(self, write, group_name, group_variables, array_inline, values_per_line):
+        # the lines of a group are written in one go, and scalars of the
+        # basic types are formatted here rather than by `_dump_variable`
+        lines = ["&%s\n" % group_name]
+        append = lines.append
+        formatters = _formatters
+        for variable_name, variable_value in group_variables.items():
+            formatter = formatters.get(type(variable_value))
+            if formatter is not None:
+                append("  %s = %s\n" % (variable_name, formatter(variable_value)))
+            else:
+                self._dump_variable(append, variable_name, variable_value, array_inline, values_per_line)
+        append("/\n")
+        write("".join(lines))
 
-                        group[variable_name] = variable_list
+    def _format_assignment(self, variable_name, variable_value, array_inline, values_per_line):
+        """
+        Formats the assignment of a single variable, without the indentation
+        of the first line and the final newline
+        """
+        pieces = []
+        self._dump_variable(pieces.append, variable_name, variable_value, array_inline, values_per_line)
+        return "".join(pieces).strip()
+
+    def _dump_variable(self, write, variable_name, variable_value, array_inline, values_per_line):
+        if isinstance(variable_value, RunLengthArray):
+            if array_inline:
+                formatted_values = self._format_array(variable_value)
+                self._dump_inline_array(write, variable_name, formatted_values, values_per_line)
+            else:
+                n = 1
+                for count, v in variable_value.runs:
+                    if v is not None:
+                        write("  %s(%d) = %s\n" % (variable_name, n, self._format_run(count, v)))
+                    n += count
+        elif isinstance(variable_value, dict):
+            # derived type, each component is written as `name%component`
+            for component_name, component_value in variable_value.items():
+                self._dump_variable(write, "%s%%%s" % (variable_name, component_name), component_value,
+                                    array_inline, values_per_line)
+        elif is_type_array(variable_value):
+            for n, element in enumerate(variable_value):
+                self._dump_variable(write, "%s(%d)" % (variable_name, n+1), element, array_inline, values_per_line)
+        elif isinstance(variable_value, SparseArray):
+            # only the assigned elements are written, so always in index notation
+            for i, v in variable_value.items():
+                write("  %s(%d) = %s\n" % (variable_name, i+1, self._format_value(v)))
+        elif is_nd_array(variable_value):
+            self._dump_nd_array(write, variable_name, variable_value, array_inline, values_per_line)
+        elif isinstance(variable_value, list) or is_numpy_array(variable_value):
+            formatted_values = self._format_array(variable_value)
+            if array_inline:
+                self._dump_inline_array(write, variable_name, formatted_values, values_per_line)
+            else:
+                for n, v in enumerate(formatted_values):
+                    write("  %s(%d) = %s\n" % (variable_name, n+1, v))
+        else:
+            write("  %s = %s\n" % (variable_name, self._format_value(variable_value)))
 
-    def dump(self, array_inline=True):
-        lines = []
-        for group_name, group_variables in self.groups.items():
-            lines.append("&%s" % group_name)
-            for variable_name, variable_value in group_variables.items():
-                if isinstance(variable_value, list):
-                    if array_inline:
-                        lines.append("  %s = %s" % (variable_name, " ".join([self._format_value(v) for v in variable_value])))
-                    else:
-                        for n, v in enumerate(variable_value):
-                            lines.append("  %s(%d) = %s" % (variable_name, n+1, self._format_value(v)))
-                else:
-                    lines.append("  %s = %s" % (variable_name, self._format_value(variable_value)))
-            lines.append("/")
+    def _dump_nd_array(self, write, variable_name, variable_value, array_inline, values_per_line):
+        """
+        Multi-dimensional arrays are written in fortran (column-major) order
+        either as a single assignment to the whole array, or one assignment
+        per column
+        """
+        shape, flat_values = fortran_order(variable_value)
+        formatted_values = self._format_array(flat_values)
+        if array_inline:
+            subscript = ",".join(["1:%d" % n for n in shape])
+            self._dump_inline_array(write, "%s(%s)" % (variable_name, subscript), formatted_values, values_per_line)
+        else:
+            n_rows = shape[0]
+            columns = product(*[range(1, n+1) for n in reversed(shape[1:])])
+            for n, column in enumerate(columns):
+                subscript = "1:%d,%s" % (n_rows, ",".join(["%d" % i for i in reversed(column)]))
+                self._dump_inline_array(write, "%s(%s)" % (variable_name, subscript),
+                                        formatted_values[n*n_rows:(n+1)*n_rows], values_per_line)
+
+    def _dump_inline_array(self, write, variable_name, formatted_values, values_per_line):
+        prefix = "  %s = " % variable_name
+        if values_per_line is None or len(formatted_values) <= values_per_line:
+            write("%s%s\n" % (prefix, " ".join(formatted_values)))
+        else:
+            # continuation lines are aligned with the first value
+            separator = "\n" + " "*len(prefix)
+            lines = [" ".join(formatted_values[i:i+values_per_line])
+                     for i in range(0, len(formatted_values), values_per_line)]
+            write("%s%s\n" % (prefix, separator.join(lines)))
+
+    def _format_array(self, variable_value):
+        if isinstance(variable_value, RunLengthArray):
+            return [self._format_run(c, v) for c, v in variable_value.runs]
+        elif is_numpy_array(variable_value):
+            return format_numpy_array(variable_value, self._format_value)
+        else:
+            return self._format_values(variable_value)
+
+    def _format_inline(self, variable_value):
+        """
+        Formats the value(s) of a variable as they'd appear on the right hand
+        side of an inline assignment
+        """
+        if isinstance(variable_value, (list, RunLengthArray)) or is_numpy_array(variable_value):
+            return " ".join(self._format_array(variable_value))
+        return self._format_value(variable_value)
+
+    def _format_run(self, count, value):
+        if value is None:
+            return "%d*" % count
+        elif count == 1:
+            return self._format_value(value)
+        else:
+            return "%d*%s" % (count, self._format_value(value))
 
-        return "\n".join(lines) + "\n"
+    def _format_values(self, values):
+        """
+        Formats a list of values, picking the formatter from the type of the
+        first value rather than checking the type of every value in turn
+        """
+        if len(values) == 0:
+            return []
+        value_type = type(values[0])
+        formatter = _formatters.get(value_type)
+        if formatter is None:
+            return [self._format_value(v) for v in values]
+        format_value = self._format_value
+        return [formatter(v) if type(v) is value_type else format_value(v) for v in values]
 
     def _format_value(self, value):
-        is_python2 = sys.version_info < (3,0,0)
-        if isinstance(value, bool):
-            return value and '.true.' or '.false.'
-        elif isinstance(value, int):
-            return "%d" % value
+        formatter = _formatters.get(type(value))
+        if formatter is not None:
+            return formatter(value)
+        elif isinstance(value, bool):
+            return _format_bool(value)
+        elif isinstance(value, _integer_types):
+            return _format_int(value)
         elif isinstance(value, float):
-            # ensure that we never use scientific notation, but remove excess zeroes
-            # https://stackoverflow.com/a/2440786
-            return ('%f' % value).rstrip('0')
-        elif isinstance(value, str):
-            return "'%s'" % value
-        elif is_python2 and isinstance(value, unicode):  # needed if unicode literals are used
-            return "'%s'" % value
+            return _format_float(value)
+        elif isinstance(value, _string_types):  # needed if unicode literals are used
+            return _format_string(value)
         elif isinstance(value, complex):
-            return "(%s,%s)" % (self._format_value(value.real), self._format_value(value.imag))
+            return _format_complex(value)
+        elif is_numpy_scalar(value):
+            return self._format_value(value.item())
         else:
             raise Exception("Variable type not understood: %s" % type(value))
 
+    def diff(self, other):
+        """
+        Returns the changes from this namelist to `other` as an ordered dict
+        of group name to either `None` for groups that aren't in `other`, or
+        an ordered dict of variable name to `Change(kind, old, new, indices)`
+        with `kind` one of 'added', 'removed' or 'changed'. For arrays that
+        keep their length `indices` lists the elements that differ and `old`
+        and `new` only hold those elements.
+        """
+        return diff_groups(self.groups, other.groups, other.group_name)
+
+    def patch(self, changes):
+        """
+        Applies the change set `changes`, as returned by `diff`, in place.
+        Instead of a `Change` variables can also be given the new value.
+        Groups that aren't in the namelist are added, under the name the
+        change set gives them (see `diff.ChangeSet`) so that e.g. the group
+        added as `station1` by `diff` is another `&station` group. With a
+        plain dict a group is added with its key as the name.
+        """
+        for group_name, group_changes in changes.items():
+            if group_changes is None:
+                self.groups.pop(group_name, None)
+                continue
+            if group_name not in self.groups:
+                self.groups.add(added_group_name(changes, group_name), OrderedDict(), key=group_name)
+            patch_variables(self.groups[group_name], group_changes, self._patch_component)
+
+    def _patch_component(self, group, variable_name):
+        if '%' in variable_name:
+            variables, variable_name, _ = self._component(group, variable_name, None)
+            return variables, variable_name
+        return group, variable_name
+
+    def to_json(self, indent=None):
+        """
+        Returns the namelist as JSON, see `namelist_python.export`
+        """
+        from .export import to_json
+        return to_json(self, indent)
+
+    @classmethod
+    def from_json(cls, text, array_backend='list'):
+        from .export import from_json
+        return from_json(text, array_backend)
+
+    def to_msgpack(self):
+        """
+        Returns the namelist as MessagePack, which needs the `msgpack` package
+        """
+        from .export import to_msgpack
+        return to_msgpack(self)
+
+    @classmethod
+    def from_msgpack(cls, data, array_backend='list'):
+        from .export import from_msgpack
+        return from_msgpack(data, array_backend)
+
+    def save_npz(self, filename):
+        """
+        Writes the namelist to an NPZ file in which large numeric arrays are
+        stored natively
+        """
+        from .export import save_npz
+        save_npz(self, filename)
+
+    @classmethod
+    def load_npz(cls, filename, array_backend='list', mmap=False):
+        """
+        Loads a namelist written by `save_npz`, with `mmap=True` large
+        arrays are memory mapped
+        """
+        from .export import load_npz
+        return load_npz(filename, array_backend, mmap)
+
+    def __getstate__(self):
+        # the attribute mapper is recreated when needed
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def get(self, path):
+        """
+        Returns the value of the variable at `path`, the group name followed
+        by the variable name separated by '.', e.g. `GROUP.dt`,
+        `GROUP.physics%microphysics%nccn` or `GROUP.domains(2)%dx`
+        """
+        return compile_path(path).get(self.groups)
+
+    def set(self, path, value):
+        """
+        Sets the value of the (existing) variable at `path`, see `get`
+        """
+        compile_path(path).set(self.groups, value)
+
+    def accessor(self, path):
+        """
+        Returns a `BoundPath` for reading and writing the variable at `path`
+        over and over again without looking it up each time
+        """
+        return compile_path(path).bind(self.groups)
+
     @property
     def data(self):
-        return AttributeMapper(self.groups)
+        if self._data is None or self._data.data is not self.groups:
+            self._data = AttributeMapper(self.groups)
+        return self._data
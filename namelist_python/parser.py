@@ -0,0 +1,528 @@
+"""
+Single-pass tokenizer and parser for Fortran 90 namelist input.
+
+The tokenizer walks the input once, emitting tokens for the start of a
+group, variable names (with an optional index), '=', values, commas, the
+terminating '/' and comments. Quoted strings are consumed as a whole, so
+'!' and '/' inside strings are not mistaken for comments or the end of a
+group, and values may span as many lines as they like.
+"""
+import re
+from collections import namedtuple
+
+GROUP_START = 'group_start'
+NAME = 'name'
+INDEX = 'index'
+EQUALS = 'equals'
+VALUE = 'value'
+COMMA = 'comma'
+GROUP_END = 'group_end'
+COMMENT = 'comment'
+
+Token = namedtuple('Token', ['kind', 'text', 'offset'])
+
+
+class NamelistParseError(Exception):
+    pass
+
+
+# outside of a group only comments and the start of a new group matter,
+# everything else is skipped
+_outside_re = re.compile(r"""
+    (?P<comment>![^\n]*)
+  | &(?P<group_start>\w+)
+  | [^!&]+
+  | &
+""", re.VERBOSE)
+
+# a complete '&name ... /' block, comments inside a group must be terminated
+# by a newline so that a partially read comment is never mistaken for the end
+# of the group
+_group_block_re = re.compile(r"""
+    &(?P<name>\w+)
+    [^'"!/]*(?:(?:'[^']*(?:''[^']*)*'|"[^"]*(?:""[^"]*)*"|![^\n]*\n)[^'"!/]*)*
+    /
+""", re.VERBOSE)
+
+_block_start_re = re.compile(r'[!&]')
+
+# inside a group, whitespace is skipped in front of each token. A variable
+# name, including the subscripts of the derived type components in it and
+# an optional subscript at the end, is matched together with the '='
+# following it so that names don't need to be told apart from values
+# afterwards.
+_inside_re = re.compile(r"""
+    \s*
+    (?:
+        (?P<name>[A-Za-z_][\w%]*(?:\s*\([^()]*\)\s*%[\w%]+)*)
+        (?:\s*\((?P<index>[^()]*)\))?
+        \s*(?P<equals>=)
+      | (?P<comment>![^\n]*)
+      | (?P<string>(?:\d+\*)?(?:'[^']*(?:''[^']*)*'|"[^"]*(?:""[^"]*)*"))
+      | (?P<repeat>\d+\*\([^()]*\))
+      | (?P<paren>\([^()]*\))
+      | (?P<stray_equals>=)
+      | (?P<comma>,)
+      | (?P<group_end>/)
+      | (?P<word>[^\s=,/!()'"&]+)
+    )
+""", re.VERBOSE)
+
+# whitespace in a variable name that isn't inside a subscript
+_name_space_re = re.compile(r'\s+(?![^(]*\))')
+
+_token_kinds = {
+    'comment': COMMENT,
+    'string': VALUE,
+    'repeat': VALUE,
+    'paren': VALUE,
+    'comma': COMMA,
+    'group_end': GROUP_END,
+    'word': VALUE,
+}
+
+# tokens are made without going through `Token.__new__`, which is
+# noticeably slower
+_new_token = tuple.__new__
+
+
+# runs of numbers are found by scanning for the characters numbers are made
+# of, which (unlike a repeated expression for a number) doesn't need memory
+# for each number. Whether they really are numbers is only found out when
+# they are converted.
+_number_run_re = re.compile(r"\s*([+\-\d.][\d.eEdD+\- \t\r\n,]*)")
+_number_run_sep_re = re.compile(r"[ \t\r\n,]+")
+
+# the same expressions for parsing from a bytes buffer, e.g. a memory mapped
+# file
+_outside_bytes_re = re.compile(_outside_re.pattern.encode('ascii'), re.VERBOSE)
+_inside_bytes_re = re.compile(_inside_re.pattern.encode('ascii'), re.VERBOSE)
+_number_run_bytes_re = re.compile(_number_run_re.pattern.encode('ascii'))
+
+
+def _number_run(text, pos, encoding, number_run_match):
+    """
+    Returns the `NumberRun` of the values of a variable starting at `pos`
+    and where it ends, or `None` if there aren't at least two values that
+    look like plain numbers
+    """
+    m = number_run_match(text, pos)
+    if m is None:
+        return None
+    run = m.group(1)
+    if encoding is not None:
+        run = run.decode(encoding)
+    end = m.end()
+    next_char = text[end:end+1]
+    if encoding is not None:
+        next_char = next_char.decode(encoding)
+    if next_char and next_char not in '/!' and (next_char in '=(%*' or run[-1] not in ' \t\r\n,'):
+        # the last "number" is part of something else, e.g. the name of the
+        # next variable or a value with a repeat count
+        run = run.rstrip(' \t\r\n,')
+        run = run[:max(run.rfind(c) for c in ' \t\r\n,') + 1]
+    run = run.rstrip(' \t\r\n,')
+    if _number_run_sep_re.search(run) is None:
+        return None
+    return NumberRun(run), m.start(1) + len(run.encode(encoding) if encoding is not None else run)
+
+
+class NumberRun(str):
+    """
+    The text of a run of plain numbers, e.g. `1.0, 2.5 3e4`, kept as a
+    single value so that it can be converted to an array in one go
+    """
+
+    def values(self):
+        # (null values between commas are skipped, as they are by `parse`)
+        return _number_run_sep_re.split(self)
+
+
+def line_number(text, offset):
+    """
+    Line number (starting at 1) of character `offset` in `text`
+    """
+    if not isinstance(text, str):
+        return bytes(text[:offset]).count(b'\n') + 1
+    return text.count('\n', 0, offset) + 1
+
+
+_subscript_int_re = re.compile(r'^\s*[+-]?\d+\s*$')
+
+
+def parse_subscript(subscript):
+    """
+    Parses the subscript of an array assignment, e.g. `3,2`, `1:50` or
+    `:,1:10:2`, into a tuple with an (zero-based) int or a python `slice`
+    for each dimension. Returns `None` if the subscript isn't understood.
+    """
+    parsed_subscript = []
+    for part in subscript.split(','):
+        if ':' not in part:
+            if not _subscript_int_re.match(part):
+                return None
+            parsed_subscript.append(int(part)-1) # python indexing starts at 0
+            continue
+
+        bounds = part.split(':')
+        if len(bounds) > 3:
+            return None
+        for b in bounds:
+            if b.strip() != '' and not _subscript_int_re.match(b):
+                return None
+        bounds = [int(b) if b.strip() else None for b in bounds] + [None]
+        start, stop, step = bounds[0], bounds[1], bounds[2] or 1
+
+        # fortran sections include the upper bound
+        if start is not None:
+            start -= 1
+        if stop is not None and step < 0:
+            stop = stop - 2 if stop >= 2 else None
+        parsed_subscript.append(slice(start, stop, step))
+
+    return tuple(parsed_subscript)
+
+
+def variable_key(variable_name, variable_index):
+    """
+    Returns the name a variable is stored under and its index for a variable
+    name and raw subscript text from an assignment. The index is a
+    (zero-based) int for a single element of a one-dimensional array and a
+    tuple as returned by `parse_subscript` for anything else.
+    """
+    if variable_index is None:
+        return variable_name, None
+    if variable_index.isdigit():
+        return variable_name, int(variable_index)-1 # python indexing starts at 0
+
+    subscript = parse_subscript(variable_index)
+    if subscript is None:
+        # keep a subscript that isn't understood as part of the name
+        return "%s(%s)" % (variable_name, variable_index), None
+    elif len(subscript) == 1 and not isinstance(subscript[0], slice):
+        return variable_name, subscript[0]
+    return variable_name, subscript
+
+
+_component_re = re.compile(r'^\s*%?\s*(\w+)\s*(?:\((.*)\))?\s*$')
+
+
+def component_path(variable_name, variable_index=None):
+    """
+    Splits the name of a derived type component, e.g. `domains(2)%dx` or
+    `physics%microphysics%nccn`, into a list of `(name, index)`, one for
+    each component, with the indices as returned by `variable_key`.
+    `variable_index` is the raw subscript of the last component. Returns
+    `None` if the name isn't understood.
+    """
+    path = []
+    parts = variable_name.split('%')
+    for n, part in enumerate(parts):
+        m = _component_re.match(part)
+        if m is None:
+            return None
+        name, subscript = m.groups()
+        if n == len(parts) - 1 and variable_index is not None:
+            if subscript is not None:
+                return None
+            subscript = variable_index
+        key, index = variable_key(name, subscript)
+        if key != name:
+            return None
+        path.append((name, index))
+    return path
+
+
+def tokenize(text, encoding=None):
+    """
+    Split `text` into a stream of `Token`s in a single pass.
+
+    If an `encoding` is given `text` is a bytes buffer (e.g. a memory mapped
+    file), which is matched directly and only the text of each token is
+    decoded.
+    """
+    pos = 0
+    end = len(text)
+    in_group = False
+
+    outside_re, inside_re = _outside_re, _inside_re
+    if encoding is not None:
+        outside_re, inside_re = _outside_bytes_re, _inside_bytes_re
+    inside_match = inside_re.match
+    token_kinds = _token_kinds
+
+    while pos < end:
+        if not in_group:
+            m = outside_re.match(text, pos)
+            kind = m.lastgroup
+            if kind == 'comment' or kind == 'group_start':
+                token_text = m.group(kind)
+                if encoding is not None:
+                    token_text = token_text.decode(encoding)
+                if kind == 'comment':
+                    yield Token(COMMENT, token_text, pos)
+                else:
+                    yield Token(GROUP_START, token_text, pos)
+                    in_group = True
+            pos = m.end()
+            continue
+
+        m = inside_match(text, pos)
+        if m is None:
+            if not text[pos:end].strip():
+                break
+            while text[pos:pos+1].isspace():
+                pos += 1
+            raise NamelistParseError("Unexpected character %r on line %d"
+                                     % (text[pos:pos+1], line_number(text, pos)))
+        kind = m.lastgroup
+
+        if kind == 'equals':
+            name = m.group('name')
+            index = m.group('index')
+            if encoding is not None:
+                name = name.decode(encoding)
+                if index is not None:
+                    index = index.decode(encoding)
+            if ' ' in name or '\t' in name or '\n' in name:
+                name = _name_space_re.sub('', name)
+            yield _new_token(Token, (NAME, name, m.start('name')))
+            if index is not None:
+                yield _new_token(Token, (INDEX, index.strip(), m.start('index') - 1))
+            yield _new_token(Token, (EQUALS, '=', m.start('equals')))
+        elif kind == 'stray_equals':
+            raise NamelistParseError("Missing variable name before '=' on line %d"
+                                     % line_number(text, m.start(kind)))
+        else:
+            token_text = m.group(kind)
+            if encoding is not None:
+                token_text = token_text.decode(encoding)
+            yield _new_token(Token, (token_kinds[kind], token_text, m.start(kind)))
+            if kind == 'group_end':
+                in_group = False
+        pos = m.end()
+
+    if in_group:
+        raise NamelistParseError("Namelist group is not terminated with '/'")
+
+
+def iter_group_spans(text):
+    """
+    Find the '&name ... /' group blocks in `text` without parsing their
+    contents, yielding `(group_name, start, end)` for each
+    """
+    pos = 0
+    while True:
+        m = _block_start_re.search(text, pos)
+        if m is None:
+            return
+        start = m.start()
+        if m.group() == '!':
+            newline = text.find('\n', start)
+            if newline < 0:
+                return
+            pos = newline + 1
+            continue
+
+        block = _group_block_re.match(text, start)
+        if block is not None:
+            yield block.group('name'), start, block.end()
+            pos = block.end()
+        elif start + 1 < len(text) and (text[start+1].isalnum() or text[start+1] == '_'):
+            raise NamelistParseError("Namelist group '%s' is not terminated with '/'"
+                                     % re.match(r'&(\w+)', text[start:]).group(1))
+        else:
+            pos = start + 1
+
+
+def iter_group_blocks(fileobj, chunk_size=65536):
+    """
+    Read `fileobj` in chunks and yield the text of each '&name ... /' group
+    block in turn, so that only a single group needs to be held in memory
+    """
+    for group_name, text in iter_file_pieces(fileobj, chunk_size):
+        if group_name is not None:
+            yield text
+
+
+def iter_file_pieces(fileobj, chunk_size=65536):
+    """
+    Read `fileobj` in chunks and yield `(group_name, text)` for each
+    '&name ... /' group block and (with `group_name` set to `None`) for the
+    text in between the groups. Joining the text of all pieces gives back
+    the whole file.
+    """
+    buf = ''
+    pos = 0
+    # start of the text in `buf` that hasn't been yielded yet
+    gap_start = 0
+    eof = False
+    read_size = chunk_size
+
+    while True:
+        m = _block_start_re.search(buf, pos)
+        if m is not None:
+            start = m.start()
+            if m.group() == '!':
+                newline = buf.find('\n', start)
+                if newline >= 0:
+                    pos = newline + 1
+                    continue
+            elif start + 1 < len(buf) and not (buf[start+1].isalnum() or buf[start+1] == '_'):
+                # a lone '&' outside of a group is ignored
+                pos = start + 1
+                continue
+            else:
+                block = _group_block_re.match(buf, start)
+                if block is not None:
+                    if start > gap_start:
+                        yield None, buf[gap_start:start]
+                    yield block.group('name'), block.group()
+                    pos = gap_start = block.end()
+                    read_size = chunk_size
+                    continue
+
+            if eof:
+                if m.group() == '&' and start + 1 < len(buf):
+                    raise NamelistParseError("Namelist group is not terminated with '/'")
+                break
+            # keep the incomplete comment or group and read some more, the
+            # amount read is doubled each time so that large groups aren't
+            # re-scanned too many times
+            if start > gap_start:
+                yield None, buf[gap_start:start]
+            buf = buf[start:]
+            read_size = max(read_size, len(buf))
+        elif eof:
+            break
+        else:
+            if len(buf) > gap_start:
+                yield None, buf[gap_start:]
+            buf = ''
+
+        pos = gap_start = 0
+        data = fileobj.read(read_size)
+        if not data:
+            eof = True
+            # make sure a trailing comment is terminated
+            data = '\n'
+        buf += data
+
+    # the rest of the file, without the newline added at the end
+    if len(buf) - 1 > gap_start:
+        yield None, buf[gap_start:-1]
+
+
+def parse(tokens):
+    """
+    Assemble a token stream into groups, yielding for each group a tuple of
+    `(group_name, assignments)`, where `assignments` is a list of
+    `(variable_name, index, values)` with `index` being the raw subscript
+    text (or `None`) and `values` the list of raw value strings.
+    """
+    group_name = None
+    assignments = None
+    values = None
+
+    for kind, text, offset in tokens:
+        if kind == VALUE:
+            if values is None:
+                raise NamelistParseError("Value %s is not assigned to any variable in group '%s'"
+                                         % (text, group_name))
+            values.append(text)
+        elif kind == NAME:
+            values = []
+            assignments.append([text, None, values])
+        elif kind == INDEX:
+            assignments[-1][1] = text
+        elif kind == GROUP_START:
+            group_name = text
+            assignments = []
+            values = None
+        elif kind == GROUP_END:
+            yield group_name, [tuple(a) for a in assignments]
+            group_name = None
+            assignments = None
+            values = None
+
+
+def parse_text(text, encoding=None, number_runs=False):
+    """
+    Same as `parse(tokenize(text, encoding))`, but builds the assignments
+    straight from the matches without making a token for each of them, for
+    when the tokens themselves (i.e. the layout) aren't needed.
+
+    With `number_runs` the values of a variable that are all plain numbers
+    are given as a single `NumberRun` rather than a string for each number.
+    """
+    pos = 0
+    end = len(text)
+    group_name = None
+
+    outside_re, inside_re = _outside_re, _inside_re
+    if encoding is not None:
+        outside_re, inside_re = _outside_bytes_re, _inside_bytes_re
+    outside_match = outside_re.match
+    inside_match = inside_re.match
+    number_run_match = (_number_run_re if encoding is None else _number_run_bytes_re).match
+
+    while pos < end:
+        if group_name is None:
+            m = outside_match(text, pos)
+            pos = m.end()
+            if m.lastgroup == 'group_start':
+                group_name = m.group('group_start')
+                if encoding is not None:
+                    group_name = group_name.decode(encoding)
+                assignments = []
+                values = None
+            continue
+
+        m = inside_match(text, pos)
+        if m is None:
+            if not text[pos:end].strip():
+                break
+            while text[pos:pos+1].isspace():
+                pos += 1
+            raise NamelistParseError("Unexpected character %r on line %d"
+                                     % (text[pos:pos+1], line_number(text, pos)))
+        pos = m.end()
+        kind = m.lastgroup
+
+        if kind == 'word' or kind == 'string' or kind == 'paren' or kind == 'repeat':
+            value = m.group(kind)
+            if encoding is not None:
+                value = value.decode(encoding)
+            if values is None:
+                raise NamelistParseError("Value %s is not assigned to any variable in group '%s'"
+                                         % (value, group_name))
+            if number_runs and values and values[0].__class__ is NumberRun:
+                # the numbers are followed by other values
+                values[:] = values[0].values()
+            values.append(value)
+        elif kind == 'equals':
+            name, index = m.group('name', 'index')
+            if encoding is not None:
+                name = name.decode(encoding)
+                if index is not None:
+                    index = index.decode(encoding)
+            if ' ' in name or '\t' in name or '\n' in name:
+                name = _name_space_re.sub('', name)
+            if index is not None:
+                index = index.strip()
+            values = []
+            assignments.append((name, index, values))
+            if number_runs:
+                run = _number_run(text, pos, encoding, number_run_match)
+                if run is not None:
+                    values.append(run[0])
+                    pos = run[1]
+        elif kind == 'group_end':
+            yield group_name, assignments
+            group_name = None
+        elif kind == 'stray_equals':
+            raise NamelistParseError("Missing variable name before '=' on line %d"
+                                     % line_number(text, m.start(kind)))
+
+    if group_name is not None:
+        raise NamelistParseError("Namelist group is not terminated with '/'")
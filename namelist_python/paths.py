@@ -0,0 +1,125 @@
+"""
+Access to (nested) variables by path, e.g. `GROUP.physics%microphysics%nccn`
+or `GROUP.domains(2)%dx`.
+
+A path is parsed once into the list of keys (names and zero-based indices)
+leading to the variable, and the result is cached, so that repeatedly
+reading or writing the same path is only a walk over the keys.
+"""
+from .parser import component_path
+
+# compiled paths, emptied when it grows beyond `_max_compiled_paths`
+_compiled_paths = {}
+_max_compiled_paths = 1024
+
+
+class ComponentPath(object):
+    """
+    Path to a variable (or a derived type component) in a mapping of groups
+    """
+    __slots__ = ('path', 'keys')
+
+    def __init__(self, path, keys):
+        self.path = path
+        self.keys = keys
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def designator(self):
+        """
+        Returns the group name and the name of the variable as it would be
+        written in an assignment, e.g. `('GROUP', 'domains(2)%dx')`
+        """
+        parts = []
+        subscript = []
+        for key in self.keys[1:]:
+            if isinstance(key, int):
+                subscript.append("%d" % (key+1))
+                continue
+            if subscript:
+                parts[-1] += "(%s)" % ",".join(subscript)
+                subscript = []
+            parts.append(key)
+        if subscript:
+            parts[-1] += "(%s)" % ",".join(subscript)
+        return self.keys[0], "%".join(parts)
+
+    def parent(self, groups):
+        """
+        Returns the dict (or list) holding the variable the path points to
+        """
+        obj = groups
+        for key in self.keys[:-1]:
+            obj = obj[key]
+        return obj
+
+    def get(self, groups):
+        obj = groups
+        for key in self.keys:
+            obj = obj[key]
+        return obj
+
+    def set(self, groups, value):
+        self.parent(groups)[self.keys[-1]] = value
+
+    def bind(self, groups):
+        return BoundPath(self, groups)
+
+
+class BoundPath(object):
+    """
+    A `ComponentPath` resolved against a mapping of groups. The dict (or
+    list) holding the variable is only looked up once, so reads and writes
+    are a single lookup. It isn't looked up again if a group or a component
+    on the way to the variable is replaced, call `rebind` after doing so.
+    """
+    __slots__ = ('component_path', 'groups', '_parent', '_key')
+
+    def __init__(self, component_path, groups):
+        self.component_path = component_path
+        self.groups = groups
+        self.rebind()
+
+    def rebind(self):
+        self._parent = self.component_path.parent(self.groups)
+        self._key = self.component_path.keys[-1]
+
+    def get(self):
+        return self._parent[self._key]
+
+    def set(self, value):
+        self._parent[self._key] = value
+
+
+def compile_path(path):
+    """
+    Parses `path`, the group name followed by the variable, separated by
+    '.' or '%' (e.g. `GROUP.physics%microphysics%nccn`), into a
+    `ComponentPath`. Raises `ValueError` if the path isn't understood.
+    """
+    compiled = _compiled_paths.get(path)
+    if compiled is not None:
+        return compiled
+
+    keys = []
+    for part in path.split('.'):
+        components = component_path(part)
+        if components is None:
+            raise ValueError("The path '%s' isn't understood" % path)
+        for name, index in components:
+            keys.append(name)
+            if isinstance(index, tuple):
+                if any(isinstance(i, slice) for i in index):
+                    raise ValueError("Array sections aren't supported in paths: '%s'" % path)
+                keys.extend(index)
+            elif index is not None:
+                keys.append(index)
+
+    if len(keys) < 2:
+        raise ValueError("The path '%s' should contain both a group and a variable name" % path)
+
+    if len(_compiled_paths) >= _max_compiled_paths:
+        _compiled_paths.clear()
+    compiled = _compiled_paths[path] = ComponentPath(path, tuple(keys))
+    return compiled
@@ -0,0 +1,405 @@
+"""
+Validation of namelists against a declarative schema.
+
+A schema gives for each group the variables it may contain, with their type
+and optionally their shape, bounds, allowed values and default:
+
+    schema = Schema({
+        'ATHAM_SETUP': {
+            'dt': {'type': 'real', 'min': 0., 'default': 1.},
+            'nsteps': {'type': 'integer', 'required': True},
+            'levels': {'type': 'real', 'shape': 50},
+            'scheme': {'type': 'character', 'choices': ['kessler', 'seifert']},
+            'physics%nccn': 'integer',
+        },
+    })
+
+The spec is compiled once into a validator for each group. When a namelist
+is parsed with a schema the values of the variables in it are converted
+straight to the declared type, rather than guessing the type of each value.
+"""
+import re
+import copy
+from collections import namedtuple
+
+from .parser import NamelistParseError, line_number, variable_key, component_path
+from .values import NoSingleValueFoundException, _number_re, _logical_values, _parse_string, _parse_complex
+from .arrays import is_numpy_array, is_nd_array, is_type_array, fortran_order, RunLengthArray, SparseArray
+from .document import _designator, _flatten_components
+
+TYPES = ('integer', 'real', 'logical', 'character', 'complex')
+
+_spec_keys = ('type', 'shape', 'min', 'max', 'choices', 'default', 'required')
+
+
+class ValidationError(namedtuple('ValidationError', ['group', 'variable', 'line', 'message'])):
+    """
+    A single problem with a namelist, `variable` is `None` for problems with
+    a whole group and `line` is `None` if it isn't known
+    """
+
+    def __str__(self):
+        where = "group '%s'" % self.group
+        if self.variable is not None:
+            where += ", variable '%s'" % self.variable
+        if self.line is not None:
+            where += " (line %d)" % self.line
+        return "%s: %s" % (where, self.message)
+
+
+class SchemaValidationError(NamelistParseError):
+    """
+    Raised when a namelist doesn't match its schema, with the list of
+    `ValidationError`s as `errors`
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        NamelistParseError.__init__(self, "\n".join(str(e) for e in errors))
+
+
+# conversion of the raw value strings of an assignment to a declared type,
+# these raise an exception for values that aren't of the type. Numbers are
+# checked against the same grammar as without a schema first, as python
+# also understands e.g. `nan` or `1_000`.
+
+_integer_re = re.compile(r'^[+-]?\d+$')
+
+def _check_number(value_str, number_re):
+    if number_re.match(value_str) is None:
+        raise NoSingleValueFoundException(value_str)
+    return value_str
+
+def _convert_integer(value_strs):
+    return [int(_check_number(v, _integer_re)) for v in value_strs]
+
+def _convert_real(value_strs):
+    return [float(_check_number(v, _number_re).replace('d', 'e').replace('D', 'e')) for v in value_strs]
+
+def _convert_logical(value_strs):
+    return [_logical_values[v.lower()] for v in value_strs]
+
+def _convert_character(value_strs):
+    return [_parse_string(v) for v in value_strs]
+
+def _convert_complex(value_strs):
+    return [_parse_complex(v) for v in value_strs]
+
+_converters = {
+    'integer': _convert_integer,
+    'real': _convert_real,
+    'logical': _convert_logical,
+    'character': _convert_character,
+    'complex': _convert_complex,
+}
+
+CONVERSION_ERRORS = (ValueError, KeyError, NoSingleValueFoundException)
+
+# arrays of these types are stored as numpy arrays with the numpy backend
+_numpy_dtypes = {
+    'integer': 'int64',
+    'real': 'float64',
+    'logical': 'bool',
+    'complex': 'complex128',
+}
+
+_python_types = {
+    'integer': (int,),
+    'real': (float, int),
+    'logical': (bool,),
+    'character': (str,),
+    'complex': (complex, float, int),
+}
+
+_numpy_kinds = {
+    'integer': 'iu',
+    'real': 'fiu',
+    'logical': 'b',
+    'character': 'US',
+    'complex': 'cfiu',
+}
+
+
+def _is_of_type(value, type_name):
+    if type_name != 'logical' and isinstance(value, bool):
+        return False
+    return isinstance(value, _python_types[type_name])
+
+
+def _coerce(value, type_name):
+    if type_name == 'real':
+        return float(value)
+    elif type_name == 'complex':
+        return complex(value)
+    return value
+
+
+def _elements(value):
+    """
+    Returns the shape of `value` (`None` for scalars) and its elements
+    """
+    if isinstance(value, (RunLengthArray, SparseArray)):
+        return (len(value),), [v for v in value if v is not None]
+    elif is_nd_array(value):
+        shape, flat = fortran_order(value)
+        return tuple(shape), flat
+    elif is_numpy_array(value):
+        return value.shape, value
+    elif isinstance(value, list):
+        return (len(value),), value
+    return None, [value]
+
+
+def _compile_variable(group_name, variable_name, spec):
+    """
+    Returns a function checking the value of a single variable, which
+    returns a list of error messages and the (possibly coerced) value
+    """
+    if not isinstance(spec, dict):
+        spec = {'type': spec}
+    unknown = [k for k in spec if k not in _spec_keys]
+    if unknown:
+        raise ValueError("Unknown keys %s in the schema of '%s' in group '%s'"
+                         % (", ".join(sorted(unknown)), variable_name, group_name))
+    type_name = spec.get('type')
+    if type_name is not None and type_name not in TYPES:
+        raise ValueError("Type '%s' of '%s' in group '%s' not understood, should be one of %s"
+                         % (type_name, variable_name, group_name, ", ".join(TYPES)))
+    shape = spec.get('shape')
+    if isinstance(shape, int):
+        shape = (shape,)
+    elif shape is not None:
+        shape = tuple(shape)
+    lower, upper, choices = spec.get('min'), spec.get('max'), spec.get('choices')
+
+    def check(value):
+        errors = []
+        value_shape, elements = _elements(value)
+
+        if shape is None and value_shape is not None:
+            errors.append("expected a single value, got an array of %d values" % len(elements))
+        elif shape is not None and value_shape != shape:
+            if value_shape is None:
+                errors.append("expected an array of shape %s, got a single value" % (shape,))
+            else:
+                errors.append("expected an array of shape %s, got %s" % (shape, value_shape))
+
+        if type_name is not None:
+            if is_numpy_array(elements):
+                if elements.dtype.kind not in _numpy_kinds[type_name]:
+                    errors.append("expected %s values, got %s" % (type_name, elements.dtype))
+                    return errors, value
+            else:
+                wrong = [v for v in elements if not _is_of_type(v, type_name)]
+                if wrong:
+                    errors.append("expected %s values, got %r" % (type_name, wrong[0]))
+                    return errors, value
+                if type_name in ('real', 'complex') and value_shape is None:
+                    value = _coerce(value, type_name)
+                elif type_name in ('real', 'complex') and isinstance(value, list) and not is_nd_array(value):
+                    value = [_coerce(v, type_name) for v in value]
+
+        if len(elements) and (lower is not None or upper is not None):
+            if is_numpy_array(elements):
+                smallest, largest = elements.min(), elements.max()
+            else:
+                smallest, largest = min(elements), max(elements)
+            if lower is not None and smallest < lower:
+                errors.append("%r is smaller than the minimum %r" % (smallest, lower))
+            if upper is not None and largest > upper:
+                errors.append("%r is larger than the maximum %r" % (largest, upper))
+
+        if choices is not None:
+            wrong = [v for v in elements if v not in choices]
+            if wrong:
+                errors.append("%r is not one of %s" % (wrong[0], ", ".join(repr(c) for c in choices)))
+        return errors, value
+
+    return check, type_name, spec.get('default'), 'default' in spec, spec.get('required', False)
+
+
+class GroupValidator(object):
+    """
+    Compiled schema of a single group
+    """
+
+    def __init__(self, group_name, spec, allow_unknown):
+        self.group_name = group_name
+        self.allow_unknown = allow_unknown
+        self.variables = {}
+        # typed converters for the raw values of variables, by variable name
+        self.converters = {}
+        for variable_name, variable_spec in spec.items():
+            compiled = _compile_variable(group_name, variable_name, variable_spec)
+            self.variables[variable_name] = compiled
+            type_name = compiled[1]
+            if type_name is not None and '%' not in variable_name:
+                self.converters[variable_name] = (_converters[type_name], _numpy_dtypes.get(type_name), type_name)
+
+    def validate(self, group_name, group, coerce, set_value, locate):
+        """
+        Returns the list of `ValidationError`s for the variables in `group`,
+        with derived type components given by their full name. With
+        `coerce` values are converted to the declared type with
+        `set_value(variable_name, value)`, which also sets missing variables
+        to their default. `locate(variable_name)` returns the line a
+        variable is assigned on.
+        """
+        errors = []
+        for variable_name, value in group.items():
+            compiled = self.variables.get(variable_name)
+            if compiled is None and '(' in variable_name:
+                # component of an element of an array of derived types
+                compiled = self.variables.get(_element_re.sub('%', variable_name))
+            if compiled is None:
+                if not self.allow_unknown:
+                    errors.append(ValidationError(group_name, variable_name, locate(variable_name),
+                                                  "unknown variable"))
+                continue
+            messages, coerced = compiled[0](value)
+            errors += [ValidationError(group_name, variable_name, locate(variable_name), m) for m in messages]
+            if coerce and not messages and coerced is not value:
+                set_value(variable_name, coerced)
+
+        for variable_name, (check, type_name, default, has_default, required) in self.variables.items():
+            if variable_name in group or '(' in variable_name:
+                continue
+            if required:
+                errors.append(ValidationError(group_name, variable_name, locate(None),
+                                              "required variable is missing"))
+            elif coerce and has_default:
+                set_value(variable_name, copy.deepcopy(default))
+        return errors
+
+
+class Schema(object):
+    """
+    Schema compiled from `spec`, a dict of group name to a dict of variable
+    name to either the type of the variable (one of 'integer', 'real',
+    'logical', 'character' or 'complex') or a dict with any of `type`,
+    `shape` (the length of an array, or a tuple for multi-dimensional
+    arrays), `min`, `max`, `choices`, `default` and `required`. Components
+    of derived types are given by their full name, e.g. `physics%nccn` or
+    `domains%dx` for all elements of an array of derived types. Groups and
+    variables that aren't in the schema are errors, unless `allow_unknown`
+    is set.
+    """
+
+    def __init__(self, spec, allow_unknown=False):
+        self.spec = spec
+        self.allow_unknown = allow_unknown
+        self.groups = dict((group_name, GroupValidator(group_name, group_spec, allow_unknown))
+                           for group_name, group_spec in spec.items())
+
+    def __reduce__(self):
+        # the compiled validators are made again rather than pickled
+        return (Schema, (self.spec, self.allow_unknown))
+
+    def converters(self, group_name):
+        """
+        Returns `{variable name: (converter, numpy dtype, type name)}` for
+        the variables of a group that have a type, where the converter turns
+        a list of raw value strings into values of that type
+        """
+        validator = self.groups.get(group_name)
+        return None if validator is None else validator.converters
+
+    def validate_group(self, namelist, schema_name, group_name, group, coerce=False, locate=None):
+        """
+        Returns the list of `ValidationError`s for a single group of
+        `namelist`, checked against the group `schema_name` of the schema
+        """
+        if locate is None:
+            locate = _no_line
+        validator = self.groups.get(schema_name)
+        if validator is None:
+            if self.allow_unknown:
+                return []
+            return [ValidationError(group_name, None, locate(None), "unknown group")]
+
+        def set_value(variable_name, value):
+            variables, name = namelist._patch_component(group, variable_name)
+            variables[name] = value
+
+        if any(isinstance(v, dict) or is_type_array(v) for v in group.values()):
+            variables = _flatten_components(group)
+        else:
+            variables = group
+        return validator.validate(group_name, variables, coerce, set_value, locate)
+
+    def validate(self, namelist, coerce=False):
+        """
+        Returns the list of `ValidationError`s for `namelist`. With `coerce`
+        values are converted to their declared type (e.g. integers given for
+        a real) and missing variables are set to their default. Errors only
+        have line numbers if the namelist was parsed with `preserve_layout`.
+        """
+        layouts = {}
+        if namelist._document is not None:
+            layouts = dict((layout.key, layout) for layout in namelist._document.groups)
+
+        errors = []
+        for group_name, group in namelist.groups.items():
+            schema_name = namelist.group_name(group_name)
+            layout = layouts.get(group_name)
+            locate = _no_line if layout is None else locator(namelist._document.text, layout)
+            errors += self.validate_group(namelist, schema_name, group_name, group, coerce, locate)
+        return errors
+
+    def validate_file(self, filename, array_backend='list'):
+        """
+        Parses and validates the file `filename`, returning the list of
+        `ValidationError`s, which includes an error parsing the file
+        """
+        from .namelist import read_namelist_file
+        try:
+            read_namelist_file(filename, array_backend=array_backend, schema=self)
+        except SchemaValidationError as e:
+            return e.errors
+        except (NamelistParseError, NoSingleValueFoundException) as e:
+            return [ValidationError(None, None, None, "%s" % e)]
+        return []
+
+
+_element_re = re.compile(r'\(\d+\)%')
+
+
+def _no_line(variable_name):
+    return None
+
+
+def locator(text, layout):
+    """
+    Returns a function giving the line in `text` on which a variable of the
+    group at `layout` is first assigned, or the line the group starts on for
+    `None`
+    """
+    def locate(variable_name):
+        if variable_name is not None:
+            for assignment in layout.assignments:
+                if '%' in assignment.variable_name:
+                    path = component_path(assignment.variable_name, assignment.index)
+                    if path is None:
+                        continue
+                    name = _designator(path[:-1] + [(path[-1][0], None)])
+                else:
+                    name = variable_key(assignment.variable_name, assignment.index)[0]
+                if name == variable_name:
+                    return line_number(text, assignment.start)
+        return line_number(text, layout.start)
+    return locate
+
+
+def _validate_one(args):
+    path, schema, array_backend = args
+    return path, schema.validate_file(path, array_backend)
+
+
+def validate_files(paths, schema, workers=None, executor='process', array_backend='list'):
+    """
+    Validates all files in `paths` against `schema` on `workers` processes
+    (or threads), returning a list of `(path, errors)` in the same order as
+    `paths`
+    """
+    from .batch import map_files
+    return map_files(_validate_one, [(path, schema, array_backend) for path in paths], workers, executor)
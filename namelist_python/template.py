@@ -0,0 +1,170 @@
+"""
+Rendering of many variants (e.g. ensemble members) of a namelist that only
+differ in the values of a few parameters.
+
+The base namelist is formatted once into static pieces of text with holes
+for the parameters, rendering a member then only formats the values of the
+parameters and joins the pieces.
+"""
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+
+from .arrays import is_type_array
+from .batch import check_executor, cpu_count, pool_map
+from .paths import compile_path
+
+
+class NamelistTemplate(object):
+    """
+    Template made from the `Namelist` `namelist` in which the variables in
+    `parameters`, given as paths (e.g. `GROUP.dt` or
+    `GROUP.physics%microphysics%nccn`), are replaced when rendering.
+    Parameters that aren't in the namelist yet are added to the end of
+    their group. Members are written in the same format as `Namelist.dump`
+    with `array_inline` and `values_per_line`.
+    """
+
+    def __init__(self, namelist, parameters, array_inline=True, values_per_line=None):
+        self.namelist = namelist
+        self.array_inline = array_inline
+        self.values_per_line = values_per_line
+
+        # group name -> {variable name: parameter}
+        holes = OrderedDict()
+        for parameter in parameters:
+            group_name, variable_name = compile_path(parameter).designator()
+            if group_name not in namelist.groups:
+                raise ValueError("The group of parameter '%s' isn't in the namelist" % parameter)
+            if variable_name[-1] == ')':
+                raise ValueError("Parameters must be whole variables, not array elements: '%s'" % parameter)
+            holes.setdefault(group_name, OrderedDict())[variable_name] = parameter
+
+        # the text between the holes, there is one more piece than there are
+        # holes
+        self._static = []
+        self._holes = []
+        self._defaults = []
+        self._pieces = []
+        for group_name, group in namelist.groups.items():
+            group_holes = holes.get(group_name, {})
+            self._pieces.append("&%s\n" % namelist.group_name(group_name))
+            for variable_name, variable_value in group.items():
+                self._add_variable(variable_name, variable_value, group_holes)
+            # parameters that are new to the group
+            added = set(parameter for parameter, _ in self._holes)
+            for variable_name, parameter in group_holes.items():
+                if parameter not in added:
+                    self._add_hole(variable_name, parameter, None)
+            self._pieces.append("/\n")
+        self._static.append("".join(self._pieces))
+        del self._pieces
+
+        self._index = dict((parameter, n) for n, (parameter, _) in enumerate(self._holes))
+
+    @property
+    def parameters(self):
+        return [parameter for parameter, variable_name in self._holes]
+
+    def _add_variable(self, variable_name, variable_value, group_holes):
+        if variable_name in group_holes:
+            self._add_hole(variable_name, group_holes[variable_name], variable_value)
+            return
+        elif any(h.startswith(variable_name + '%') or h.startswith(variable_name + '(') for h in group_holes):
+            # derived type with some of its components as parameters
+            if isinstance(variable_value, dict):
+                for component_name, component_value in variable_value.items():
+                    self._add_variable("%s%%%s" % (variable_name, component_name), component_value, group_holes)
+                return
+            elif is_type_array(variable_value):
+                for n, element in enumerate(variable_value):
+                    self._add_variable("%s(%d)" % (variable_name, n+1), element, group_holes)
+                return
+        self.namelist._dump_variable(self._pieces.append, variable_name, variable_value,
+                                     self.array_inline, self.values_per_line)
+
+    def _add_hole(self, variable_name, parameter, default):
+        self._pieces.append("  ")
+        self._static.append("".join(self._pieces))
+        self._pieces = ["\n"]
+        self._holes.append((parameter, variable_name))
+        if default is None:
+            # a new variable, only written when it's given a value
+            self._defaults.append(None)
+        else:
+            self._defaults.append(self._format(variable_name, default))
+
+    def _format(self, variable_name, value):
+        return self.namelist._format_assignment(variable_name, value, self.array_inline, self.values_per_line)
+
+    def render_pieces(self, values):
+        """
+        Returns the list of pieces of text of the namelist with the
+        parameters set to `values`, a dict of parameter to value.
+        Parameters that aren't in `values` keep the value of the base
+        namelist.
+        """
+        formatted = list(self._defaults)
+        for parameter, value in values.items():
+            n = self._index.get(parameter)
+            if n is None:
+                raise ValueError("'%s' isn't a parameter of the template" % parameter)
+            formatted[n] = self._format(self._holes[n][1], value)
+
+        static = self._static
+        pieces = [static[0]]
+        for n, f in enumerate(formatted):
+            if f is None:
+                # parameter without a value that isn't in the base namelist
+                # either, drop the indentation and newline around it
+                pieces[-1] = pieces[-1][:-2]
+                pieces.append(static[n+1][1:])
+            else:
+                pieces.append(f)
+                pieces.append(static[n+1])
+        return pieces
+
+    def render(self, values):
+        return "".join(self.render_pieces(values))
+
+    def render_to(self, fileobj, values):
+        fileobj.write(self.render(values))
+
+    def write_members(self, members, filenames, workers=1, executor='process'):
+        """
+        Renders every member in `members` (each a dict of parameter to value)
+        and writes it to a file. `filenames` is either a list with a file
+        name for each member, or a pattern with the member number (starting
+        at 0), e.g. `'member_%03d.nml'`. With `workers` other than 1 the
+        members are written on a pool of processes (or threads if
+        `executor='thread'`), by default as many as there are CPUs. Returns
+        the file names written.
+        """
+        check_executor(executor)
+        members = list(members)
+        if isinstance(filenames, str):
+            filenames = [filenames % n for n in range(len(members))]
+        else:
+            filenames = list(filenames)
+        if len(filenames) != len(members):
+            raise ValueError("A file name is needed for each of the %d members" % len(members))
+
+        if workers is None:
+            workers = cpu_count()
+        if workers == 1 or len(members) <= 1:
+            _write_members((self, members, filenames))
+            return filenames
+
+        # each worker is sent the template together with a batch of members
+        n_batches = min(len(members), workers*4)
+        batches = [(self, members[n::n_batches], filenames[n::n_batches]) for n in range(n_batches)]
+        pool_map(_write_members, batches, workers, executor)
+        return filenames
+
+
+def _write_members(args):
+    template, members, filenames = args
+    for values, filename in zip(members, filenames):
+        with open(filename, 'w') as f:
+            f.writelines(template.render_pieces(values))
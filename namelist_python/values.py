@@ -0,0 +1,138 @@
+"""
+Conversion of single namelist value tokens into Python values.
+
+The type of a value is decided from its first character (and the shape of
+the token where that isn't enough) rather than by trying one conversion
+after another and catching the exceptions.
+"""
+import re
+
+
+class NoSingleValueFoundException(Exception):
+    pass
+
+
+# at least one digit is required, either before or after the decimal point
+_number_re = re.compile(r'^[+-]?(?=\.?\d)\d*(\.\d*)?([eEdD][+-]?\d+)?$')
+_complex_re = re.compile(r'^\(\s*([^,\s]+)\s*,\s*([^)\s]+)\s*\)$')
+
+_logical_values = {
+    't': True, '.t.': True, '.t': True, '.true.': True, 'true': True,
+    'f': False, '.f.': False, '.f': False, '.false.': False, 'false': False,
+}
+
+
+def _parse_number(value_str):
+    if value_str.isdigit():
+        return int(value_str)
+
+    m = _number_re.match(value_str)
+    if m is None:
+        raise NoSingleValueFoundException(value_str)
+    fraction, exponent = m.groups()
+    if fraction is None and exponent is None:
+        return int(value_str)
+    if exponent is not None and exponent[0] in 'dD':
+        # double precision exponent, e.g. 1.0d-3
+        value_str = value_str.replace('d', 'e').replace('D', 'e')
+    return float(value_str)
+
+
+def _parse_logical(value_str):
+    parsed_value = _logical_values.get(value_str.lower())
+    if parsed_value is None:
+        raise NoSingleValueFoundException(value_str)
+    return parsed_value
+
+
+def _parse_dot(value_str):
+    # either a logical, e.g. `.true.`, or a real, e.g. `.5`
+    if len(value_str) > 1 and value_str[1].isalpha():
+        return _parse_logical(value_str)
+    return _parse_number(value_str)
+
+
+def _parse_string(value_str):
+    quote = value_str[0]
+    if len(value_str) < 2 or value_str[-1] != quote:
+        raise NoSingleValueFoundException(value_str)
+    # quotes inside the string are escaped by doubling them
+    return value_str[1:-1].replace(quote*2, quote)
+
+
+def _parse_complex(value_str):
+    m = _complex_re.match(value_str)
+    if m is None:
+        raise NoSingleValueFoundException(value_str)
+    real, imag = m.groups()
+    return complex(float(_parse_number(real)), float(_parse_number(imag)))
+
+
+def _parse_unknown(value_str):
+    raise NoSingleValueFoundException(value_str)
+
+
+_parsers = dict.fromkeys('0123456789+-', _parse_number)
+_parsers.update(dict.fromkeys('tTfF', _parse_logical))
+_parsers['.'] = _parse_dot
+_parsers["'"] = _parse_string
+_parsers['"'] = _parse_string
+_parsers['('] = _parse_complex
+
+
+def parse_value(value_str):
+    """
+    Parses a single value, raises `NoSingleValueFoundException` if the value
+    isn't an integer, real, complex number, logical or quoted string
+    """
+    if not value_str:
+        raise NoSingleValueFoundException(value_str)
+    return _parsers.get(value_str[0], _parse_unknown)(value_str)
+
+
+def split_repeat(value_str):
+    """
+    Splits a value with a repeat count, `r*c`, into `(r, c)`. For values
+    without a repeat count `None` is returned.
+    """
+    if value_str[0].isdigit() and '*' in value_str:
+        count, _, value_str = value_str.partition('*')
+        if count.isdigit():
+            return int(count), value_str
+    return None
+
+
+def has_repeat_count(value_strs):
+    for value_str in value_strs:
+        if '*' in value_str and value_str[0].isdigit():
+            return True
+    return False
+
+
+def parse_runs(value_strs):
+    """
+    Parses a list of values, some of which may have repeat counts, into runs
+    of `[count, value]`. Null values (`r*`) are given the value `None`.
+    """
+    runs = []
+    for value_str in value_strs:
+        repeat = split_repeat(value_str)
+        if repeat is None:
+            runs.append([1, parse_value(value_str)])
+        else:
+            count, value_str = repeat
+            runs.append([count, parse_value(value_str) if value_str else None])
+    return runs
+
+
+def parse_values(value_strs):
+    """
+    Parses a list of values, expanding any repeat counts
+    """
+    if not has_repeat_count(value_strs):
+        return [parse_value(v) for v in value_strs]
+
+    parsed_values = []
+    for count, value in parse_runs(value_strs):
+        parsed_values.extend([value]*count)
+    return parsed_values
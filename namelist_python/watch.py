@@ -0,0 +1,230 @@
+"""
+Watching namelist files for changes and keeping parsed namelists up to
+date.
+
+Files are polled for changes to their modification time or size. When a
+file has changed only the '&name ... /' blocks whose text differs (by their
+hash) are parsed again, and swapped into the `groups` of the namelist in
+place, so that references to the namelist stay valid. Subscribers are then
+told what changed, group by group and variable by variable:
+
+    watcher = NamelistWatcher(interval=0.5)
+    namelist = watcher.watch('SIM_CONFIG.nl')
+    watcher.subscribe(lambda filename, changes: print(filename, changes))
+    watcher.start()
+"""
+import os
+import hashlib
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from utils import OrderedDict
+
+from .parser import iter_group_spans
+from .namelist import Namelist, LazyGroups, group_keys
+from .diff import diff_variables
+
+
+def _group_hashes(text):
+    """
+    Returns `(group_name, hash, start, end)` for each group block in `text`
+    """
+    return [(group_name, hashlib.sha1(text[start:end].encode('utf-8')).hexdigest(), start, end)
+            for group_name, start, end in iter_group_spans(text)]
+
+
+class _WatchedFile(object):
+    __slots__ = ('namelist', 'stamp', 'hashes')
+
+    def __init__(self, namelist, stamp, hashes):
+        self.namelist = namelist
+        self.stamp = stamp
+        # `(group key, hash)` of each group block, in order
+        self.hashes = hashes
+
+
+def _stamp(filename):
+    # the modification time in nanoseconds where available, as a float it
+    # can miss a change made shortly after the last one
+    stat = os.stat(filename)
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size
+
+
+class NamelistWatcher(object):
+    """
+    Keeps the namelists parsed from a set of local files up to date. Files
+    are checked by calling `poll`, or every `interval` seconds on a
+    background thread after calling `start`. Subscribers are then called
+    from that thread.
+    """
+
+    def __init__(self, interval=1.0, array_backend='list'):
+        self.interval = interval
+        self.array_backend = array_backend
+        # the last error reading each file, until it is read successfully
+        self.errors = {}
+        self._files = OrderedDict()
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def watch(self, filename, namelist=None):
+        """
+        Starts watching the file `filename`, returning the namelist that is
+        kept up to date. An existing `namelist` that was parsed from the
+        file can be given, otherwise the file is parsed.
+        """
+        filename = os.path.abspath(filename)
+        with self._lock:
+            stamp = _stamp(filename)
+            with open(filename, 'r') as f:
+                text = f.read()
+            if namelist is None:
+                namelist = Namelist(text, array_backend=self.array_backend)
+            elif namelist._document is not None or isinstance(namelist.groups, LazyGroups):
+                raise ValueError("Namelists that are lazily parsed or preserve their layout can't be watched")
+            blocks = _group_hashes(text)
+            keys = group_keys([group_name for group_name, _, _, _ in blocks])
+            hashes = [(key, h) for key, (_, h, _, _) in zip(keys, blocks)]
+            self._files[filename] = _WatchedFile(namelist, stamp, hashes)
+            return namelist
+
+    def unwatch(self, filename):
+        with self._lock:
+            del self._files[os.path.abspath(filename)]
+
+    def namelist(self, filename):
+        return self._files[os.path.abspath(filename)].namelist
+
+    def subscribe(self, callback, filename=None, group_name=None):
+        """
+        Calls `callback(filename, changes)` whenever a watched file (or only
+        `filename`) changes, with `changes` as returned by `Namelist.diff`:
+        an ordered dict of group key to either `None` for removed groups or
+        an ordered dict of variable name to `Change`. With `group_name`
+        only changes to that group are passed on.
+        """
+        if filename is not None:
+            filename = os.path.abspath(filename)
+        with self._lock:
+            self._subscribers.append((callback, filename, group_name))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[0] is not callback]
+
+    def poll(self):
+        """
+        Checks all watched files for changes, updating their namelists and
+        notifying the subscribers. Returns a dict of file name to the
+        changes for the files that changed.
+        """
+        changed = OrderedDict()
+        with self._lock:
+            for filename, watched in list(self._files.items()):
+                try:
+                    stamp = _stamp(filename)
+                    if stamp == watched.stamp:
+                        continue
+                    watched.stamp = stamp
+                    with open(filename, 'r') as f:
+                        text = f.read()
+                    changes = self._update(watched, text)
+                except Exception as e:
+                    # e.g. a file that is being written, it is read again
+                    # the next time it changes
+                    self.errors[filename] = e
+                    continue
+                self.errors.pop(filename, None)
+                if changes:
+                    changed[filename] = changes
+
+            subscribers = list(self._subscribers)
+        for filename, changes in changed.items():
+            self._notify(subscribers, filename, changes)
+        return changed
+
+    def _update(self, watched, text):
+        """
+        Parses the group blocks of `text` that have changed and swaps them
+        into the namelist, returning the changes
+        """
+        namelist = watched.namelist
+        blocks = _group_hashes(text)
+        keys = group_keys([group_name for group_name, _, _, _ in blocks])
+        old_hashes = dict(watched.hashes)
+
+        # everything is parsed before anything is changed, so that the
+        # namelist is left as it was if any block fails to parse
+        new_groups = OrderedDict()
+        for key, (group_name, h, start, end) in zip(keys, blocks):
+            if old_hashes.get(key) == h and key in namelist.groups:
+                new_groups[key] = namelist.groups[key]
+            else:
+                new_groups[key] = namelist._parse_group_block(text[start:end])
+
+        changes = OrderedDict()
+        for key, old_group in namelist.groups.items():
+            if key not in new_groups:
+                changes[key] = None
+            elif new_groups[key] is not old_group:
+                group_changes = diff_variables(old_group, new_groups[key])
+                if group_changes:
+                    changes[key] = group_changes
+        for key, new_group in new_groups.items():
+            if key not in namelist.groups:
+                changes[key] = diff_variables({}, new_group)
+
+        groups = namelist.groups
+        if list(groups.keys()) == keys:
+            for key, group in new_groups.items():
+                if groups[key] is not group:
+                    groups[key] = group
+        else:
+            # groups were added, removed or moved
+            groups.clear()
+            for (group_name, _, _, _), group in zip(blocks, new_groups.values()):
+                namelist.add_group(group_name, group)
+
+        watched.hashes = [(key, h) for key, (_, h, _, _) in zip(keys, blocks)]
+        return changes
+
+    def _notify(self, subscribers, filename, changes):
+        for callback, watched_filename, group_name in subscribers:
+            if watched_filename is not None and watched_filename != filename:
+                continue
+            if group_name is None:
+                callback(filename, changes)
+            elif group_name in changes:
+                callback(filename, OrderedDict([(group_name, changes[group_name])]))
+
+    def start(self):
+        """
+        Polls the watched files every `interval` seconds on a background
+        thread until `stop` is called
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
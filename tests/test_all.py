@@ -1,6 +1,17 @@
+import io
+import os
+import json
 import re
 
-from namelist_python import Namelist
+import pytest
+
+from namelist_python import Namelist, NamelistCache, NamelistTemplate, NamelistWatcher, LayeredNamelist, Schema, SchemaValidationError, validate_files, apply_patch, iter_namelist_groups, read_namelist_file
+from namelist_python.parser import tokenize, NamelistParseError
+from namelist_python.batch import read_namelist_dir
+from namelist_python.index import NamelistIndex, parse_condition
+from namelist_python.values import parse_value, NoSingleValueFoundException
+from namelist_python.arrays import RunLengthArray, SparseArray
+from namelist_python.diff import Change
 
 
 def test_single_value():
@@ -306,3 +317,939 @@ def test_multiline_variable():
 
     assert namelist.groups == {'AADATA': {'AACOMPLEX':
                                           [3., 4., 3., 4., 5., 6., 7., 7.]}}
+
+def test_special_characters_in_string():
+    input_str = """
+    &settings
+    path = '/home/monkey/!data/' ! the path to the data
+    title = "it's a test"
+    name = 'it''s'
+    /
+    """
+    namelist = Namelist(input_str)
+
+    assert namelist.groups == {'settings': {'path': '/home/monkey/!data/',
+                                            'title': "it's a test",
+                                            'name': "it's"}}
+
+def test_multiline_complex_variable():
+    input_str = """&AADATA
+  AACOMPLEX = (3.,4.) (3.,4.)
+              (5.,6.) ! comment between values
+              (7.,7.), AAREAL = 1.
+/"""
+
+    namelist = Namelist(input_str)
+
+    assert namelist.groups == {'AADATA': {'AACOMPLEX': [3.+4.j, 3.+4.j, 5.+6.j, 7.+7.j],
+                                          'AAREAL': 1.}}
+
+def test_tokenize():
+    input_str = "&foo bar(2) = 1, 'a/b' ! comment\n/"
+
+    tokens = [(t.kind, t.text) for t in tokenize(input_str)]
+
+    assert tokens == [('group_start', 'foo'), ('name', 'bar'), ('index', '2'),
+                      ('equals', '='), ('value', '1'), ('comma', ','),
+                      ('value', "'a/b'"), ('comment', '! comment'),
+                      ('group_end', '/')]
+
+def test_iter_namelist_groups():
+    input_str = """! comment with an &ampersand
+    &CCFMSIM_SETUP
+    CCFMrad=800.0 ! comment / with slash
+    path = '/home/monkey/'
+    /
+    &GROUP2
+    R=500.0 400.0
+      300.0
+    /
+    &GROUP2
+    R=1.
+    /
+    """
+    # a small chunk size makes sure that groups span several reads
+    groups = list(iter_namelist_groups(io.StringIO(input_str), chunk_size=7))
+
+    assert groups == [('CCFMSIM_SETUP', {'CCFMrad': 800., 'path': '/home/monkey/'}),
+                      ('GROUP2', {'R': [500., 400., 300.]}),
+                      ('GROUP2', {'R': 1.})]
+
+def test_lazy_groups():
+    input_str = """
+    &CCFMSIM_SETUP
+    CCFMrad=800.0 ! comment / with slash
+    /
+    &GROUP2
+    R=500.0 400.0
+    /
+    &GROUP2
+    R=1.
+    /
+    """
+    namelist = Namelist(input_str, lazy=True)
+
+    assert list(namelist.groups.keys()) == ['CCFMSIM_SETUP', 'GROUP2', 'GROUP20']
+    assert not namelist.groups.is_parsed('GROUP2')
+
+    assert namelist.data.GROUP2.R == [500., 400.]
+    assert namelist.groups.is_parsed('GROUP2')
+    assert not namelist.groups.is_parsed('CCFMSIM_SETUP')
+
+    assert namelist.groups == Namelist(input_str).groups
+    assert namelist.dump() == Namelist(input_str).dump()
+
+def test_numpy_array_backend():
+    numpy = pytest.importorskip('numpy')
+
+    input_str = """&AADATA
+  AAREAL = 1. 1. 2. 3.
+  AAINTEGER = 2 2 3 4
+  AAMIXED = 2 2.5
+  AACOMPLEX = (3.,4.) (5.,6.)
+  AACHAR = 'namelist' 'array'
+  AABOOL = T .false. F
+  AAINDEXED(1) = 1
+  AAINDEXED(2) = 2
+/"""
+    namelist = Namelist(input_str, array_backend='numpy')
+    group = namelist.groups['AADATA']
+
+    assert group['AAREAL'].dtype == numpy.float64
+    assert group['AAREAL'].tolist() == [1., 1., 2., 3.]
+    assert group['AAINTEGER'].dtype == numpy.int64
+    assert group['AAMIXED'].tolist() == [2., 2.5]
+    assert group['AACOMPLEX'].tolist() == [3.+4.j, 5.+6.j]
+    assert group['AACHAR'] == ['namelist', 'array']
+    assert group['AABOOL'].tolist() == [True, False, False]
+    assert group['AAINDEXED'].tolist() == [1, 2]
+
+    # arrays of mixed ints and floats become float arrays
+    assert namelist.dump() == Namelist(input_str).dump().replace('2 2.5', '2. 2.5')
+
+    # numbers are converted from the text in one go, but understood as with
+    # the list backend
+    group = Namelist("&foo x = 1d0, 2.5D-1 3, y = 1 2 e(1) = 5, z = 1 2 3*4 /", array_backend='numpy').groups['foo']
+    assert group['x'].tolist() == [1., .25, 3.]
+    assert group['y'].tolist() == [1, 2]
+    assert group['e'].tolist() == [5]
+    assert group['z'] == RunLengthArray([(1, 1), (1, 2), (3, 4)])
+    for values in ('nan 1', '1, 2, nan', '1.2.3 4', '1+2 3'):
+        for array_backend in ('list', 'numpy'):
+            with pytest.raises(NoSingleValueFoundException):
+                Namelist("&foo x = %s /" % values, array_backend=array_backend)
+
+def test_namelist_cache(tmpdir):
+    filename = str(tmpdir.join('input.nl'))
+    with open(filename, 'w') as f:
+        f.write("&foo\n  bar = 1\n/\n")
+
+    cache = NamelistCache(maxsize=2, cache_dir=str(tmpdir.join('cache')))
+
+    namelist = read_namelist_file(filename, cache=cache)
+    namelist.data.foo.bar = 2
+    assert read_namelist_file(filename, cache=cache).data.foo.bar == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+    # a new cache using the same directory reads the parsed file from disk
+    other_cache = NamelistCache(cache_dir=str(tmpdir.join('cache')))
+    assert other_cache.read(filename).groups == {'foo': {'bar': 1}}
+    assert other_cache.stats()['disk_hits'] == 1
+
+    # only the groups are stored, with the version of their encoding
+    cache_files = [str(p) for p in tmpdir.join('cache').listdir() if '-v' in p.basename]
+    assert len(cache_files) == 1
+    with open(cache_files[0]) as f:
+        assert json.load(f) == {'version': 1, 'groups': [['foo', {'bar': 1}]]}
+
+    # touching the file doesn't change the content hash
+    os.utime(filename, (0, 0))
+    assert cache.read(filename).groups == {'foo': {'bar': 1}}
+    assert cache.stats()['misses'] == 1
+
+    with open(filename, 'w') as f:
+        f.write("&foo\n  bar = 3\n/\n")
+    os.utime(filename, (1, 1))
+    assert cache.read(filename).groups == {'foo': {'bar': 3}}
+    assert cache.stats()['misses'] == 2
+
+    cache.invalidate()
+    assert len(cache) == 0
+    cache.read(filename)
+    assert cache.stats()['misses'] == 3
+
+    # namelists from the cache have the same types as parsed ones
+    filename = str(tmpdir.join('types.nl'))
+    with open(filename, 'w') as f:
+        f.write("&foo\n  bar = 1\n  s = 'abc'\n  n = 12345678901234567890\n/\n")
+    parsed = read_namelist_file(filename)
+    cache.read(filename)
+    cached = cache.read(filename)
+    assert [type(v) for v in cached.groups['foo'].values()] == [type(v) for v in parsed.groups['foo'].values()]
+    assert cached.to_json() == parsed.to_json()
+
+def test_read_namelist_files(tmpdir):
+    for n in range(4):
+        with open(str(tmpdir.join('input%d.nml' % n)), 'w') as f:
+            f.write("&foo\n  bar = %d\n/\n" % n)
+    with open(str(tmpdir.join('input4.nml')), 'w') as f:
+        f.write("&foo\n  bar = 1\n")
+
+    for executor in ['process', 'thread']:
+        results = read_namelist_dir(str(tmpdir), workers=2, executor=executor)
+
+        assert [os.path.basename(r.path) for r in results] == ['input%d.nml' % n for n in range(5)]
+        assert [r.namelist.data.foo.bar for r in results[:4]] == [0, 1, 2, 3]
+        assert results[4].namelist is None
+        assert isinstance(results[4].error, NamelistParseError)
+
+def test_fortran_value_forms():
+    input_str = """&foo
+  dp = 1.0d-3
+  no_frac = 1.e5
+  signed = -2
+  logicals = .t. .F. .TRUE. f
+  cmplx = (-1.5, +2.)
+  repeated = 3*'ab' 2*7
+/"""
+    namelist = Namelist(input_str)
+
+    assert namelist.groups == {'foo': {
+        'dp': 1.0e-3,
+        'no_frac': 1.e5,
+        'signed': -2,
+        'logicals': [True, False, True, False],
+        'cmplx': -1.5+2.j,
+        'repeated': ['ab', 'ab', 'ab', 7, 7],
+    }}
+
+def test_parse_value_unknown():
+    with pytest.raises(NoSingleValueFoundException):
+        parse_value('foo')
+    with pytest.raises(NoSingleValueFoundException):
+        parse_value('1.2.3')
+
+def test_repeat_count():
+    input_str = """&foo
+  mask = 500*.true.
+  z0 = 0.5 1000*0.01 2* 3
+/"""
+    namelist = Namelist(input_str)
+    z0 = namelist.data.foo.z0
+
+    assert isinstance(z0, RunLengthArray)
+    assert len(z0) == 1004
+    assert z0[0] == 0.5 and z0[1000] == 0.01 and z0[1001] is None and z0[-1] == 3
+    assert z0.runs == [[1, 0.5], [1000, 0.01], [2, None], [1, 3]]
+    assert namelist.data.foo.mask == [True]*500
+
+    z0[10] = 0.02
+    assert z0.runs == [[1, 0.5], [9, 0.01], [1, 0.02], [990, 0.01], [2, None], [1, 3]]
+
+    assert namelist.dump() == """&foo
+  mask = 500*.true.
+  z0 = 0.5 9*0.01 0.02 990*0.01 2* 3
+/
+"""
+    assert namelist.dump(array_inline=False) == """&foo
+  mask(1) = 500*.true.
+  z0(1) = 0.5
+  z0(2) = 9*0.01
+  z0(11) = 0.02
+  z0(12) = 990*0.01
+  z0(1004) = 3
+/
+"""
+
+def test_dump_to_values_per_line():
+    input_str = """&foo
+  levels = 1 2 3 4 5
+  names = 'a' 'b'
+/"""
+    namelist = Namelist(input_str)
+
+    output = io.StringIO()
+    namelist.dump_to(output, values_per_line=2)
+
+    assert output.getvalue() == """&foo
+  levels = 1 2
+           3 4
+           5
+  names = 'a' 'b'
+/
+"""
+    assert Namelist(output.getvalue()).groups == namelist.groups
+
+def test_preserve_layout():
+    input_str = """! model setup
+&CCFMSIM_SETUP
+  CCFMrad   = 800.0   ! radius
+  dt = 1.0d0, nsteps = 10
+  var_trac_picture(1) = 'watcnew'
+  var_trac_picture(2) = 'watpnew'
+  unused = T
+/
+&GROUP2 R=500.0 /"""
+    namelist = Namelist(input_str, preserve_layout=True)
+
+    assert namelist.dump() == input_str
+
+    namelist.data.CCFMSIM_SETUP.CCFMrad = 900.
+    namelist.data.CCFMSIM_SETUP.var_trac_picture[1] = 'rain'
+    del namelist.groups['CCFMSIM_SETUP']['unused']
+    namelist.groups['CCFMSIM_SETUP']['new_var'] = 3
+    namelist.groups['GROUP2']['S'] = 'a'
+    namelist.groups['GROUP3'] = {'T': 1}
+
+    assert namelist.dump() == """! model setup
+&CCFMSIM_SETUP
+  CCFMrad   = 900.   ! radius
+  dt = 1.0d0, nsteps = 10
+  var_trac_picture(1) = 'watcnew'
+  var_trac_picture(2) = 'rain'
+  new_var = 3
+/
+&GROUP2 R=500.0 
+  S = 'a'
+/
+&GROUP3
+  T = 1
+/
+"""
+
+def test_array_mixed_assignments():
+    input_str = """&foo
+  a = 1 2 3
+  a(5) = 5
+  a(4) = 4
+  b(2) = 2 3
+  b(1) = 1
+  c = 0
+  c(2) = 1
+/"""
+    namelist = Namelist(input_str)
+
+    assert namelist.groups == {'foo': {'a': [1, 2, 3, 4, 5], 'b': [1, 2, 3], 'c': [0, 1]}}
+
+def test_sparse_array():
+    input_str = """&foo
+  coef(1) = 1.
+  coef(3) = 3.
+  table(100000) = 5
+  table(10) = 1
+/"""
+    namelist = Namelist(input_str)
+
+    coef = namelist.groups['foo']['coef']
+    assert isinstance(coef, SparseArray)
+    assert list(coef) == [1., None, 3.]
+
+    table = namelist.groups['foo']['table']
+    assert isinstance(table, SparseArray)
+    assert len(table) == 100000 and table.nnz == 2
+    assert table.indices == [9, 99999]
+    assert table[9] == 1 and table[99999] == 5 and table[500] is None
+    assert list(table[9:11]) == [1, None]
+    assert table.todense(0)[9] == 1
+
+    table[500] = 7
+    assert list(table.items()) == [(9, 1), (500, 7), (99999, 5)]
+
+    assert namelist.dump() == """&foo
+  coef(1) = 1.
+  coef(3) = 3.
+  table(10) = 1
+  table(501) = 7
+  table(100000) = 5
+/
+"""
+
+def test_multidimensional_array():
+    input_str = """&foo
+  a(1,1) = 1, a(2,1) = 2
+  a(1,2) = 3, a(2,2) = 4
+  b(:,1) = 1 2 3
+  b(:,2) = 4 5 6
+/"""
+    namelist = Namelist(input_str)
+
+    assert namelist.groups['foo']['a'] == [[1, 3], [2, 4]]
+    assert namelist.groups['foo']['b'] == [[1, 4], [2, 5], [3, 6]]
+
+    assert namelist.dump() == """&foo
+  a(1:2,1:2) = 1 2 3 4
+  b(1:3,1:2) = 1 2 3 4 5 6
+/
+"""
+    assert namelist.dump(array_inline=False) == """&foo
+  a(1:2,1) = 1 2
+  a(1:2,2) = 3 4
+  b(1:3,1) = 1 2 3
+  b(1:3,2) = 4 5 6
+/
+"""
+    assert Namelist(namelist.dump(array_inline=False)).groups == namelist.groups
+
+def test_multidimensional_array_numpy():
+    numpy = pytest.importorskip('numpy')
+    input_str = """&foo
+  b(1:3,1) = 1 2 3
+  b(1:3,2) = 4 5 6
+/"""
+    namelist = Namelist(input_str, array_backend='numpy')
+
+    b = namelist.groups['foo']['b']
+    assert b.shape == (3, 2)
+    assert b[2, 1] == 6
+    assert Namelist(namelist.dump()).groups['foo']['b'] == [[1, 4], [2, 5], [3, 6]]
+
+def test_array_sections():
+    input_str = """&foo
+  a(1:3) = 1 2 3
+  b(1:5:2) = 1 3 5
+  b(2:4:2) = 2 4
+  c(3:1:-1) = 3 2 1
+  d(2:) = 2 3
+  d(1) = 1
+/"""
+    namelist = Namelist(input_str)
+
+    assert namelist.groups == {'foo': {'a': [1, 2, 3], 'b': [1, 2, 3, 4, 5], 'c': [1, 2, 3], 'd': [1, 2, 3]}}
+
+def test_inconsistent_multidimensional_array():
+    input_str = """&foo
+  a(1,1) = 1
+  a(2,2) = 4
+/"""
+    with pytest.raises(NamelistParseError) as excinfo:
+        Namelist(input_str)
+    assert "'a'" in str(excinfo.value)
+
+def test_derived_types():
+    input_str = """&foo
+  physics%microphysics%nccn = 100
+  physics%dt = 2.
+  domains(2)%dx = 500., domains(1)%dx = 1000.
+  domains(2)%levels(1:2) = 1 2
+/"""
+    namelist = Namelist(input_str)
+
+    assert namelist.groups == {'foo': {
+        'physics': {'microphysics': {'nccn': 100}, 'dt': 2.},
+        'domains': [{'dx': 1000.}, {'dx': 500., 'levels': [1, 2]}],
+    }}
+    assert namelist.data.foo.physics.microphysics.nccn == 100
+    assert namelist.get('foo.domains(2)%dx') == 500.
+
+    namelist.set('foo.physics%microphysics%nccn', 200)
+    nccn = namelist.accessor('foo.physics%microphysics%nccn')
+    assert nccn.get() == 200
+    nccn.set(300)
+    assert namelist.data.foo.physics.microphysics.nccn == 300
+
+    assert namelist.dump() == """&foo
+  physics%microphysics%nccn = 300
+  physics%dt = 2.
+  domains(1)%dx = 1000.
+  domains(2)%dx = 500.
+  domains(2)%levels = 1 2
+/
+"""
+    assert Namelist(namelist.dump()).groups == namelist.groups
+
+def test_derived_types_preserve_layout():
+    input_str = """&foo
+  physics%dt = 1. ! time step
+  physics%nccn = 100
+/
+"""
+    namelist = Namelist(input_str, preserve_layout=True)
+    namelist.data.foo.physics.nccn = 200
+
+    assert namelist.dump() == """&foo
+  physics%dt = 1. ! time step
+  physics%nccn = 200
+/
+"""
+
+def test_data_attribute_access():
+    namelist = Namelist("&foo a = 1 /")
+
+    foo = namelist.data.foo
+    assert namelist.data.foo is foo
+    foo.b = 2
+    foo.update(a=3, c='x')
+    assert namelist.groups == {'foo': {'a': 3, 'b': 2, 'c': 'x'}}
+    assert namelist.dump() == """&foo
+  a = 3
+  b = 2
+  c = 'x'
+/
+"""
+
+    with pytest.raises(AttributeError):
+        foo.d
+
+    namelist.groups['foo'] = {'a': 4}
+    assert namelist.data.foo.a == 4
+
+def test_template(tmpdir):
+    input_str = """&foo
+  physics%nccn = 100
+  physics%dt = 2.
+  x = 1 2 3
+/
+&bar
+  y = 'a'
+/"""
+    namelist = Namelist(input_str)
+    template = NamelistTemplate(namelist, ['foo.physics%nccn', 'foo.x', 'bar.z'])
+
+    assert template.render({}) == namelist.dump()
+    assert template.render({'foo.x': [4, 5], 'bar.z': 3.5, 'foo.physics%nccn': 7}) == """&foo
+  physics%nccn = 7
+  physics%dt = 2.
+  x = 4 5
+/
+&bar
+  y = 'a'
+  z = 3.5
+/
+"""
+    with pytest.raises(ValueError):
+        template.render({'foo.y': 1})
+
+    members = [{'foo.physics%nccn': n} for n in range(5)]
+    filenames = template.write_members(members, str(tmpdir.join('member_%03d.nml')), workers=2, executor='thread')
+    assert len(filenames) == 5
+    assert read_namelist_file(filenames[3]).groups['foo']['physics']['nccn'] == 3
+
+def test_diff_and_patch():
+    old = Namelist("""&foo
+  x = 1 2 3 4
+  y = 1.
+  p%q = 1
+  s = 'a'
+/
+&bar z = 1 /""")
+    new = Namelist(old.dump())
+    new.groups['foo']['x'][2] = 9
+    new.groups['foo']['p']['q'] = 2
+    del new.groups['foo']['s']
+    new.groups['foo']['t'] = True
+    del new.groups['bar']
+
+    changes = old.diff(new)
+    assert list(changes.keys()) == ['foo', 'bar']
+    assert changes['bar'] is None
+    foo = changes['foo']
+    assert (foo['x'].kind, foo['x'].indices, foo['x'].old, foo['x'].new) == ('changed', [2], [3], [9])
+    assert (foo['p%q'].kind, foo['p%q'].new) == ('changed', 2)
+    assert foo['s'].kind == 'removed'
+    assert (foo['t'].kind, foo['t'].new) == ('added', True)
+
+    old.patch(changes)
+    assert old.groups == new.groups
+    assert old.diff(new) == {}
+
+def test_diff_numpy():
+    pytest.importorskip('numpy')
+    old = Namelist("&foo x = 1 2 3 4 /", array_backend='numpy')
+    new = Namelist("&foo x = 1 2 5 4 /", array_backend='numpy')
+
+    change = old.diff(new)['foo']['x']
+    assert (change.indices, change.old, change.new) == ([2], [3], [5])
+
+def test_apply_patch(tmpdir):
+    file_in = str(tmpdir.join('in.nml'))
+    file_out = str(tmpdir.join('out.nml'))
+    with open(file_in, 'w') as f:
+        f.write("""! header
+&foo
+  x = 1 2 3 ! xs
+  y = 1.
+/
+&bar z = 1 /
+""")
+    apply_patch(file_in, file_out, {'foo': {'y': 2.}, 'baz': {'w': 1}})
+
+    with open(file_out) as f:
+        assert f.read() == """! header
+&foo
+  x = 1 2 3 ! xs
+  y = 2.
+/
+&bar z = 1 /
+&baz
+  w = 1
+/
+"""
+
+    # groups that aren't in the file are written under their own name, or
+    # as another instance of a repeated group if the change set says so
+    with open(file_in, 'w') as f:
+        f.write("&run x = 1 /\n")
+    new = Namelist("&run x = 1 /\n&run x = 2 /\n&run2 y = 3 /")
+    apply_patch(file_in, file_out, Namelist("&run x = 1 /").diff(new))
+    with open(file_out) as f:
+        assert Namelist(f.read()).groups == new.groups
+    apply_patch(file_in, file_out, {'run2': {'y': 3}})
+    with open(file_out) as f:
+        assert f.read() == "&run x = 1 /\n&run2\n  y = 3\n/\n"
+
+def test_namelist_index(tmpdir):
+    runs = tmpdir.mkdir('runs')
+    runs.join('a.nml').write("&setup dt = 3. scheme = 'kessler' /")
+    runs.join('b.nml').write("&setup dt = 6. levels = 1 2 3 /")
+    runs.mkdir('sub').join('c.nml').write("&setup dt = 4. flag = T physics%nccn = 100 /")
+    runs.join('bad.nml').write("&setup dt = ")
+    runs.join('d.nml').write("&tracer name = 'o3' /\n&tracer name = 'co2' /")
+
+    with NamelistIndex(str(tmpdir.join('index.sqlite'))) as index:
+        assert index.update(str(runs), workers=1) == (5, 0)
+        assert len(index.errors()) == 1
+
+        def query(*conditions):
+            return [os.path.basename(p) for p in index.query(*[parse_condition(c) for c in conditions])]
+
+        assert query("setup.dt<5") == ['a.nml', 'c.nml']
+        assert query("setup.dt>=4", "setup.flag=T") == ['c.nml']
+        assert query("setup.scheme='kessler'") == ['a.nml']
+        assert query("setup.levels") == ['b.nml']
+        assert query("setup.levels<=3") == ['b.nml']
+        assert query("setup.physics%nccn==100") == ['c.nml']
+        assert query("setup.dt!=3") == ['b.nml', 'c.nml']
+        # repeated groups are found by their name
+        assert query("tracer.name='co2'") == ['d.nml']
+        assert query("tracer0.name") == []
+
+        # only new and changed files are parsed again
+        assert index.update(str(runs), workers=1) == (0, 0)
+        runs.join('b.nml').remove()
+        runs.join('a.nml').write("&setup dt = 10. /")
+        assert index.update(str(runs), workers=1) == (1, 1)
+        assert query("setup.dt>5") == ['a.nml']
+
+def test_read_namelist_file_mmap(tmpdir):
+    path = tmpdir.join('input.nml')
+    path.write_text(u"""! comment with unicode \u00e9
+&foo
+  a = 1 2 3
+  s = 'caf\u00e9', t = .true.
+/""", encoding='utf-8')
+
+    namelist = read_namelist_file(str(path), use_mmap=True)
+    assert namelist.groups == read_namelist_file(str(path)).groups
+    assert namelist.groups['foo']['s'] == u'caf\u00e9'
+
+    tmpdir.join('empty.nml').write("")
+    assert read_namelist_file(str(tmpdir.join('empty.nml')), use_mmap=True).groups == {}
+
+    with pytest.raises(ValueError):
+        read_namelist_file(str(path), use_mmap=True, lazy=True)
+
+    path = tmpdir.join('latin1.nml')
+    path.write_text(u"&foo s = 'caf\u00e9' /", encoding='latin-1')
+    for use_mmap in (False, True):
+        namelist = read_namelist_file(str(path), use_mmap=use_mmap, encoding='latin-1')
+        assert namelist.groups['foo']['s'] == u'caf\u00e9'
+
+    # the cache reads the file the same way
+    for use_mmap in (False, True):
+        cache = NamelistCache()
+        for _ in range(2):
+            namelist = read_namelist_file(str(path), use_mmap=use_mmap, encoding='latin-1', cache=cache)
+            assert namelist.groups['foo']['s'] == u'caf\u00e9'
+        assert cache.stats()['misses'] == 1
+    # a file read with another encoding is parsed again
+    with pytest.raises(UnicodeDecodeError):
+        read_namelist_file(str(path), cache=cache)
+
+def test_layered_namelist():
+    base = Namelist("""&foo
+  x = 1 2 3
+  y = 1.
+  physics%a = 1
+  physics%b = 2
+/
+&bar z = 1 /""")
+    experiment = Namelist("&foo y = 2. physics%b = 5 flag = T /")
+    layered = LayeredNamelist(base, experiment)
+
+    assert layered.data.foo.y == 2.
+    assert layered.get('foo.physics%a') == 1
+    assert layered.dump() == """&foo
+  x = 1 2 3
+  y = 2.
+  physics%a = 1
+  physics%b = 5
+  flag = .true.
+/
+&bar
+  z = 1
+/
+"""
+
+    member = layered.new_child()
+    # reading leaves the top layer empty, only changes are copied up
+    assert member.data.foo.x == [1, 2, 3]
+    assert member.data.foo.physics.a == 1
+    assert 'x' in member.groups['foo']
+    assert member.groups['foo'].get('x') == [1, 2, 3]
+    assert member.groups['foo'].get('missing') is None
+    assert member.layers[-1].groups == {}
+    member.data.foo.x[1] = 9
+    member.set('foo.physics%a', 7)
+    del member.groups['foo']['flag']
+    del member.groups['bar']
+    assert member.dump() == """&foo
+  x = 1 9 3
+  y = 2.
+  physics%a = 7
+  physics%b = 5
+/
+"""
+    # the layers below are left as they were
+    assert base.groups['foo']['x'] == [1, 2, 3]
+    assert base.groups['foo']['physics'] == {'a': 1, 'b': 2}
+    assert experiment.groups['foo']['flag'] is True
+    assert 'bar' in layered.groups
+
+    flat = member.flatten()
+    assert isinstance(flat, Namelist)
+    assert flat.dump() == member.dump()
+
+
+def test_schema(tmpdir):
+    schema = Schema({
+        'foo': {
+            'dt': {'type': 'real', 'min': 0., 'default': 1.},
+            'n': {'type': 'integer', 'required': True},
+            'levels': {'type': 'real', 'shape': 3},
+            'scheme': {'type': 'character', 'choices': ['kessler', 'seifert']},
+            'physics%nccn': 'integer',
+            'domains%dx': 'real',
+        },
+    })
+    namelist = Namelist("""&foo
+  n = 3
+  levels = 1 2 3
+  physics%nccn = 100
+  domains(2)%dx = 250
+/""", schema=schema)
+    group = namelist.groups['foo']
+    assert group['n'] == 3
+    # integers given for reals are converted, and defaults filled in
+    assert group['levels'] == [1., 2., 3.] and type(group['levels'][0]) is float
+    assert type(group['domains'][1]['dx']) is float
+    assert group['dt'] == 1.
+
+    namelist = Namelist("&foo n = 3 levels = 1 2 3 /", schema=schema, array_backend='numpy')
+    assert namelist.groups['foo']['levels'].dtype.kind == 'f'
+
+    with pytest.raises(SchemaValidationError) as e:
+        Namelist("""&foo
+  n = 3.5
+  levels = 1 2
+  dt = -1.
+  scheme = 'other'
+  unknown = 1
+/
+&bar x = 1 /""", schema=schema)
+    assert [(error.variable, error.line) for error in e.value.errors] == [
+        ('n', 2), ('levels', 3), ('dt', 4), ('scheme', 5), ('unknown', 6), (None, 8)]
+    assert "expected integer values" in e.value.errors[0].message
+
+    with pytest.raises(SchemaValidationError) as e:
+        Namelist("&foo dt = 1. /", schema=schema)
+    assert e.value.errors[0].message == "required variable is missing"
+
+    # values that aren't valid fortran, or of the wrong type, are reported
+    # where they are rather than raised
+    with pytest.raises(SchemaValidationError) as e:
+        Namelist("&foo\n  n = 1_000\n  dt = nan\n  physics%nccn = abc\n/", schema=schema)
+    assert [(error.variable, error.line, error.message) for error in e.value.errors] == [
+        ('n', 2, "expected integer values, got '1_000'"),
+        ('dt', 3, "expected real values, got 'nan'"),
+        ('physics%nccn', 4, "value 'abc' not understood")]
+
+    # validating a namelist that has already been parsed
+    namelist = Namelist("&foo n = 1 levels = 1. 2. 3. extra = 1 /")
+    assert [error.variable for error in schema.validate(namelist)] == ['extra']
+    assert Schema(schema.spec, allow_unknown=True).validate(namelist) == []
+
+    good, bad = tmpdir.join('good.nml'), tmpdir.join('bad.nml')
+    good.write("&foo n = 1 /")
+    bad.write("&foo n = 1 dt = -1. /")
+    results = validate_files([str(good), str(bad)], schema, workers=2, executor='thread')
+    assert [path for path, errors in results] == [str(good), str(bad)]
+    assert results[0][1] == [] and results[1][1][0].variable == 'dt'
+
+
+def test_repeated_groups():
+    input_str = """&tracer name = 'o3' molar_mass = 48. /
+&other x = 1 /
+&tracer name = 'co2' molar_mass = 44. /
+&tracer name = 'dust' /
+"""
+    for lazy in (False, True):
+        namelist = Namelist(input_str, lazy=lazy)
+        assert list(namelist.groups) == ['tracer', 'other', 'tracer0', 'tracer1']
+        assert namelist.group('tracer', 1)['name'] == 'co2'
+        assert [t['name'] for t in namelist.instances('tracer')] == ['o3', 'co2', 'dust']
+        assert namelist.group_name('tracer0') == 'tracer'
+
+    assert namelist.column('tracer', 'molar_mass') == [48., 44., None]
+    numpy = pytest.importorskip('numpy')
+    column = Namelist(input_str, array_backend='numpy').column('tracer', 'molar_mass', default=0.)
+    assert numpy.array_equal(column, [48., 44., 0.])
+
+    # written back out in the original order under their own name
+    namelist.add_group('tracer')['name'] = 'bc'
+    assert namelist.dump() == """&tracer
+  name = 'o3'
+  molar_mass = 48.
+/
+&other
+  x = 1
+/
+&tracer
+  name = 'co2'
+  molar_mass = 44.
+/
+&tracer
+  name = 'dust'
+/
+&tracer
+  name = 'bc'
+/
+"""
+
+
+def test_repeated_groups_keys():
+    # a group whose name is the key of an instance of another group doesn't
+    # replace it
+    namelist = Namelist("&g a = 1 / &g a = 4 / &g a = 5 / &g0 b = 1 /")
+    assert list(namelist.groups) == ['g', 'g0', 'g1', 'g00']
+    assert [g['a'] for g in namelist.instances('g')] == [1, 4, 5]
+    assert namelist.group('g0') == {'b': 1}
+    assert namelist.dump() == "&g\n  a = 1\n/\n&g\n  a = 4\n/\n&g\n  a = 5\n/\n&g0\n  b = 1\n/\n"
+
+    # deleted instances are gone from both `instances` and `group`
+    del namelist.groups['g0']
+    assert [g['a'] for g in namelist.instances('g')] == [1, 5]
+    assert namelist.group('g', 1) == {'a': 5}
+    with pytest.raises(IndexError):
+        namelist.group('g', 2)
+
+    # an instance added by a patch is an instance of its group
+    other = Namelist("&st x = 1 / &st x = 2 /")
+    namelist = Namelist("&st x = 1 /")
+    namelist.patch(namelist.diff(other))
+    assert [g['x'] for g in namelist.instances('st')] == [1, 2]
+    assert namelist.dump() == "&st\n  x = 1\n/\n&st\n  x = 2\n/\n"
+
+    # while a group whose name ends in digits is a group of its own
+    other = Namelist("&run x = 1 / &run2 y = 2 /")
+    namelist = Namelist("&run x = 1 /")
+    namelist.patch(namelist.diff(other))
+    assert namelist.group('run2') == {'y': 2}
+    assert namelist.dump() == "&run\n  x = 1\n/\n&run2\n  y = 2\n/\n"
+
+
+def test_export_json_and_npz(tmpdir):
+    numpy = pytest.importorskip('numpy')
+    input_str = """&foo
+  n = 3
+  c = (1., 2.)
+  runs = 100*0.5
+  sparse(1) = 1
+  sparse(1000) = 2
+  m(1:2,1:2) = 1 2 3 4
+  physics%%nccn = 100
+  levels = %s
+/
+&foo n = 4 /
+""" % " ".join("%d." % i for i in range(200))
+    for array_backend in ('list', 'numpy'):
+        namelist = Namelist(input_str, array_backend=array_backend)
+        loaded = Namelist.from_json(namelist.to_json(), array_backend=array_backend)
+        assert loaded.dump() == namelist.dump()
+        assert loaded.group('foo', 1)['n'] == 4
+
+        filename = str(tmpdir.join('%s.npz' % array_backend))
+        namelist.save_npz(filename)
+        for mmap in (False, True):
+            loaded = Namelist.load_npz(filename, array_backend=array_backend, mmap=mmap)
+            assert loaded.dump() == namelist.dump()
+
+    levels = Namelist.load_npz(filename, array_backend='numpy', mmap=True).groups['foo']['levels']
+    assert isinstance(levels, numpy.memmap)
+    # changes aren't written back to the file
+    levels[0] = 5.
+    assert Namelist.load_npz(filename, array_backend='numpy').groups['foo']['levels'][0] == 0.
+
+
+def test_export_msgpack():
+    pytest.importorskip('msgpack')
+    namelist = Namelist("&foo x = %s c = (1., 2.) /" % " ".join("%d" % i for i in range(100)))
+    assert Namelist.from_msgpack(namelist.to_msgpack()).dump() == namelist.dump()
+
+
+def test_export_dataset(tmpdir):
+    pytest.importorskip('numpy')
+    from namelist_python.export import convert_dir, load_dataset
+    tmpdir.join('a.nml').write("&foo n = 1 name = 'a' v = 1 2 3 /\n&foo n = 2 /")
+    tmpdir.join('b.nml').write("&foo m(1:2,1:2) = 1 2 3 4 /")
+    tmpdir.join('c.nml').write("&foo n = ")
+
+    filename = str(tmpdir.join('dataset.npz'))
+    errors = convert_dir(str(tmpdir), filename, workers=1)
+    assert [os.path.basename(path) for path, error in errors] == ['c.nml']
+
+    dataset = load_dataset(filename, mmap=True)
+    assert list(dataset['variable']) == ['n', 'name', 'v', 'n', 'm']
+    assert list(dataset['occurrence']) == [0, 0, 0, 1, 0]
+    assert list(dataset['number'][[0, 3]]) == [1., 2.]
+    assert dataset['text'][1] == 'a' and dataset['text'][4] == '[2, 2]'
+    offset, length = dataset['offset'][4], dataset['length'][4]
+    assert list(dataset['values'][offset:offset+length]) == [1., 2., 3., 4.]
+
+
+def test_namelist_watcher(tmpdir):
+    path = tmpdir.join('watched.nml')
+
+    def write(text, mtime):
+        path.write(text)
+        os.utime(str(path), (mtime, mtime))
+
+    write("&foo x = 1 y = 2 /\n&bar z = 1 /\n&bar z = 2 /\n", 1)
+    watcher = NamelistWatcher()
+    namelist = watcher.watch(str(path))
+    foo, bar = namelist.groups['foo'], namelist.groups['bar']
+    notified, bar0_notified = [], []
+    watcher.subscribe(lambda filename, changes: notified.append(changes))
+    watcher.subscribe(lambda filename, changes: bar0_notified.append(changes), group_name='bar0')
+    assert watcher.poll() == {}
+
+    # only the block that changed is parsed again
+    write("&foo x = 1 y = 2 /\n&bar z = 1 /\n&bar z = 3 /\n", 2)
+    changes = watcher.poll()[str(path)]
+    assert list(changes) == ['bar0']
+    assert changes['bar0']['z'] == Change('changed', 2, 3, None)
+    assert namelist.groups['foo'] is foo and namelist.groups['bar'] is bar
+    assert namelist.group('bar', 1) == {'z': 3}
+    assert notified == [changes] and bar0_notified == [changes]
+
+    write("&bar z = 1 /\n&foo x = 1 /\n&baz q = 1 /\n", 3)
+    changes = watcher.poll()[str(path)]
+    assert changes['bar0'] is None and list(changes['foo']) == ['y'] and 'baz' in changes
+    assert list(namelist.groups) == ['bar', 'foo', 'baz']
+    assert bar0_notified[-1] == {'bar0': None}
+
+    # a file that fails to parse leaves the namelist as it was
+    write("&bar z = ", 4)
+    assert watcher.poll() == {}
+    assert isinstance(watcher.errors[str(path)], NamelistParseError)
+    assert list(namelist.groups) == ['bar', 'foo', 'baz']